@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Benchmark DHT datastore stores/sec of the SqliteDataStore and
+BulkSqliteDataStore backends on a scratch database.
+
+Execute from root dir as: python -m benchmarks.datastore_bench [-n 2000]
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from node import datastore, db_store, setup_db
+
+
+def _make_db(directory, name):
+    db_path = os.path.join(directory, name)
+    setup_db.setup_db(db_path, disable_sqlite_crypt=True)
+    return db_store.Obdb(db_path, disable_sqlite_crypt=True)
+
+
+def _store(data_store, count, distinct_keys):
+    now = int(time.time())
+    start = time.time()
+    for i in range(count):
+        data_store.set_item(
+            ('%040x' % (i % distinct_keys)), "{'listing': %d}" % i,
+            now, now, 'a' * 40, market_id=1
+        )
+    data_store.flush()
+    return count / (time.time() - start)
+
+
+class _IdleLoop(object):
+    """An IOLoop stand-in whose timeouts never fire: batches flush by size."""
+    def call_later(self, delay, callback):
+        return None
+
+    def remove_timeout(self, timeout):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-n', type=int, default=2000, help='number of stores')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        backends = (
+            ('SqliteDataStore', lambda db: datastore.SqliteDataStore(db)),
+            ('BulkSqliteDataStore (write-through)',
+             lambda db: datastore.BulkSqliteDataStore(db)),
+            ('BulkSqliteDataStore (batched)',
+             lambda db: datastore.BulkSqliteDataStore(db, io_loop=_IdleLoop())),
+        )
+        for index, (name, make_store) in enumerate(backends):
+            for label, distinct_keys in (('new keys', args.n),
+                                         ('updates', max(args.n // 10, 1))):
+                data_store = make_store(_make_db(directory, '%d-%s.db' % (index, label)))
+                rate = _store(data_store, args.n, distinct_keys)
+                print '%-38s %-9s %10.0f stores/sec' % (name, label, rate)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""
+Benchmark the common Obdb.select_entries patterns of orders.py and
+market.py, with pooled connections and with a new connection per call.
+
+Execute from root dir as: python -m benchmarks.db_store_bench [-n 1000]
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from node import db_store, setup_db
+
+MARKET_ID = 1
+GUID = 'a' * 40
+
+# (name, select_entries args, select_entries kwargs)
+QUERIES = (
+    ('orders page', ("orders", {"market_id": MARKET_ID}),
+     {'order_field': "updated", 'order': "DESC", 'limit': 10, 'limit_offset': 20}),
+    ('order by order_id', ("orders", {"order_id": 42}), {}),
+    ('all market orders', ("orders", {"market_id": MARKET_ID}), {}),
+    ('peer by guid', ("peers", {"guid": GUID}), {}),
+    ('settings', ("settings", {"market_id": MARKET_ID}), {}),
+    ('contracts page', ("contracts", {"market_id": MARKET_ID, "deleted": 0}),
+     {'limit': 10, 'limit_offset': 10}),
+    ('contract by id', ("contracts", {"id": 7}), {}),
+    ('keystore ids', ("keystore",), {'select_fields': "id"}),
+)
+
+
+def _populate(db, orders):
+    db.insert_entry("settings", {"market_id": MARKET_ID, "guid": GUID})
+    db.insert_entry("peers", {"market_id": MARKET_ID, "guid": GUID})
+    for i in range(orders):
+        db.insert_entry("orders", {
+            "order_id": i, "market_id": MARKET_ID, "state": "Sent",
+            "buyer": GUID, "merchant": 'b' * 40, "updated": i
+        })
+        db.insert_entry("keystore", {"order_id": i})
+    for i in range(orders // 10):
+        db.insert_entry("contracts", {
+            "market_id": MARKET_ID, "deleted": 0, "item_title": "item %d" % i
+        })
+
+
+def _time_queries(db, repeat, reconnect):
+    results = []
+    for name, args, kwargs in QUERIES:
+        start = time.time()
+        for _ in range(repeat):
+            db.select_entries(*args, **kwargs)
+            if reconnect:
+                db.close()
+        results.append((name, repeat / (time.time() - start)))
+    return results
+
+
+def _time_concurrent(db, repeat, threads):
+    def worker():
+        for _ in range(repeat):
+            db.select_entries(*QUERIES[0][1], **QUERIES[0][2])
+
+    def writer():
+        for i in range(repeat):
+            db.update_entries("orders", {"state": "Paid"}, {"order_id": i})
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    workers.append(threading.Thread(target=writer))
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return threads * repeat / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-n', type=int, default=1000, help='number of orders')
+    parser.add_argument('-r', type=int, default=200, help='repetitions per query')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(directory, 'bench.db')
+        setup_db.setup_db(db_path, disable_sqlite_crypt=True)
+        db = db_store.Obdb(db_path, disable_sqlite_crypt=True)
+        _populate(db, args.n)
+
+        per_call = _time_queries(db, args.r, reconnect=True)
+        pooled = _time_queries(db, args.r, reconnect=False)
+        print '%-20s %16s %16s' % ('query/sec', 'new connection', 'pooled')
+        for (name, per_call_rate), (_, pooled_rate) in zip(per_call, pooled):
+            print '%-20s %16.0f %16.0f' % (name, per_call_rate, pooled_rate)
+
+        print '%-37s %16.0f' % (
+            'orders page, 4 readers + 1 writer',
+            _time_concurrent(db, args.r, 4)
+        )
+        db.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Measure the peak RSS of reading every row of a large datastore table
+with Obdb.select_entries and with Obdb.iter_entries.
+
+Execute from root dir as: python -m benchmarks.iter_entries_bench [-n 50000]
+"""
+
+import argparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from node import db_store, setup_db
+
+MODES = ('baseline', 'select_entries', 'iter_entries')
+
+
+def _make_db(db_path, rows):
+    setup_db.setup_db(db_path, disable_sqlite_crypt=True)
+    db = db_store.Obdb(db_path, disable_sqlite_crypt=True)
+    con = db._make_db_connection()
+    with con:
+        con.executemany(
+            "INSERT INTO datastore(key, value, lastPublished, "
+            "originallyPublished, originalPublisherID, market_id) "
+            "VALUES(?, ?, ?, ?, ?, ?)",
+            (
+                ('%040x' % i, 'x' * 1024, '0', '0', 'a' * 40, 1)
+                for i in range(rows)
+            )
+        )
+    con.close()
+
+
+def _read(db_path, mode):
+    """Read the whole table in this process; return the peak RSS in KiB."""
+    db = db_store.Obdb(db_path, disable_sqlite_crypt=True)
+    size = 0
+    if mode == 'select_entries':
+        for row in db.select_entries("datastore"):
+            size += len(row['value'])
+    elif mode == 'iter_entries':
+        for row in db.iter_entries("datastore"):
+            size += len(row['value'])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-n', type=int, default=50000, help='number of rows')
+    parser.add_argument('--read', nargs=2, metavar=('PATH', 'MODE'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.read:
+        print _read(*args.read)
+        return
+
+    directory = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(directory, 'bench.db')
+        _make_db(db_path, args.n)
+        print '%d rows, peak RSS:' % args.n
+        for mode in MODES:
+            # A fresh process per mode, so that peaks don't overlap.
+            peak = subprocess.check_output([
+                sys.executable, '-m', 'benchmarks.iter_entries_bench',
+                '--read', db_path, mode
+            ])
+            print '  %-16s %8d KiB' % (mode, int(peak))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""
+Measure the BIP32 key derivations per second of deriving every key from
+the seed, as was done before node.keychain, and of a KeyChain with cold
+and warm caches.
+
+Execute from root dir as: python -m benchmarks.keychain_bench [-n 200]
+"""
+
+import argparse
+import os
+import time
+
+import bitcoin
+
+from node import keychain
+
+
+def _from_seed(seed, key_id):
+    wallet = bitcoin.bip32_ckd(bitcoin.bip32_master_key(seed), 1)
+    wallet_chain = bitcoin.bip32_ckd(wallet, 0)
+    bip32_identity_priv = bitcoin.bip32_ckd(wallet_chain, key_id)
+    return bitcoin.encode_privkey(bitcoin.bip32_extract_key(bip32_identity_priv), 'wif')
+
+
+def _rate(derive, key_ids):
+    start = time.time()
+    for key_id in key_ids:
+        derive(key_id)
+    return len(key_ids) / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-n', type=int, default=200, help='number of keys')
+    args = parser.parse_args()
+
+    seed = os.urandom(32).encode('hex')
+    key_ids = range(1, args.n + 1)
+    # Room for the child and the signing key of each key id.
+    chain = keychain.KeyChain(seed, cache_size=2 * args.n)
+
+    results = (
+        ('from seed', _rate(lambda key_id: _from_seed(seed, key_id), key_ids)),
+        ('keychain, cold', _rate(chain.get_signing_key, key_ids)),
+        ('keychain, warm', _rate(chain.get_signing_key, key_ids)),
+    )
+    print '%d signing keys %20s' % (args.n, 'derivations/s')
+    for name, rate in results:
+        print '%-20s %14.1f' % (name, rate)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Count the DHT stores and messages of republishing the keyword indexes
+of a store, one store per keyword of each listing as was done before
+node.keyword_publisher, and batched by KeywordPublisher.
+
+Execute from root dir as: python -m benchmarks.keyword_publish_bench [-n 500]
+"""
+
+import argparse
+import random
+
+import mock
+
+from node import constants, dht, keyword_publisher
+
+
+def _listings(rand, count, keywords_per_listing, vocabulary_size):
+    # The keywords of a store come from a small, skewed vocabulary: most
+    # listings share a few category keywords.
+    vocabulary = ['keyword%d' % number for number in range(vocabulary_size)]
+    weights = [1.0 / rank for rank in range(1, vocabulary_size + 1)]
+    listings = []
+    for number in range(count):
+        keywords = set()
+        while len(keywords) < keywords_per_listing:
+            point = rand.random() * sum(weights)
+            for keyword, weight in zip(vocabulary, weights):
+                point -= weight
+                if point <= 0:
+                    break
+            keywords.add(keyword)
+        listings.append(('%040x' % rand.getrandbits(160), sorted(keywords)))
+    return listings
+
+
+def _transport():
+    transport = mock.Mock()
+    transport.guid = '1' * 40
+    transport.dht.keyword_index_shard = dht.DHT.keyword_index_shard
+    # The number of distinct keys does not depend on how they are hashed.
+    transport.dht.keyword_index_key = (
+        lambda keyword, shard: (keyword.upper(), shard)
+    )
+    return transport
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-n', type=int, default=500, help='number of listings')
+    parser.add_argument('-k', type=int, default=5, help='keywords per listing')
+    parser.add_argument('-v', type=int, default=100, help='store vocabulary size')
+    parser.add_argument('-p', type=int, default=20, help='active peers')
+    args = parser.parse_args()
+
+    listings = _listings(random.Random(0), args.n, args.k, args.v)
+
+    # Before: one store per keyword of each listing.
+    per_keyword = sum(len(keywords) for _, keywords in listings)
+
+    transport = _transport()
+    publisher = keyword_publisher.KeywordPublisher(
+        transport, 1, io_loop=mock.Mock()
+    )
+    for listing_key, keywords in listings:
+        for keyword in keywords:
+            publisher.add(keyword, listing_key)
+    ticks = 0
+    while len(publisher):
+        publisher.publish()
+        ticks += 1
+    batched = transport.store.call_count
+
+    # Each store is one lookup plus a direct store to every active peer.
+    print '%d listings, %d keywords each, %d active peers, %d shards' % (
+        args.n, args.k, args.p, constants.KEYWORD_INDEX_SHARDS
+    )
+    print '%-14s %8s %16s' % ('', 'stores', 'direct messages')
+    for name, stores in (('per keyword', per_keyword), ('batched', batched)):
+        print '%-14s %8d %16d' % (name, stores, stores * args.p)
+    print 'batched over %d ticks of %ds' % (
+        ticks, constants.KEYWORD_PUBLISH_INTERVAL
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+Measure the query latency of node.listing_index.ListingIndex over a
+large number of synthetic listings, next to ranking every match rather
+than the most recent LISTING_SEARCH_CANDIDATES, and to a LIKE scan of
+the same listings. A common term, matching most listings, should not
+take longer than a rare one by more than the cost of its candidates.
+
+Execute from root dir as: python -m benchmarks.listing_index_bench [-n 100000]
+"""
+
+import argparse
+import bisect
+import os
+import random
+import shutil
+import string
+import tempfile
+import time
+
+from node import constants, db_store, listing_index, setup_db
+
+# Listing text is drawn from a Zipf distributed vocabulary, as natural
+# language is: a few words are in most listings, most are in few.
+VOCABULARY_SIZE = 5000
+
+
+def _vocabulary(rand):
+    words = set()
+    while len(words) < VOCABULARY_SIZE:
+        words.add(''.join(
+            rand.choice(string.ascii_lowercase)
+            for _ in range(rand.randint(3, 9))
+        ))
+    words = sorted(words)
+    rand.shuffle(words)
+    return words
+
+
+def _sampler(rand, words):
+    cumulative, total = [], 0.0
+    for rank in range(1, len(words) + 1):
+        total += 1.0 / rank
+        cumulative.append(total)
+
+    def sample(count):
+        return [
+            words[bisect.bisect(cumulative, rand.random() * cumulative[-1])]
+            for _ in range(count)
+        ]
+    return sample
+
+
+def _listing(sample, number):
+    return {
+        'Seller': {'seller_GUID': '%040x' % number},
+        'Contract': {
+            'item_title': ' '.join(sample(4)),
+            'item_keywords': sample(3),
+            'item_desc': ' '.join(sample(40))
+        }
+    }
+
+
+def _queries(words):
+    """Queries of common, middling and rare words of the vocabulary."""
+    return (
+        ('common term', words[5]),
+        ('middling term', words[200]),
+        ('rare prefix', words[3000][:3]),
+        ('two terms', '%s %s' % (words[20], words[100])),
+        ('three terms', '%s %s %s' % (words[10], words[50], words[300][:3])),
+    )
+
+
+def _latency(search, text, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        search(text)
+    return (time.time() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-n', type=int, default=100000, help='number of listings')
+    parser.add_argument('-r', type=int, default=20, help='repetitions per query')
+    args = parser.parse_args()
+
+    db_dir = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(db_dir, 'bench.db')
+        setup_db.setup_db(db_path, disable_sqlite_crypt=True)
+        db = db_store.Obdb(db_path, disable_sqlite_crypt=True)
+        index = listing_index.ListingIndex(db, 1, max_rows=args.n)
+        index._get_connection().execute('PRAGMA synchronous = OFF')
+
+        rand = random.Random(0)
+        words = _vocabulary(rand)
+        sample = _sampler(rand, words)
+        start = time.time()
+        for number in range(args.n):
+            index.add('%040x' % number, _listing(sample, number), '', '')
+        print 'indexed %d listings in %.1fs' % (args.n, time.time() - start)
+
+        con = index._get_connection()
+
+        def like_scan(text):
+            terms = listing_index.ListingIndex.make_query(text).split()
+            where = ' AND '.join(['contract_body LIKE ?'] * len(terms))
+            return con.execute(
+                'SELECT key FROM listings WHERE %s ORDER BY updated DESC '
+                'LIMIT 20' % where,
+                ['%%%s%%' % term.rstrip('*') for term in terms]
+            ).fetchall()
+
+        print '%-14s %-26s %8s %10s %10s %10s' % (
+            'query', 'text', 'matches', 'index ms', 'all ms', 'LIKE ms'
+        )
+        for name, text in _queries(words):
+            matches = con.execute(
+                'SELECT COUNT(*) FROM listings_fts WHERE listings_fts MATCH ?',
+                (listing_index.ListingIndex.make_query(text),)
+            ).fetchone()[0]
+            latency = _latency(index.search, text, args.r)
+            index.candidates = args.n
+            all_latency = _latency(index.search, text, args.r)
+            index.candidates = constants.LISTING_SEARCH_CANDIDATES
+            print '%-14s %-26s %8d %10.2f %10.2f %10.2f' % (
+                name, repr(text), matches, latency, all_latency,
+                _latency(like_scan, text, args.r)
+            )
+        index.close()
+        db.close()
+    finally:
+        shutil.rmtree(db_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Benchmark the latency of the order page queries of Orders.get_orders
+on a large orders table, before and after the migration5 indexes.
+
+Execute from root dir as: python -m benchmarks.orders_page_bench [-n 100000]
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from db.migrations import migration5
+from node import db_store
+
+MARKET_ID = 1
+
+QUERIES = (
+    ('orders page', ("orders", {"market_id": MARKET_ID}),
+     {'order_field': "updated", 'order': "DESC", 'limit': 10, 'limit_offset': 50}),
+    ('order by order_id', ("orders", {"order_id": 4242}), {}),
+    ('order by buyer_order_id', ("orders", {"buyer_order_id": "4242"}), {}),
+)
+
+
+def _make_db(db_path, orders):
+    db = db_store.Obdb(db_path, disable_sqlite_crypt=True)
+    con = db._make_db_connection()
+    with con:
+        con.execute(
+            "CREATE TABLE orders (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "order_id INT, market_id INT, state TEXT, buyer_order_id TEXT, "
+            "buyer TEXT, merchant TEXT, signed_contract_body TEXT, updated INT)"
+        )
+        con.executemany(
+            "INSERT INTO orders(order_id, market_id, state, buyer_order_id, "
+            "buyer, merchant, signed_contract_body, updated) "
+            "VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                (i, MARKET_ID, 'Sent', str(i), 'a' * 40, 'b' * 40, 'x' * 1024,
+                 (i * 7919) % orders)
+                for i in range(orders)
+            )
+        )
+    con.close()
+    return db
+
+
+def _time_queries(db, repeat):
+    results = []
+    for name, args, kwargs in QUERIES:
+        start = time.time()
+        for _ in range(repeat):
+            db.select_entries(*args, **kwargs)
+        results.append((name, (time.time() - start) / repeat * 1000))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-n', type=int, default=100000, help='number of orders')
+    parser.add_argument('-r', type=int, default=20, help='repetitions per query')
+    args = parser.parse_args()
+    # Show the index advisor's reports of the unindexed queries.
+    logging.basicConfig(level=logging.WARNING)
+
+    directory = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(directory, 'bench.db')
+        db = _make_db(db_path, args.n)
+
+        before = _time_queries(db, args.r)
+        con = db._make_db_connection()
+        with con:
+            for name, table, columns in migration5.INDEXES:
+                if table == 'orders':
+                    con.execute("CREATE INDEX %s ON %s(%s)" % (name, table, columns))
+        con.close()
+        after = _time_queries(db, args.r)
+
+        print '%d orders, ms/query %16s %16s' % (args.n, 'no indexes', 'migration5')
+        for (name, before_ms), (_, after_ms) in zip(before, after):
+            print '%-30s %16.2f %16.2f' % (name, before_ms, after_ms)
+        db.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Measure the store messages and bytes sent to publish one contract,
+broadcasting it to all the active peers as well as to the nodes found by
+the lookup, as was done before, and storing it on the K closest nodes
+only.
+
+Execute from root dir as: python -m benchmarks.store_fanout_bench [-p 50]
+"""
+
+import argparse
+import json
+import os
+
+import mock
+
+from node import constants, dht
+
+
+def _dht(active_peers, sent):
+    node = dht.DHT(mock.Mock(), 1, {'guid': '0' * 40}, mock.Mock())
+    node.transport.guid = '0' * 40
+    node._store_locally = mock.Mock()
+    node.active_peers = [
+        mock.Mock(hostname='10.0.%d.%d' % divmod(num, 256), port=12345,
+                  guid='%040x' % num)
+        for num in range(1, active_peers + 1)
+    ]
+    peer = mock.Mock()
+    peer.send.side_effect = lambda msg: sent.append(len(json.dumps(msg)))
+    node.routing_table.get_contact = mock.Mock(return_value=peer)
+    return node
+
+
+def _shortlist(count):
+    # Mostly the nodes close to the key, which are not all active peers.
+    return [
+        ('10.1.%d.%d' % divmod(num, 256), 12345, '%040x' % (num * 7919),
+         'pub', 'nick', None)
+        for num in range(1, count + 1)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-p', type=int, default=50, help='active peers')
+    parser.add_argument('-s', type=int, default=40, help='lookup shortlist size')
+    parser.add_argument('-b', type=int, default=4096, help='contract bytes')
+    args = parser.parse_args()
+
+    key = os.urandom(20).encode('hex')
+    contract = os.urandom(args.b / 2).encode('hex')
+    shortlist = _shortlist(args.s)
+
+    # Before: the value went to every active peer and every node the
+    # lookup returned.
+    before = []
+    node = _dht(args.p, before)
+    with node._peers_lock:
+        active = [(peer.hostname, peer.port, peer.guid) for peer in node.active_peers]
+    node.store_key_value(active, key, contract, node.transport.guid, 0)
+    node.store_key_value(shortlist, key, contract, node.transport.guid, 0)
+
+    after = []
+    node = _dht(args.p, after)
+    node.iterative_find_node = mock.Mock()
+    node.iterative_store(key, contract)
+    node.iterative_find_node.call_args[0][1](shortlist)
+
+    print '%d byte contract, %d active peers, %d nodes found, K = %d' % (
+        args.b, args.p, args.s, constants.K
+    )
+    print '%-16s %10s %12s' % ('', 'messages', 'bytes')
+    for name, sent in (('all peers', before), ('K closest', after)):
+        print '%-16s %10d %12d' % (name, len(sent), sum(sent))
+    print '(lookup messages, identical in both, and encryption not counted)'
+
+
+if __name__ == "__main__":
+    main()
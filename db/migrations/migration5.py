@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+from sqlite3 import dbapi2
+
+from db.migrations import migrations_util
+from node import constants
+
+# (name, table, columns) of the indexes backing the frequent lookups.
+INDEXES = (
+    ('orders_order_id', 'orders', 'order_id'),
+    ('orders_buyer_order_id', 'orders', 'buyer_order_id'),
+    ('orders_market_id_updated', 'orders', 'market_id, updated'),
+    ('peers_guid', 'peers', 'guid'),
+    ('peers_hostname', 'peers', 'hostname'),
+    ('contracts_market_id_deleted', 'contracts', 'market_id, deleted'),
+    ('inbox_recipient_guid', 'inbox', 'recipient_guid'),
+    ('inbox_sender_guid', 'inbox', 'sender_guid'),
+    ('keystore_contract_id', 'keystore', 'contract_id'),
+)
+
+
+def upgrade(db_path):
+    with dbapi2.connect(db_path) as con:
+        cur = con.cursor()
+
+        # Use PRAGMA key to encrypt / decrypt database.
+        cur.execute("PRAGMA key = '%s';" % constants.DB_PASSPHRASE)
+
+        try:
+            for name, table, columns in INDEXES:
+                cur.execute("CREATE INDEX IF NOT EXISTS %s ON %s(%s)"
+                            % (name, table, columns))
+
+            # The datastore is looked up by key; its index is unique,
+            # so drop any duplicates first.
+            cur.execute("DELETE FROM datastore WHERE id NOT IN "
+                        "(SELECT MAX(id) FROM datastore "
+                        "GROUP BY key, market_id)")
+            cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS "
+                        "datastore_key_market_id ON datastore(key, market_id)")
+            print 'Upgraded'
+            con.commit()
+        except dbapi2.Error as exc:
+            print 'Exception: %s' % exc
+
+
+def downgrade(db_path):
+    with dbapi2.connect(db_path) as con:
+        cur = con.cursor()
+
+        # Use PRAGMA key to encrypt / decrypt database.
+        cur.execute("PRAGMA key = '%s';" % constants.DB_PASSPHRASE)
+
+        for name, _, _ in INDEXES:
+            cur.execute("DROP INDEX IF EXISTS %s" % name)
+        cur.execute("DROP INDEX IF EXISTS datastore_key_market_id")
+
+        print 'Downgraded'
+        con.commit()
+
+
+def main():
+    parser = migrations_util.make_argument_parser(constants.DB_PATH)
+    args = parser.parse_args()
+    if args.action == "upgrade":
+        upgrade(args.path)
+    else:
+        downgrade(args.path)
+
+if __name__ == "__main__":
+    main()
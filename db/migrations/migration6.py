@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+from sqlite3 import dbapi2
+
+from db.migrations import migrations_util
+from node import constants
+
+
+def upgrade(db_path):
+    with dbapi2.connect(db_path) as con:
+        cur = con.cursor()
+
+        # Use PRAGMA key to encrypt / decrypt database.
+        cur.execute("PRAGMA key = '%s';" % constants.DB_PASSPHRASE)
+
+        try:
+            # The parsed sections of signed_contract_body, and the
+            # digest of the contract they were parsed from. They are
+            # filled in the first time each order is read.
+            cur.execute("ALTER TABLE orders "
+                        "ADD COLUMN contract_digest TEXT")
+            cur.execute("ALTER TABLE orders "
+                        "ADD COLUMN parsed_contract TEXT")
+            print 'Upgraded'
+            con.commit()
+        except dbapi2.Error as exc:
+            print 'Exception: %s' % exc
+
+
+def downgrade(db_path):
+    with dbapi2.connect(db_path) as con:
+        cur = con.cursor()
+
+        # Use PRAGMA key to encrypt / decrypt database.
+        cur.execute("PRAGMA key = '%s';" % constants.DB_PASSPHRASE)
+
+        cur.execute("ALTER TABLE orders DROP COLUMN contract_digest")
+        cur.execute("ALTER TABLE orders DROP COLUMN parsed_contract")
+
+        print 'Downgraded'
+        con.commit()
+
+
+def main():
+    parser = migrations_util.make_argument_parser(constants.DB_PATH)
+    args = parser.parse_args()
+    if args.action == "upgrade":
+        upgrade(args.path)
+    else:
+        downgrade(args.path)
+
+if __name__ == "__main__":
+    main()
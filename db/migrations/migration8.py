@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+from sqlite3 import dbapi2
+
+from db.migrations import migrations_util
+from node import constants
+
+
+def upgrade(db_path):
+    with dbapi2.connect(db_path) as con:
+        cur = con.cursor()
+
+        # Use PRAGMA key to encrypt / decrypt database.
+        cur.execute("PRAGMA key = '%s';" % constants.DB_PASSPHRASE)
+
+        try:
+            # The fingerprint of the key each verified contract was
+            # signed with, by digest of the contract text.
+            cur.execute("CREATE TABLE IF NOT EXISTS verified_contracts ("
+                        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "digest TEXT, "
+                        "fingerprint TEXT, "
+                        "created INT)")
+            cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS "
+                        "verified_contracts_digest "
+                        "ON verified_contracts(digest)")
+            print 'Upgraded'
+            con.commit()
+        except dbapi2.Error as exc:
+            print 'Exception: %s' % exc
+
+
+def downgrade(db_path):
+    with dbapi2.connect(db_path) as con:
+        cur = con.cursor()
+
+        # Use PRAGMA key to encrypt / decrypt database.
+        cur.execute("PRAGMA key = '%s';" % constants.DB_PASSPHRASE)
+
+        cur.execute("DROP TABLE IF EXISTS verified_contracts")
+
+        print 'Downgraded'
+        con.commit()
+
+
+def main():
+    parser = migrations_util.make_argument_parser(constants.DB_PATH)
+    args = parser.parse_args()
+    if args.action == "upgrade":
+        upgrade(args.path)
+    else:
+        downgrade(args.path)
+
+if __name__ == "__main__":
+    main()
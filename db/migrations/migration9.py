@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+from sqlite3 import dbapi2
+
+from db.migrations import migrations_util
+from node import constants
+
+
+def upgrade(db_path):
+    with dbapi2.connect(db_path) as con:
+        cur = con.cursor()
+
+        # Use PRAGMA key to encrypt / decrypt database.
+        cur.execute("PRAGMA key = '%s';" % constants.DB_PASSPHRASE)
+
+        try:
+            # The local search index of listings, see node.listing_index
+            cur.execute("CREATE TABLE IF NOT EXISTS listings ("
+                        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "key TEXT, "
+                        "market_id INT, "
+                        "guid TEXT, "
+                        "nickname TEXT, "
+                        "contract_body TEXT, "
+                        "signed_contract_body TEXT, "
+                        "updated INT, "
+                        "used INT)")
+            columns = [row[1] for row in
+                       cur.execute("PRAGMA table_info(listings)")]
+            if 'used' not in columns:
+                # Created by a version which made the index on demand
+                cur.execute("ALTER TABLE listings ADD COLUMN used INT")
+                cur.execute("UPDATE listings SET used = updated")
+            cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS "
+                        "listings_key_market_id "
+                        "ON listings(key, market_id)")
+            cur.execute("CREATE INDEX IF NOT EXISTS "
+                        "listings_market_id_used "
+                        "ON listings(market_id, used)")
+            cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS listings_fts "
+                        "USING fts4(item_title, item_keywords, item_desc, "
+                        "tokenize=unicode61, prefix=\"2,3\")")
+            print 'Upgraded'
+            con.commit()
+        except dbapi2.Error as exc:
+            print 'Exception: %s' % exc
+
+
+def downgrade(db_path):
+    with dbapi2.connect(db_path) as con:
+        cur = con.cursor()
+
+        # Use PRAGMA key to encrypt / decrypt database.
+        cur.execute("PRAGMA key = '%s';" % constants.DB_PASSPHRASE)
+
+        cur.execute("DROP TABLE IF EXISTS listings_fts")
+        cur.execute("DROP TABLE IF EXISTS listings")
+
+        print 'Downgraded'
+        con.commit()
+
+
+def main():
+    parser = migrations_util.make_argument_parser(constants.DB_PATH)
+    args = parser.parse_args()
+    if args.action == "upgrade":
+        upgrade(args.path)
+    else:
+        downgrade(args.path)
+
+if __name__ == "__main__":
+    main()
@@ -41,6 +41,9 @@ class KBucket(collections.Sequence):
         # while stale contacts are near the head.
         self._contacts = []
 
+        # Index of the above contacts by guid, for O(1) lookups.
+        self._guid_index = {}
+
     # pylint: disable=no-self-argument
     # pylint: disable=not-callable
     def _touch(func):
@@ -77,13 +80,25 @@ class KBucket(collections.Sequence):
                 is not already in it.
         """
         assert self.contact_in_range(contact), 'Wrong KBucket.'
-        try:
-            self._contacts.remove(contact)
-        except ValueError:
-            pass
+        self._push_contact(contact)
+
+    def _push_contact(self, contact):
+        """
+        Append a contact at the tail of the contact list, evicting
+        any prior contact with the same guid. Keep the guid index
+        in sync.
+
+        Raises:
+            FullBucketError: The bucket is full and the contact to add
+                is not already in it.
+        """
+        old_contact = self._guid_index.pop(contact.guid, None)
+        if old_contact is not None:
+            self._contacts.remove(old_contact)
 
         if len(self._contacts) < constants.K:
             self._contacts.append(contact)
+            self._guid_index[contact.guid] = contact
         else:
             raise FullBucketError('No space in bucket to insert contact')
 
@@ -99,10 +114,7 @@ class KBucket(collections.Sequence):
         Returns:
             A contact.Contact with the given guid or None
         """
-        for contact in self._contacts:
-            if contact.guid == guid:
-                return contact
-        return None
+        return self._guid_index.get(guid)
 
     @_touch
     def get_contacts(self, count=-1, excluded_guid=None):
@@ -154,9 +166,11 @@ class KBucket(collections.Sequence):
         If no such contact exists, do nothing.
         """
         try:
-            self._contacts.remove(contact)
+            index = self._contacts.index(contact)
         except ValueError:
-            pass
+            return
+        removed = self._contacts.pop(index)
+        del self._guid_index[removed.guid]
 
     @_touch
     def remove_guid(self, guid):
@@ -169,11 +183,9 @@ class KBucket(collections.Sequence):
 
         If no such contact exists, do nothing.
         """
-        self._contacts = [
-            contact
-            for contact in self._contacts
-            if contact.guid != guid
-        ]
+        contact = self._guid_index.pop(guid, None)
+        if contact is not None:
+            self._contacts.remove(contact)
 
     def split_kbucket(self):
         """
@@ -194,9 +206,7 @@ class KBucket(collections.Sequence):
         # Ensure no empty range is created.
         assert self.range_min < half_point < self.range_max
 
-        # Make the instantiation dependent on the actual class,
-        # for easy inheritance.
-        new_kbucket = self.__class__(half_point, self.range_max)
+        new_kbucket = self._spawn(half_point, self.range_max)
 
         # Halve the ID space of the split KBucket.
         self.range_max = half_point
@@ -206,9 +216,25 @@ class KBucket(collections.Sequence):
             self._contacts,
             self.contact_in_range
         )
+        self._reindex()
+        new_kbucket._reindex()
 
         return new_kbucket
 
+    def _spawn(self, range_min, range_max):
+        """
+        Make an empty KBucket of the same kind, covering the given range.
+        """
+        # Make the instantiation dependent on the actual class,
+        # for easy inheritance.
+        return self.__class__(range_min, range_max)
+
+    def _reindex(self):
+        """Rebuild the guid index from the contact list."""
+        self._guid_index = dict(
+            (contact.guid, contact) for contact in self._contacts
+        )
+
     def contact_in_range(self, contact):
         """
         Test whether the given contact is in the range of the ID
@@ -45,8 +45,13 @@ class RoutingTable(collections.Sequence):
                 table, strictly for logging purposes.
         """
         self.own_guid = own_guid
+        # Incremented whenever a contact joins or leaves the table, or
+        # is replaced by another object, so that results derived from
+        # it can be cached and invalidated. Seeing a known contact
+        # again only reorders its bucket, and does not count.
+        self.version = 0
         self._buckets = [
-            kbucket.CachingKBucket(0, 2**constants.BIT_NODE_ID_LEN)
+            self._make_kbucket(0, 2**constants.BIT_NODE_ID_LEN)
         ]
         self._log = logging.getLogger(
             '[%s] %s' % (market_id, self.__class__.__name__)
@@ -58,6 +63,14 @@ class RoutingTable(collections.Sequence):
     def __len__(self):
         return len(self._buckets)
 
+    @staticmethod
+    def _make_kbucket(range_min, range_max):
+        """
+        Make the initial KBucket, covering the given range. Further
+        KBuckets are created by splitting it.
+        """
+        return kbucket.CachingKBucket(range_min, range_max)
+
     def add_contact(self, contact):
         """
         Add the given contact to the correct KBucket; if it already
@@ -76,6 +89,7 @@ class RoutingTable(collections.Sequence):
 
         kbucket_index = self._get_kbucket_index(contact.guid)
         bucket = self._buckets[kbucket_index]
+        old_contact = bucket.get_contact(contact.guid)
         try:
             bucket.add_contact(contact)
         except kbucket.FullBucketError:
@@ -96,6 +110,9 @@ class RoutingTable(collections.Sequence):
                 self.add_contact(contact)
             else:
                 bucket.cache_contact(contact)
+        else:
+            if old_contact is not contact:
+                self.version += 1
 
     def get_contact(self, guid):
         """
@@ -127,7 +144,9 @@ class RoutingTable(collections.Sequence):
                 RoutingTable.
         """
         bucket = self._get_kbucket_by_guid(contact.guid)
-        bucket.remove_contact(contact)
+        if bucket.get_contact(contact.guid) is not None:
+            bucket.remove_contact(contact)
+            self.version += 1
 
     def remove_guid(self, guid):
         """
@@ -141,7 +160,9 @@ class RoutingTable(collections.Sequence):
         BadGUIDError: `guid` is outside the range of the RoutingTable.
         """
         bucket = self._get_kbucket_by_guid(guid)
-        bucket.remove_guid(guid)
+        if bucket.get_contact(guid) is not None:
+            bucket.remove_guid(guid)
+            self.version += 1
 
     def find_close_nodes(self, guid, count=constants.K, sender_guid=None):
         """
@@ -181,10 +202,7 @@ class RoutingTable(collections.Sequence):
         for i in gen_indices_closest_to_furthest(index_of_closest_bucket):
             bucket = self._buckets[i]
             closest_nodes.extend(
-                bucket.get_contacts(
-                    count - len(closest_nodes),
-                    excluded_guid=sender_guid
-                )
+                bucket.get_contacts(count - len(closest_nodes), sender_guid)
             )
             if len(closest_nodes) >= count:
                 break
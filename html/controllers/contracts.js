@@ -32,6 +32,7 @@ angular.module('app')
 
             Connection.$on('load_page', function(e, msg){ $scope.load_page(msg); });
             Connection.$on('contracts', function(e, msg){ $scope.parse_contracts(msg); });
+            Connection.$on('save_contract_result', function(e, msg){ $scope.onSaveContractResult(msg); });
             Connection.$on('btc_ticker', function(e, msg){ $scope.parse_btc_ticker(msg); });
 
             $scope.load_page = function(msg) {
@@ -40,6 +41,12 @@ angular.module('app')
                 $scope.queryContracts();
             };
 
+            $scope.onSaveContractResult = function(msg) {
+                if (msg.result === 'failure') {
+                    Notifier.error(msg.detail, 'Couldn\'t save contract.');
+                }
+            };
+
             $scope.queryContracts = function() {
                 var query = { 'type': 'query_contracts' };
                 Connection.send('query_contracts', query);
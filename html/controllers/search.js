@@ -43,6 +43,26 @@ angular.module('app')
 
             };
 
+            // The network is searched a keyword index shard at a time;
+            // ask for the next shard when the results are scrolled to
+            // the end.
+            $scope.loadMoreSearchResults = function() {
+                if(!$scope.searching) {
+                    return;
+                }
+                Connection.send('search_more', {
+                    'type': 'search_more',
+                    'key': $scope.searching
+                });
+            };
+
+            $(window).scroll(function() {
+                if($scope.searchPanel &&
+                   $(window).scrollTop() + $(window).height() > $(document).height() - 200) {
+                    $scope.loadMoreSearchResults();
+                }
+            });
+
             $scope.load_page = function(msg) {
                 console.log($location.search());
                 $('#dashboard-container').removeClass('col-sm-8').addClass('col-sm-12');
@@ -88,6 +108,10 @@ angular.module('app')
                 var contract_body = JSON.parse(contract_data.contract_body);
                 console.log(contract_body.Seller);
 
+                if (jQuery.isEmptyObject(contract_body.Contract.item_images)) {
+                    contract_body.Contract.item_images = "img/no-photo.png";
+                }
+
                 if(!(key in $scope.search_results)) {
                     $scope.search_results[key] = contract_body;
                 }
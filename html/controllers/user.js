@@ -32,6 +32,10 @@ angular.module('app')
                     Connection.$on('store_contracts', function(e, msg){ $scope.parse_store_listings(msg); });
                     listeners.store_contract = [];
                     Connection.$on('store_contract', function(e, msg){ $scope.parse_store_contract(msg); });
+                    listeners.store_contracts_removed = [];
+                    Connection.$on('store_contracts_removed', function(e, msg){ $scope.parse_store_contracts_removed(msg); });
+                    listeners.listing_sync = [];
+                    Connection.$on('listing_sync', function(e, msg){ $scope.parse_listing_sync(msg); });
                     listeners.page = [];
                     Connection.$on('page', function(e, msg){ $scope.parse_page(msg); });
                     Connection.$on('store_products', function(e, msg){ $scope.parse_store_products(msg); });
@@ -211,6 +215,39 @@ angular.module('app')
                 $scope.no_listings = false;
             };
 
+            $scope.parse_store_contracts_removed = function(msg) {
+                $scope.store_listings = $.grep($scope.store_listings, function(listing) {
+                    return msg.keys.indexOf(listing.key) == -1;
+                });
+            };
+
+            // The store streams its listings a window at a time; ask for
+            // the next window when the listings are scrolled to the end.
+            $scope.store_has_more = false;
+            $scope.parse_listing_sync = function(msg) {
+                if(msg.senderGUID == $scope.guid) {
+                    $scope.store_has_more = msg.more;
+                }
+            };
+
+            $scope.loadMoreStoreProducts = function() {
+                if(!$scope.store_has_more) {
+                    return;
+                }
+                $scope.store_has_more = false;
+                Connection.send('query_store_products_more', {
+                    'type': 'query_store_products_more',
+                    'key': $scope.guid
+                });
+            };
+
+            $(window).scroll(function() {
+                if($scope.storeProductsPanel &&
+                   $(window).scrollTop() + $(window).height() > $(document).height() - 200) {
+                    $scope.loadMoreStoreProducts();
+                }
+            });
+
             $scope.parse_store_listings = function(msg) {
                 var contracts = msg.product;
 
@@ -25,6 +25,31 @@ from rudp.packetsender import PacketSender
 from tornado import ioloop
 
 
+def sign_message(transport, data):
+    """
+    Add the sender information of `transport` to the message `data` and
+    sign it.
+
+    @return: The serialized envelope of the message, which is then
+             encrypted for each peer it is sent to.
+    """
+    data['senderGUID'] = transport.guid
+    data['pubkey'] = transport.pubkey
+    data['senderNick'] = transport.nickname
+    data['avatar_url'] = transport.settings.get('avatar_url')
+    data['senderNamecoin'] = transport.namecoin_id
+    data['v'] = VERSION
+
+    # Sign cleartext data
+    sig_data = json.dumps(data).encode('hex')
+    signature = transport.cryptor.sign(sig_data).encode('hex')
+
+    return json.dumps({
+        'sig': signature,
+        'data': sig_data
+    })
+
+
 class PeerConnection(GUIDMixin, object):
     def __init__(self, guid, transport, hostname, port=12345, nickname="",
                  avatar_url="", peer_socket=None, nat_type=None):
@@ -256,6 +281,7 @@ class CryptoPeerConnection(PeerConnection):
         self.pub = pub
         self.sin = sin
         self.waiting = False  # Waiting for ping-pong
+        self.version = None  # Protocol version, once heard from
 
     def __repr__(self):
         try:
@@ -297,28 +323,27 @@ class CryptoPeerConnection(PeerConnection):
             self.log.warn('There is no public key for encryption')
             return
 
-        # Include sender information and version
+        # Include recipient, sender information and version
         data['guid'] = self.guid
-        data['senderGUID'] = self.transport.guid
-        data['pubkey'] = self.transport.pubkey
-        data['senderNick'] = self.transport.nickname
-        data['avatar_url'] = self.transport.settings.get('avatar_url')
-        data['senderNamecoin'] = self.transport.namecoin_id
-        data['v'] = VERSION
-
-        # Sign cleartext data
-        sig_data = json.dumps(data).encode('hex')
-        signature = self.sign(sig_data).encode('hex')
+        envelope = sign_message(self.transport, data)
 
         self.log.datadump('Sending to peer: %s %s', self.hostname,
                           pformat(data))
 
+        self.send_envelope(envelope, callback)
+
+    def send_envelope(self, envelope, callback=None):
+        """
+        Encrypt and send a message signed by sign_message(). Messages
+        sent to many peers can be signed once and sent this way.
+        """
+        if not self.pub:
+            self.log.warn('There is no public key for encryption')
+            return
+
         try:
             # Encrypt signature and data
-            data = self.encrypt(json.dumps({
-                'sig': signature,
-                'data': sig_data
-            }))
+            data = self.encrypt(envelope)
         except Exception as exc:
             self.log.error('Encryption failed. %s', exc)
             return
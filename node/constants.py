@@ -1,6 +1,10 @@
 # ####### IMPLEMENTATION-SPECIFIC CONSTANTS ###########
 # OpenBazaar Version Number
-VERSION = "0.5.0"
+VERSION = "0.5.1"
+
+# Oldest version of peers which merge the keyword and notary index
+# updates sent to them; older ones are sent the whole updated index
+INDEX_UPDATE_MIN_VERSION = (0, 5, 1)
 
 # Max size of a single UDP datagram.
 # Any larger message will be spread accross several UDP packets.
@@ -13,8 +17,43 @@ DB_PASSPHRASE = "passphrase"
 
 DB_PATH = "db/ob.db"
 
+# Number of connections serving concurrent DB reads, and the page cache
+# of each DB connection
+DB_READER_POOL_SIZE = 4
+# Seconds to wait for a reader connection when all of them are busy,
+# before reading on a temporary connection instead
+DB_READER_TIMEOUT = 5
+DB_CACHE_SIZE = 8 * 1024  # KiB
+
+# Number of rows fetched at a time when streaming query results
+DB_ITER_CHUNK_SIZE = 500
+
+# DB queries taking longer than this get their query plan logged
+# [seconds]
+DB_SLOW_QUERY_THRESHOLD = 0.05
+
+# DHT datastore writes are buffered for up to this long and written
+# in a single transaction, or sooner if this many are buffered
+DATASTORE_FLUSH_INTERVAL = 0.5  # seconds
+DATASTORE_BATCH_SIZE = 100
+
+# Memory bound of the cache of parsed contracts, shared by the market,
+# its orders and the web socket handler, counted as the size of the
+# contract texts
+CONTRACT_CACHE_MAX_BYTES = 4 * 1024 * 1024  # 4 MB
+
+# Number of derived BIP32 child keys kept in memory
+BIP32_KEY_CACHE_SIZE = 1024
+
 SATOSHIS_IN_BITCOIN = 100000000
 
+# The balances of the escrow addresses of the orders being viewed are
+# polled in one batch every PAYMENT_POLL_INTERVAL; an address is no
+# longer polled once its order has not been viewed for
+# PAYMENT_WATCH_TIMEOUT
+PAYMENT_POLL_INTERVAL = 60  # seconds
+PAYMENT_WATCH_TIMEOUT = 60 * 60  # seconds
+
 # The IP of the default DNSChain Server used to validate namecoin addresses
 DNSCHAIN_SERVER_IP = "192.184.93.146"
 
@@ -46,9 +85,22 @@ RPC_TIMEOUT = 0.1
 ITERATIVE_LOOKUP_DELAY = RPC_TIMEOUT / 2
 
 # If a KBucket has not been used for this amount of time, refresh it.
-# [seconds]
+# [milliseconds]
 REFRESH_TIMEOUT = 60 * 60 * 1000  # 1 hour
 
+# Maximum number of bucket refresh lookups in flight at once
+REFRESH_CONCURRENCY = ALPHA
+
+# The bucket refresh lookups of a cycle are started at random
+# times within this window, rather than all at once
+# [seconds]
+REFRESH_SPREAD = 5 * 60  # 5 minutes
+
+# A bucket refresh lookup which has not finished by then
+# is abandoned, freeing its slot
+# [seconds]
+REFRESH_LOOKUP_TIMEOUT = 30
+
 # The interval in which the node should check whether any buckets
 # need refreshing or whether any data needs to be republished
 # [seconds]
@@ -65,6 +117,23 @@ REPLICATE_INTERVAL = REFRESH_TIMEOUT
 # [seconds]
 DATE_EXPIRE_TIMEOUT = 86400  # 24 hours
 
+# The interval at which stored data is republished (by its original
+# publisher) or replicated (by other nodes holding it)
+# [seconds]
+REPUBLISH_INTERVAL = 60 * 60  # 1 hour
+
+# The interval at which the republish scheduler processes the
+# stored data that is due
+# [seconds]
+REPUBLISH_TICK_INTERVAL = 10
+
+# Maximum number of keys republished per scheduler tick
+REPUBLISH_BATCH_SIZE = 20
+
+# Maximum amount of value data republished per scheduler tick
+# [bytes]
+REPUBLISH_BANDWIDTH_BUDGET = 64 * 1024  # 64 KB
+
 # ####### CONNECTION/NETWORKING RELATED CONSTANTS #######
 PEERCONNECTION_NO_RESPONSE_DELAY_IN_SECONDS = 10
 PEERCONNECTION_SENDING_OUT_DELAY_IN_SECONDS = 5
@@ -92,3 +161,60 @@ MSG_RELAYTO_ID = 'relayto'
 MSG_RELAY_ID = 'relay '  # Trailing space is intentional.
 
 CLOSE_NODE_TIMELIMIT_IN_SECONDS = 5*60
+
+# Maximum number of close_nodes() results cached, and the time after
+# which a cached result is recomputed even if the routing table has
+# not changed
+CLOSE_NODES_CACHE_SIZE = 256
+CLOSE_NODES_CACHE_TTL = 10  # seconds
+
+# Number of shards the keyword index of a keyword is split in, and the
+# maximum number of listings in a shard. A full shard moves its oldest
+# listings to an overflow shard, so the number of shards of a keyword
+# grows with its listings, up to KEYWORD_INDEX_MAX_SHARDS
+KEYWORD_INDEX_SHARDS = 8
+KEYWORD_INDEX_SHARD_SIZE = 256
+KEYWORD_INDEX_MAX_SHARDS = 1024
+
+# Seconds between two batches of keyword index updates, and the maximum
+# number of keyword index keys stored per batch
+KEYWORD_PUBLISH_INTERVAL = 1
+KEYWORD_PUBLISH_BATCH_SIZE = 20
+
+# Length of the listing key prefixes exchanged to synchronize the
+# listings of a store, and the memory bound of the listings cached from
+# other stores
+LISTING_DIGEST_LENGTH = 16
+STORE_LISTING_CACHE_MAX_BYTES = 8 * 1024 * 1024  # 8 MB
+
+# Maximum number of listings of other stores kept in the local search
+# index
+LISTING_INDEX_MAX_ROWS = 20000
+
+# Most recently indexed matches of a local search which are ranked, so
+# that searching for a common word does not rank every listing
+LISTING_SEARCH_CANDIDATES = 500
+
+# Number of listings requested per window when browsing a store, the
+# most a store sends per window, and the number sent per message
+LISTING_WINDOW = 20
+LISTING_WINDOW_MAX = 100
+LISTING_FRAME_SIZE = 5
+
+# Worker threads rendering contract images, the size of the thumbnail
+# inlined in contracts and the sizes thumbnails can be rendered at
+# [pixels]
+THUMBNAIL_WORKERS = 2
+THUMBNAIL_SIZE = 200
+THUMBNAIL_SIZES = (64, 200, 400)
+
+# Disk bound of the thumbnails fetched from other stores, and the time
+# after which a store which does not send an image is given up on
+PEER_IMAGE_CACHE_MAX_BYTES = 32 * 1024 * 1024  # 32 MB
+PEER_IMAGE_TIMEOUT = 30  # seconds
+
+# Number of contract signature verifications remembered in memory, on
+# top of those kept in the database, and the most contracts verified
+# by one batch of the verification worker
+VERIFY_CACHE_SIZE = 4096
+VERIFY_BATCH_SIZE = 32
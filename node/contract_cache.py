@@ -0,0 +1,99 @@
+"""
+Caching of parsed contracts.
+
+Signed contracts are stored and exchanged as PGP clearsigned text, from
+which the JSON sections have to be cut out and decoded. This module
+caches the result, keyed by a digest of the contract text, so that each
+contract is parsed once.
+
+Classes:
+    ContractCache -- Memory-bounded LRU cache of parsed contracts.
+
+Functions:
+    contract_digest -- The digest contracts are cached by.
+"""
+
+import collections
+import hashlib
+import threading
+
+from node import constants
+
+
+def contract_digest(raw_contract):
+    """Return the hex SHA-1 digest of a contract's text."""
+    if isinstance(raw_contract, unicode):
+        raw_contract = raw_contract.encode('utf-8')
+    return hashlib.sha1(raw_contract).hexdigest()
+
+
+class ContractCache(object):
+    """
+    LRU cache of parsed contracts.
+
+    Its memory is bounded by the total length of the contract texts
+    whose parsed values it holds, which the parsed values do not exceed
+    by much. Cached values are shared between callers and must be
+    treated as read-only.
+    """
+
+    def __init__(self, max_bytes=constants.CONTRACT_CACHE_MAX_BYTES):
+        """
+        @param max_bytes: Total length of the cached contracts above
+                          which the least recently used are evicted.
+        @type max_bytes: int
+        """
+        self.max_bytes = max_bytes
+        # key -> (value, size), least recently used first.
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the value cached for key, or None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        """
+        Cache value under key, evicting the least recently used values
+        beyond the memory bound.
+
+        @param size: The length of the contract value was parsed from.
+        @type size: int
+        """
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._entries[key] = (value, size)
+            self._size += size
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+
+    def parse(self, raw_contract, parser, *args):
+        """
+        Return parser(raw_contract, *args), computing it only if it is
+        not cached yet. Parse errors propagate and are not cached.
+
+        Values are cached per parser, since one cache is shared by the
+        market, the orders and the web socket handler.
+        """
+        key = (contract_digest(raw_contract), parser) + args
+        value = self.get(key)
+        if value is None:
+            value = parser(raw_contract, *args)
+            self.put(key, value, len(raw_contract))
+        return value
@@ -1,7 +1,12 @@
 import UserDict
+import collections
 import logging
 import ast
+import threading
 from abc import ABCMeta, abstractmethod
+from sqlite3 import dbapi2
+
+from node import constants
 
 
 class DataStore(UserDict.DictMixin, object):
@@ -21,6 +26,26 @@ class DataStore(UserDict.DictMixin, object):
         """ Return a list of the keys in this data store """
         pass
 
+    @abstractmethod
+    def get_entry(self, key):
+        """ Get the value and all the metadata of the C{(key, value)} pair
+        identified by C{key} at once
+
+        @return: A dict with the keys 'value', 'lastPublished',
+        'originallyPublished' and 'originalPublisherID', or None if
+        C{key} is not stored.
+        """
+        pass
+
+    @abstractmethod
+    def get_metadata(self):
+        """ Get the metadata of all the stored C{(key, value)} pairs
+
+        @return: A list of C{(key, last_published, originally_published,
+        original_publisher_id)} tuples.
+        """
+        pass
+
     @abstractmethod
     def get_last_published(self, key):
         """ Get the time the C{(key, value)} pair identified by C{key}
@@ -71,6 +96,10 @@ class DataStore(UserDict.DictMixin, object):
         """
         self.set_item(key, *value)
 
+    def flush(self):
+        """ Write any buffered changes to the physical storage """
+        pass
+
 
 class SqliteDataStore(DataStore):
     """Sqlite database-based datastore."""
@@ -79,16 +108,50 @@ class SqliteDataStore(DataStore):
         self.db_connection = db_connection
         self.log = logging.getLogger(self.__class__.__name__)
 
+    def __iter__(self):
+        """ Stream the keys in this data store """
+        for row in self.db_connection.iter_entries(
+                "datastore", select_fields="key"):
+            yield row['key'].decode('hex')
+
     def keys(self):
         """ Return a list of the keys in this data store """
-        keys = []
         try:
-            db_keys = self.db_connection.select_entries("datastore")
-            for row in db_keys:
-                keys.append(row['key'].decode('hex'))
+            return list(self)
         except Exception:
-            pass
-        return keys
+            return []
+
+    def _get_row(self, key):
+        """ Return the datastore row of C{key} as a dict, or None """
+        rows = self.db_connection.select_entries("datastore", {"key": key})
+        if len(rows) == 0:
+            return None
+        return rows[0]
+
+    def get_entry(self, key):
+        row = self._get_row(key)
+        if row is None:
+            return None
+
+        return {
+            'value': self._parse_value(row['value']),
+            'lastPublished': int(row['lastPublished']),
+            'originallyPublished': int(row['originallyPublished']),
+            'originalPublisherID': row['originalPublisherID']
+        }
+
+    def get_metadata(self):
+        rows = self.db_connection.iter_entries(
+            "datastore",
+            select_fields=[
+                'key', 'lastPublished', 'originallyPublished',
+                'originalPublisherID'
+            ]
+        )
+        return [
+            (key, int(last_published), int(originally_published), publisher_id)
+            for key, last_published, originally_published, publisher_id in rows
+        ]
 
     def get_last_published(self, key):
         """ Get the time the C{(key, value)} pair identified by C{key}
@@ -114,12 +177,12 @@ class SqliteDataStore(DataStore):
     def set_item(self, key, value, last_published, originally_published,
                  original_publisher_id, market_id=1):
 
-        rows = self.db_connection.select_entries(
+        exists = self.db_connection.exists(
             "datastore",
             {"key": key,
              "market_id": market_id}
         )
-        if len(rows) == 0:
+        if not exists:
             self.db_connection.insert_entry(
                 "datastore",
                 {
@@ -150,18 +213,160 @@ class SqliteDataStore(DataStore):
 
     def _db_query(self, key, column_name):
 
-        row = self.db_connection.select_entries("datastore", {"key": key})
+        row = self._get_row(key)
 
-        if len(row) != 0:
-            value = row[0][column_name]
-            try:
-                value = ast.literal_eval(value)
-            except Exception:
-                pass
-            return value
+        if row is not None:
+            return self._parse_value(row[column_name])
+
+    @staticmethod
+    def _parse_value(value):
+        try:
+            value = ast.literal_eval(value)
+        except Exception:
+            pass
+        return value
 
     def __getitem__(self, key):
         return self._db_query(key, 'value')
 
     def __delitem__(self, key):
         self.db_connection.delete_entries("datastore", {"key": key.encode("hex")})
+
+
+class BulkSqliteDataStore(SqliteDataStore):
+    """
+    Sqlite database-based datastore which keeps a persistent connection
+    of its own and batches its writes.
+
+    Stores are buffered and written in a single transaction, upserting
+    on the unique (key, market_id) index, once `flush_interval` seconds
+    have passed since the first buffered store or as soon as
+    `batch_size` stores are buffered. Reads see buffered stores.
+    Without an `io_loop` every store is written at once.
+
+    Given a `market_id`, reads only see the rows of that market.
+    """
+
+    _COLUMNS = (
+        'key', 'value', 'lastPublished', 'originallyPublished',
+        'originalPublisherID', 'market_id'
+    )
+
+    def __init__(self, db_connection, io_loop=None, market_id=None,
+                 flush_interval=constants.DATASTORE_FLUSH_INTERVAL,
+                 batch_size=constants.DATASTORE_BATCH_SIZE):
+        super(BulkSqliteDataStore, self).__init__(db_connection)
+        self.io_loop = io_loop
+        self.market_id = market_id
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+        self._con = None
+        self._lock = threading.RLock()
+        # (key, market_id) -> row tuple, in the order of _COLUMNS
+        self._pending = collections.OrderedDict()
+        self._flush_timeout = None
+
+    def _get_connection(self):
+        if self._con is None:
+            con = dbapi2.connect(
+                self.db_connection.db_path, timeout=10, check_same_thread=False
+            )
+            if not self.db_connection.disable_sqlite_crypt:
+                con.execute("PRAGMA key = '%s';" % constants.DB_PASSPHRASE)
+            self._con = con
+        return self._con
+
+    def _select(self, query, params=()):
+        with self._lock:
+            return self._get_connection().execute(query, params).fetchall()
+
+    def _get_row(self, key):
+        with self._lock:
+            for (pending_key, market_id), row in reversed(self._pending.items()):
+                if pending_key == key and self.market_id in (None, market_id):
+                    return dict(zip(self._COLUMNS, row))
+
+            query = "SELECT %s FROM datastore WHERE key = ?" % (
+                ', '.join(self._COLUMNS)
+            )
+            params = (key,)
+            if self.market_id is not None:
+                query += " AND market_id = ?"
+                params += (self.market_id,)
+            rows = self._select(query + " ORDER BY id LIMIT 1", params)
+        if len(rows) == 0:
+            return None
+        return dict(zip(self._COLUMNS, rows[0]))
+
+    def __iter__(self):
+        self.flush()
+        return super(BulkSqliteDataStore, self).__iter__()
+
+    def get_metadata(self):
+        self.flush()
+        return super(BulkSqliteDataStore, self).get_metadata()
+
+    def set_item(self, key, value, last_published, originally_published,
+                 original_publisher_id, market_id=1):
+        row = tuple(
+            unicode(field) for field in (
+                key, value, last_published, originally_published,
+                original_publisher_id, market_id
+            )
+        )
+        with self._lock:
+            # Re-inserted so that the buffer stays in store order.
+            self._pending.pop((key, market_id), None)
+            self._pending[(key, market_id)] = row
+
+            if self.io_loop is None or len(self._pending) >= self.batch_size:
+                self.flush()
+            elif self._flush_timeout is None:
+                self._flush_timeout = self.io_loop.call_later(
+                    self.flush_interval, self.flush
+                )
+
+    def flush(self):
+        """ Write the buffered stores in a single transaction """
+        with self._lock:
+            if self._flush_timeout is not None:
+                self.io_loop.remove_timeout(self._flush_timeout)
+                self._flush_timeout = None
+            if not self._pending:
+                return
+
+            rows = self._pending.values()
+            try:
+                with self._get_connection() as con:
+                    con.executemany(
+                        "INSERT OR REPLACE INTO datastore(%s) VALUES(%s)" % (
+                            ', '.join(self._COLUMNS),
+                            ', '.join('?' * len(self._COLUMNS))
+                        ),
+                        rows
+                    )
+            except dbapi2.Error as exc:
+                # Kept buffered, to be written with the next flush.
+                self.log.error(
+                    'Could not write %d datastore entries: %s', len(rows), exc
+                )
+                return
+            self._pending.clear()
+
+    def close(self):
+        """ Flush the buffered stores and close the connection """
+        with self._lock:
+            self.flush()
+            if self._con is not None:
+                self._con.close()
+                self._con = None
+
+    def __delitem__(self, key):
+        key = key.encode("hex")
+        with self._lock:
+            for pending_key in self._pending.keys():
+                if pending_key[0] == key:
+                    del self._pending[pending_key]
+            with self._get_connection() as con:
+                con.execute("DELETE FROM datastore WHERE key = ?", (key,))
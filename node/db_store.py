@@ -1,6 +1,9 @@
+import Queue
+import contextlib
 import functools
 import logging
 import threading
+import time
 
 from node import constants
 from sqlite3 import dbapi2
@@ -10,41 +13,124 @@ class Obdb(object):
     """
     API for DB storage. Serves as segregation of the persistence
     layer and the application logic.
+
+    Connections are long-lived: writes go through a single writer
+    connection, one at a time, while reads are served concurrently by
+    a pool of up to `pool_size` reader connections. The database is
+    switched to WAL journaling so that readers don't block the writer
+    and vice versa.
     """
-    def __init__(self, db_path, disable_sqlite_crypt=False):
+    def __init__(self, db_path, disable_sqlite_crypt=False,
+                 pool_size=constants.DB_READER_POOL_SIZE):
         self.db_path = db_path
-        self.con = None
         self.disable_sqlite_crypt = disable_sqlite_crypt
+        self.pool_size = pool_size
 
         self._log = logging.getLogger('DB')
+        # Serializes writes.
         self._lock = threading.Lock()
+        self._writer = None
+        # Guards the accounting of the reader pool.
+        self._pool_lock = threading.Lock()
+        self._readers = Queue.Queue()
+        self._reader_count = 0
+        # Connections opened when all the readers were busy.
+        self._temporary_readers = set()
+        # The connection used by the current thread's operation.
+        self._local = threading.local()
+        # Slow queries whose plan has already been logged.
+        self._advised_queries = set()
 
         dbapi2.register_adapter(bool, int)
         dbapi2.register_converter("bool", lambda v: bool(int(v)))
 
-    def _login(self, passphrase=constants.DB_PASSPHRASE):
+    @property
+    def con(self):
+        """The connection of the operation running in this thread."""
+        return getattr(self._local, 'con', None)
+
+    def _login(self, con, passphrase=constants.DB_PASSPHRASE):
         """Enable access to an encrypted database."""
-        cursor = self.con.cursor()
+        cursor = con.cursor()
         cursor.execute("PRAGMA key = '%s';" % passphrase)
 
     def _make_db_connection(self):
-        """Create and return a DB connection."""
-        return dbapi2.connect(
+        """Create, authenticate and tune a long-lived DB connection."""
+        con = dbapi2.connect(
             self.db_path,
             detect_types=dbapi2.PARSE_DECLTYPES,
-            timeout=10
+            timeout=10,
+            check_same_thread=False
         )
+        con.row_factory = self._dict_factory
+        if not self.disable_sqlite_crypt:
+            self._login(con)
+
+        cursor = con.cursor()
+        cursor.execute("PRAGMA journal_mode = WAL")
+        # In WAL mode NORMAL is safe from corruption and only syncs
+        # on checkpoints.
+        cursor.execute("PRAGMA synchronous = NORMAL")
+        cursor.execute("PRAGMA cache_size = -%d" % constants.DB_CACHE_SIZE)
+        return con
+
+    def _get_reader(self):
+        try:
+            return self._readers.get_nowait()
+        except Queue.Empty:
+            pass
+
+        with self._pool_lock:
+            create = self._reader_count < self.pool_size
+            if create:
+                self._reader_count += 1
+        if create:
+            return self._make_db_connection()
+        try:
+            return self._readers.get(timeout=constants.DB_READER_TIMEOUT)
+        except Queue.Empty:
+            # Readers are all held, e.g. by iterators not yet closed:
+            # rather than wait for them forever, read on a connection
+            # which _put_reader() closes once done with.
+            self._log.warning('All %d reader connections are busy',
+                              self.pool_size)
+            con = self._make_db_connection()
+            with self._pool_lock:
+                self._temporary_readers.add(con)
+            return con
+
+    def _put_reader(self, con):
+        with self._pool_lock:
+            temporary = con in self._temporary_readers
+            self._temporary_readers.discard(con)
+        if temporary:
+            con.close()
+        else:
+            self._readers.put(con)
 
+    def close(self):
+        """Close all the connections; they are reopened on demand."""
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        with self._pool_lock:
+            while True:
+                try:
+                    self._readers.get_nowait().close()
+                except Queue.Empty:
+                    break
+                self._reader_count -= 1
 
     # pylint: disable=no-self-argument
     # pylint: disable=not-callable
     def _managedmethod(func):
         """
         Decorator for abstracting the setting up and tearing down of a
-        DB operation. It handles:
-            * Syncrhonizing multiple DB accesses.
-            * Opening and closing DB connections.
-            * Authenitcating the user if the database is encrypted.
+        DB write operation. It handles:
+            * Synchronizing multiple DB writes.
+            * Reusing the writer DB connection.
+            * Committing, or rolling back on error.
 
         A function wrapped by this decorator may use the database
         connection (via self.con) in order to operate on the DB
@@ -52,18 +138,114 @@ class Obdb(object):
         """
         @functools.wraps(func)
         def managed_func(self, *args, **kwargs):
-            with self._lock, self._make_db_connection() as self.con:
-                self.con.row_factory = self._dict_factory
-                if not self.disable_sqlite_crypt:
-                    self._login()
+            if self._in_transaction():
+                # Part of the enclosing transaction; committed with it.
+                return func(self, *args, **kwargs)
 
-                ret_val = func(self, *args, **kwargs)
-
-                self.con.commit()
-                return ret_val
+            with self.transaction():
+                return func(self, *args, **kwargs)
 
         return managed_func
 
+    def _readmethod(func):
+        """
+        Like _managedmethod, for read-only operations: the function is
+        run on a pooled reader connection, concurrently with other
+        reads and with writes.
+        """
+        @functools.wraps(func)
+        def read_func(self, *args, **kwargs):
+            if self._in_transaction():
+                # Read from the writer, to see the pending changes.
+                return func(self, *args, **kwargs)
+
+            con = self._get_reader()
+            self._local.con = con
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                self._local.con = None
+                self._put_reader(con)
+
+        return read_func
+
+    def _in_transaction(self):
+        return getattr(self._local, 'in_transaction', False)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Context manager grouping all the DB operations made by this
+        thread inside the block into a single transaction, committed
+        when the block ends or rolled back if it raises:
+
+            with db.transaction():
+                db.update_entries(...)
+                db.insert_entry(...)
+
+        Other threads' writes wait until the transaction is over, so
+        keep slow work out of the block. Nested transactions are part
+        of the outermost one.
+        """
+        if self._in_transaction():
+            yield
+            return
+
+        with self._lock:
+            if self._writer is None:
+                self._writer = self._make_db_connection()
+            self._local.con = self._writer
+            self._local.in_transaction = True
+            try:
+                with self._writer:
+                    yield
+            finally:
+                self._local.in_transaction = False
+                self._local.con = None
+
+    def _execute(self, cur, query, params):
+        """
+        Execute the query on the cursor; if it turns out to be slow,
+        log its query plan so that missing indexes can be spotted.
+        """
+        start = time.time()
+        cur.execute(query, params)
+        elapsed = time.time() - start
+        if elapsed >= constants.DB_SLOW_QUERY_THRESHOLD:
+            self._advise(cur.connection, query, params, elapsed)
+
+    def _executemany(self, cur, query, params_list):
+        """
+        Like _execute, for a statement executed once per parameters in
+        `params_list`; the plan is that of the first ones.
+        """
+        start = time.time()
+        cur.executemany(query, params_list)
+        elapsed = time.time() - start
+        if elapsed >= constants.DB_SLOW_QUERY_THRESHOLD:
+            self._advise(cur.connection, query, params_list[0], elapsed)
+
+    def _advise(self, con, query, params, elapsed):
+        """Index advisor: log the plan of a slow query, once per query."""
+        if query in self._advised_queries:
+            self._log.debug('Slow query (%.3fs): %s', elapsed, query)
+            return
+        self._advised_queries.add(query)
+
+        cur = con.cursor()
+        cur.row_factory = self._dict_factory
+        plan = cur.execute("EXPLAIN QUERY PLAN " + query, params).fetchall()
+        details = [step['detail'] for step in plan]
+        scans = [
+            detail for detail in details
+            if detail.startswith('SCAN') and 'USING' not in detail
+        ]
+        self._log.warning(
+            'Slow query (%.3fs): %s\nQuery plan:\n  %s%s',
+            elapsed, query, '\n  '.join(details),
+            '\nFull table scans; consider adding an index.' if scans else ''
+        )
+
     @staticmethod
     def _dict_factory(cursor, row):
         """
@@ -139,7 +321,7 @@ class Obdb(object):
             table, set_part, where_part
         )
         self._log.debug('query: %s', query)
-        cur.execute(query, tuple(sets + wheres))
+        self._execute(cur, query, tuple(sets + wheres))
 
     @_managedmethod
     def insert_entry(self, table, update_dict):
@@ -167,27 +349,44 @@ class Obdb(object):
             table, updatefield_part, setfield_part
         )
         self._log.debug("query: %s", query)
-        cur.execute(query, tuple(sets))
+        self._execute(cur, query, tuple(sets))
         lastrowid = cur.lastrowid
 
         if lastrowid:
             return lastrowid
 
     @_managedmethod
-    def select_entries(self, table, where_dict=None, operator="AND", order_field="id",
-                       order="ASC", limit=None, limit_offset=None, select_fields="*"):
+    def insert_many(self, table, rows):
         """
-        A wrapper for the SQL SELECT operation. It will always return
-        all the attributes for the selected rows.
+        Insert many rows at once, with a single prepared statement.
 
-        @param table: The table to search
-        @param where_dict: A dictionary with the WHERE clauses. If ommited,
-                           it will return all the rows of the table.
+        @param table: The table to insert into
+        @param rows: A list of dictionaries with the values to set; they
+                     must all set the same columns.
+        """
+        if not rows:
+            return
+
+        cur = self.con.cursor()
+        fields = [self._before_storing(key) for key in rows[0]]
+        query = "INSERT INTO %s(%s) VALUES(%s)" % (
+            table, ",".join(fields), ",".join("?" * len(fields))
+        )
+        self._log.debug("query: %s (%d rows)", query, len(rows))
+        self._executemany(cur, query, [
+            tuple(self._before_storing(row[key]) for key in rows[0])
+            for row in rows
+        ])
+
+    def _where_clause(self, where_dict, operator):
+        """
+        Build the WHERE clause for `where_dict`.
+
+        @return: The clause and the tuple of its parameters.
         """
         if where_dict is None:
             where_dict = {'"1"': '1'}
 
-        cur = self.con.cursor()
         wheres = []
         where_part = []
         for key, value in where_dict.iteritems():
@@ -199,22 +398,130 @@ class Obdb(object):
             value = self._before_storing(value)
             wheres.append(value)
             where_part.append("%s %s ?" % (key, sign))
-            if limit is not None and limit_offset is None:
-                limit_clause = "LIMIT %s" % limit
-            elif limit is not None and limit_offset is not None:
-                limit_clause = "LIMIT %s, %s" % (limit_offset, limit)
-            else:
-                limit_clause = ""
         operator = " " + operator + " "
-        where_part = operator.join(where_part)
-        query = "SELECT * FROM %s WHERE %s ORDER BY %s %s %s" % (
-            table, where_part, order_field, order, limit_clause
+        return operator.join(where_part), tuple(wheres)
+
+    def _select_query(self, table, where_dict, operator, order_field, order,
+                      limit, limit_offset, select_fields):
+        """
+        Build a SELECT query.
+
+        @return: The query and the tuple of its parameters.
+        """
+        where_part, wheres = self._where_clause(where_dict, operator)
+
+        if limit is not None and limit_offset is None:
+            limit_clause = "LIMIT %s" % limit
+        elif limit is not None and limit_offset is not None:
+            limit_clause = "LIMIT %s, %s" % (limit_offset, limit)
+        else:
+            limit_clause = ""
+
+        if isinstance(select_fields, basestring):
+            select_fields = [select_fields]
+        select_part = ", ".join(
+            self._before_storing(field) for field in select_fields
+        )
+
+        query = "SELECT %s FROM %s WHERE %s ORDER BY %s %s %s" % (
+            select_part, table, where_part, order_field, order, limit_clause
         )
         self._log.debug("query: %s", query)
-        cur.execute(query, tuple(wheres))
+        return query, wheres
+
+    @_readmethod
+    def select_entries(self, table, where_dict=None, operator="AND", order_field="id",
+                       order="ASC", limit=None, limit_offset=None, select_fields="*"):
+        """
+        A wrapper for the SQL SELECT operation.
+
+        @param table: The table to search
+        @param where_dict: A dictionary with the WHERE clauses. If ommited,
+                           it will return all the rows of the table.
+        @param select_fields: The name of the column to return, or a list
+                              of them. By default all the columns are
+                              returned.
+        """
+        cur = self.con.cursor()
+        query, wheres = self._select_query(
+            table, where_dict, operator, order_field, order,
+            limit, limit_offset, select_fields
+        )
+        self._execute(cur, query, wheres)
         rows = cur.fetchall()
         return rows
 
+    def iter_entries(self, table, where_dict=None, operator="AND", order_field="id",
+                     order="ASC", limit=None, limit_offset=None, select_fields="*",
+                     chunk_size=constants.DB_ITER_CHUNK_SIZE):
+        """
+        Like select_entries, but stream the rows instead of loading them
+        all in memory. Rows are fetched `chunk_size` at a time, and are
+        sqlite3.Row objects: they are indexed by column name (or
+        position) and NULL values are None rather than "".
+
+        A reader connection is held until the generator is exhausted
+        or closed, so avoid slow work, such as network calls, while
+        iterating; use select_entries for that.
+        """
+        query, wheres = self._select_query(
+            table, where_dict, operator, order_field, order,
+            limit, limit_offset, select_fields
+        )
+        in_transaction = self._in_transaction()
+        con = self.con if in_transaction else self._get_reader()
+        try:
+            cur = con.cursor()
+            cur.row_factory = dbapi2.Row
+            self._execute(cur, query, wheres)
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+            cur.close()
+        finally:
+            if not in_transaction:
+                self._put_reader(con)
+
+    @_readmethod
+    def count_entries(self, table, where_dict=None, operator="AND"):
+        """
+        A wrapper for SQL SELECT COUNT(*).
+
+        @param table: The table to search
+        @param where_dict: A dictionary with the WHERE clauses. If ommited,
+                           all the rows of the table are counted.
+        @return: The number of matching rows.
+        """
+        cur = self.con.cursor()
+        where_part, wheres = self._where_clause(where_dict, operator)
+        query = "SELECT COUNT(*) AS count FROM %s WHERE %s" % (
+            table, where_part
+        )
+        self._log.debug("query: %s", query)
+        self._execute(cur, query, wheres)
+        return cur.fetchone()['count']
+
+    @_readmethod
+    def exists(self, table, where_dict=None, operator="AND"):
+        """
+        Check whether any row matches, without reading it.
+
+        @param table: The table to search
+        @param where_dict: A dictionary with the WHERE clauses.
+        @return: True if at least one row matches.
+        """
+        cur = self.con.cursor()
+        where_part, wheres = self._where_clause(where_dict, operator)
+        query = "SELECT 1 AS found FROM %s WHERE %s LIMIT 1" % (
+            table, where_part
+        )
+        self._log.debug("query: %s", query)
+        self._execute(cur, query, wheres)
+        return cur.fetchone() is not None
+
     @_managedmethod
     def delete_entries(self, table, where_dict=None, operator="AND"):
         """
@@ -244,4 +551,4 @@ class Obdb(object):
             table, where_part
         )
         self._log.debug('Query: %s', query)
-        cur.execute(query, dels)
+        self._execute(cur, query, tuple(dels))
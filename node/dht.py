@@ -1,3 +1,4 @@
+import collections
 import hashlib
 import json
 import logging
@@ -8,6 +9,54 @@ from threading import RLock
 
 from node import constants, datastore, routingtable
 from node.protocol import proto_store
+from node.refresher import RoutingTableRefresher
+from node.republisher import RepublishScheduler
+
+
+class MeteredRLock(object):
+    """
+    A reentrant lock which keeps track of how long its users had to
+    wait in order to acquire it.
+    """
+    def __init__(self, name):
+        self.name = name
+        self._lock = RLock()
+        self.acquisitions = 0
+        self.contentions = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def acquire(self):
+        # Fast path: the lock is free (or already ours).
+        if not self._lock.acquire(False):
+            start = time.time()
+            self._lock.acquire()
+            waited = time.time() - start
+            self.contentions += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+        self.acquisitions += 1
+        return True
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def get_stats(self):
+        """Return the contention metrics of this lock as a dict."""
+        return {
+            'name': self.name,
+            'acquisitions': self.acquisitions,
+            'contentions': self.contentions,
+            'wait_time': self.wait_time,
+            'max_wait_time': self.max_wait_time
+        }
+
 
 class DHT(object):
     def __init__(self, transport, market_id, settings, db_connection):
@@ -25,25 +74,60 @@ class DHT(object):
         # Routing table
         self.routing_table = routingtable.OptimizedTreeRoutingTable(
             self.settings['guid'], market_id)
-        self.data_store = datastore.SqliteDataStore(db_connection)
-
-        self._lock = RLock()
+        self.data_store = datastore.BulkSqliteDataStore(
+            db_connection, io_loop=transport.loop, market_id=market_id
+        )
+        self.republisher = RepublishScheduler(self, market_id)
+        self.refresher = RoutingTableRefresher(self, market_id)
+
+        # Recent close_nodes() results, keyed by (key, excluded guid);
+        # dropped whenever the routing table version changes.
+        self._close_nodes_cache = collections.OrderedDict()
+        self._close_nodes_cache_version = None
+
+        # The DHT state is split in independently locked parts, so that
+        # e.g. answering a findNode is not held up by a slow datastore
+        # write. When more than one lock is needed they must be acquired
+        # in this order: searches, datastore, peers.
+        # Guards active_peers, known_nodes and the routing table.
+        self._peers_lock = MeteredRLock('peers')
+        # Guards searches and the state of each DHTSearch.
+        self._searches_lock = MeteredRLock('searches')
+        # Guards read-modify-write cycles of datastore entries (indexes).
+        # Plain datastore I/O needs no lock; Obdb synchronizes itself.
+        self._datastore_lock = MeteredRLock('datastore')
+
+        # Keys stored on all the active peers, see replicate_widely()
+        self.wide_replication_keys = set()
 
     # pylint: disable=no-self-argument
     # pylint: disable=not-callable
-    def _synchronized(func):
-        """Decorator for synchronizing access to DHT attributes."""
-        @functools.wraps(func)
-        def synced_f(self, *args, **kwargs):
-            with self._lock:
-                return func(self, *args, **kwargs)
-        return synced_f
-
-    @_synchronized
+    def _synchronized(lock_name):
+        """
+        Decorator for synchronizing access to the DHT attributes guarded
+        by the lock with the given attribute name.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def synced_f(self, *args, **kwargs):
+                with getattr(self, lock_name):
+                    return func(self, *args, **kwargs)
+            return synced_f
+        return decorator
+
+    def get_lock_stats(self):
+        """Return the contention metrics of the DHT locks."""
+        return [
+            lock.get_stats()
+            for lock in (
+                self._peers_lock, self._searches_lock, self._datastore_lock
+            )
+        ]
+
+    @_synchronized('_peers_lock')
     def get_active_peers(self):
         return self.active_peers
 
-    @_synchronized
     def start(self, seed_peer):
         """ This method executes only when the server is starting up for the
             first time and add the seed peer(s) to known node list and
@@ -65,6 +149,7 @@ class DHT(object):
         self.iterative_find(self.settings['guid'], self.known_nodes,
                             'findNode')
 
+    @_synchronized('_peers_lock')
     def remove_peer(self, guid):
         if guid[:4] != 'seed':
             for i, active_peer in enumerate(self.active_peers):
@@ -80,7 +165,7 @@ class DHT(object):
             if self.transport.handler:
                 self.transport.handler.refresh_peers()
 
-    @_synchronized
+    @_synchronized('_peers_lock')
     def add_peer(self, hostname, port, pubkey=None, guid=None, nickname=None, nat_type=None, avatar_url=None):
         """ This takes a tuple (pubkey, hostname, port, guid) and adds it to the active
         peers list if it doesn't already reside there.
@@ -110,10 +195,16 @@ class DHT(object):
                     peer.init_packetsender()
                     peer.setup_emitters()
                     self.routing_table.add_contact(peer)
+                    # Re-adding the same contact is not a change.
+                    self.routing_table.update_contact(peer)
 
                     if self.transport.handler:
                         self.transport.handler.refresh_peers()
 
+                if (nickname, pubkey) != (peer.nickname, peer.pub) or \
+                        (avatar_url and avatar_url != peer.avatar_url):
+                    self.routing_table.update_contact(peer)
+
                 peer.nickname = nickname
                 if avatar_url:
                     peer.avatar_url = avatar_url
@@ -158,7 +249,7 @@ class DHT(object):
             self.log.error('Could not create a new peer.')
             return None
 
-    @_synchronized
+    @_synchronized('_peers_lock')
     def _add_known_node(self, node):
         """ Accept a peer tuple and add it to known nodes list
         :param node: (tuple)
@@ -168,7 +259,6 @@ class DHT(object):
         if node not in self.known_nodes and node[1] is not None:
             self.known_nodes.append(node)
 
-    @_synchronized
     def on_find_node(self, msg):
         """ When a findNode message is received it will be of several types:
         - findValue: Looking for a specific key-value
@@ -237,14 +327,33 @@ class DHT(object):
                 response_msg['foundNodes'] = close_nodes
                 querying_peer.send(response_msg)
 
-    @_synchronized
+    @_synchronized('_peers_lock')
     def close_nodes(self, key, guid=None):
+        """
+        Return the foundNodes payload for a findNode on `key`: the
+        recently reached contacts closest to it, excluding `guid`.
+
+        Results are cached until the routing table changes, or for
+        CLOSE_NODES_CACHE_TTL seconds since they also depend on when
+        each contact was last reached.
+        """
+        if self._close_nodes_cache_version != self.routing_table.version:
+            self._close_nodes_cache.clear()
+            self._close_nodes_cache_version = self.routing_table.version
+
+        now = time.time()
+        cache_key = (key, guid)
+        cached = self._close_nodes_cache.pop(cache_key, None)
+        if cached is not None and now - cached[0] < constants.CLOSE_NODES_CACHE_TTL:
+            # Reinsert as the most recently used entry.
+            self._close_nodes_cache[cache_key] = cached
+            return list(cached[1])
+
         contacts = self.routing_table.find_close_nodes(key, constants.K, guid)
         contact_list = []
+        stale_contact_time = now - constants.CLOSE_NODE_TIMELIMIT_IN_SECONDS
         for contact in contacts:
 
-            stale_contact_time = time.time() - constants.CLOSE_NODE_TIMELIMIT_IN_SECONDS
-
             if contact.last_reached > stale_contact_time:
 
                 contact.avatar_url = contact.avatar_url if contact.avatar_url else None
@@ -261,16 +370,21 @@ class DHT(object):
 
         close_nodes = self.dedupe(contact_list)
 
-        return close_nodes
+        self._close_nodes_cache[cache_key] = (now, close_nodes)
+        if len(self._close_nodes_cache) > constants.CLOSE_NODES_CACHE_SIZE:
+            self._close_nodes_cache.popitem(last=False)
+
+        return list(close_nodes)
 
-    @_synchronized
+    @_synchronized('_searches_lock')
     def on_find_node_response(self, msg):
 
         # Update existing peer's pubkey if active peer
-        for idx, peer in enumerate(self.active_peers):
-            if peer.guid == msg['senderGUID']:
-                peer.nickname = msg['senderNick']
-                peer.pub = msg['pubkey']
+        with self._peers_lock:
+            for peer in self.active_peers:
+                if peer.guid == msg['senderGUID']:
+                    peer.nickname = msg['senderNick']
+                    peer.pub = msg['pubkey']
 
         # If key was found by this node then
         if 'foundKey' in msg.keys():
@@ -375,83 +489,22 @@ class DHT(object):
                         if search.callback is not None:
                             search.callback(search.shortlist)
 
-    @_synchronized
     def _refresh_node(self):
-        """ Periodically called to perform k-bucket refreshes and data
-        replication/republishing as necessary """
+        """ Periodically called to perform k-bucket refreshes as necessary.
+        Data replication/republishing is left to self.republisher """
         self._refresh_routing_table()
-        self._republish_data()
 
-        if self.transport.handler:
-            self.transport.handler.send_to_client(None, {"type": "republish_notify",
-                                                         "msg": "P2P Data Republished"})
+        for stats in self.get_lock_stats():
+            self.log.debug(
+                'Lock %(name)s: %(contentions)d/%(acquisitions)d contended, '
+                'waited %(wait_time).3fs (max %(max_wait_time).3fs)', stats
+            )
 
-    @_synchronized
     def _refresh_routing_table(self):
         self.log.info('Started Refreshing Routing Table')
+        self.refresher.refresh()
 
-        # Get Random ID from every KBucket
-        node_ids = self.routing_table.get_refresh_list(0, False)
-
-        def search_for_next_node_id():
-            if len(node_ids) > 0:
-                search_id = node_ids.pop()
-                self.iterative_find_node(search_id)
-                search_for_next_node_id()
-            else:
-                # If this is reached, we have finished refreshing the routing table
-                return
-
-        # Start the refreshing cycle
-        search_for_next_node_id()
-
-    @_synchronized
-    def _republish_data(self, *args):
-        self._threaded_republish_data()
-
-    @_synchronized
-    def _threaded_republish_data(self, *args):
-        """ Republishes and expires any stored data (i.e. stored
-        C{(key, value pairs)} that need to be republished/expired
-
-        This method should run in a deferred thread
-        """
-        self.log.debug('Republishing Data')
-        expired_keys = []
-
-        for key in self.data_store.keys():
-
-            # Filter internal variables stored in the data store
-            if key == 'nodeState':
-                continue
-
-            now = int(time.time())
-            key = key.encode('hex')
-            original_publisher_id = self.data_store.get_original_publisher_id(key)
-            age = now - self.data_store.get_original_publish_time(key) + 500000
-
-            if original_publisher_id == self.settings['guid']:
-                # This node is the original publisher; it has to republish
-                # the data before it expires (24 hours in basic Kademlia)
-                if age >= constants.DATE_EXPIRE_TIMEOUT:
-                    self.iterative_store(key, self.data_store[key])
-
-            else:
-                # This node needs to replicate the data at set intervals,
-                # until it expires, without changing the metadata associated with it
-                # First, check if the data has expired
-                if age >= constants.DATE_EXPIRE_TIMEOUT:
-                    # This key/value pair has expired and has not been
-                    # republished by the original publishing node,
-                    # so remove it.
-                    expired_keys.append(key)
-                elif now - self.data_store.get_last_published(key) >= constants.REPLICATE_INTERVAL:
-                    self.iterative_store(key, self.data_store[key], original_publisher_id, age)
-
-        for key in expired_keys:
-            del self.data_store[key]
-
-    @_synchronized
+    @_synchronized('_searches_lock')
     def extend_shortlist(self, find_id, found_nodes):
 
         self.log.datadump('found_nodes: %s', found_nodes)
@@ -480,10 +533,11 @@ class DHT(object):
             if node_guid == self.settings['guid']:
                 continue
 
-            for peer in self.active_peers:
-                if node_guid == peer.guid:
-                    # Already an active peer or it's myself
-                    continue
+            with self._peers_lock:
+                for peer in self.active_peers:
+                    if node_guid == peer.guid:
+                        # Already an active peer or it's myself
+                        continue
 
             if node_guid != self.settings['guid']:
                 self.log.debug('Adding new peer to active peers list: %s', node)
@@ -491,25 +545,39 @@ class DHT(object):
 
         self.log.datadump('Short list after: %s', search.shortlist)
 
-    @_synchronized
-    def find_listings(self, key, listing_filter=None, callback=None):
+    def find_listings(self, key, listing_filter=None, callback=None, known=None,
+                      page=0, cursor=None, window=None):
         """
-        Send a get product listings call to the node in question and
-        then cache those listings locally.
-        TODO: Ideally we would want to send an array of listing IDs that
-        we have locally and then the node would send back the missing or
-        updated listings. This would save on queries for listings we
-        already have.
+        Send a get product listings call to the node in question.
+
+        @param known: The digests (node.store_listings.listing_digest) of
+                      the listings of the node we already have, which it
+                      then does not send again; None to get them all.
+        @type known: list
+        @param page: The page of listings to get, if no window is given.
+        @type page: int
+        @param cursor: The cursor of the last listing_sync message of the
+                       node, to get the window of listings after it.
+        @param window: The number of listings to stream; None to get a
+                       page of listings instead.
+        @type window: int
         """
 
         peer = self.routing_table.get_contact(key)
 
         if peer:
-            peer.send({
+            msg = {
                 'type': 'query_listings',
                 'key': key,
+                'page': page,
                 'v': constants.VERSION
-            })
+            }
+            if known is not None:
+                msg['known'] = known
+            if window is not None:
+                msg['cursor'] = cursor
+                msg['window'] = window
+            peer.send(msg)
         else:
             self.log.error('Peer is not available for listings.')
 
@@ -524,23 +592,69 @@ class DHT(object):
         #
         # self.iterative_find_value(listing_index_key, callback)
 
-    @_synchronized
-    def find_listings_by_keyword(self, keyword, listing_filter=None, callback=None):
-
+    @staticmethod
+    def keyword_index_key(keyword, shard=0):
+        """
+        Return the DHT key of a shard of the keyword index of `keyword`.
+        The first shard is stored under the key of the unsharded index.
+        """
+        keyword_key = 'keyword-%s' % keyword.upper()
+        if shard:
+            keyword_key = '%s-%d' % (keyword_key, shard)
         hashvalue = hashlib.new('ripemd160')
-        keyword_key = 'keyword-%s' % keyword
         hashvalue.update(keyword_key.encode('utf-8'))
-        listing_index_key = hashvalue.hexdigest()
+        return hashvalue.hexdigest()
+
+    @staticmethod
+    def keyword_index_shard(listing_key):
+        """Return the keyword index shard a listing is kept in."""
+        digest = hashlib.sha1(listing_key).hexdigest()
+        return int(digest, 16) % constants.KEYWORD_INDEX_SHARDS
 
+    def find_listings_by_keyword(self, keyword, listing_filter=None, callback=None, shard=None):
+        """
+        Look up the keyword index of `keyword`. The callback is called
+        once for each shard found, with a value of the form
+        {'listings': [...], 'shard': shard, 'shards': number of shards}.
+
+        @param shard: The shard to look up, to page through the index;
+                      all of them if None, including the overflow
+                      shards the shards found report.
+        @type shard: int
+        """
         self.log.info('Finding contracts for keyword: %s', keyword)
 
-        self.iterative_find_value(listing_index_key, callback)
+        if shard is not None:
+            self.iterative_find_value(
+                self.keyword_index_key(keyword, shard), callback
+            )
+            return
+
+        looked_up = set()
+
+        def look_up(shards):
+            for number in range(min(shards, constants.KEYWORD_INDEX_MAX_SHARDS)):
+                if number not in looked_up:
+                    looked_up.add(number)
+                    self.iterative_find_value(
+                        self.keyword_index_key(keyword, number), on_shard_found
+                    )
+
+        def on_shard_found(value):
+            if isinstance(value, dict) and isinstance(value.get('shards'), int):
+                look_up(value['shards'])
+            if callback is not None:
+                callback(value)
+
+        look_up(constants.KEYWORD_INDEX_SHARDS)
 
-    @_synchronized
     def iterative_store(self, key, value_to_store=None, original_publisher_id=None, age=0):
         """ The Kademlia store operation
 
-        Call this to store/republish data in the DHT.
+        Call this to store/republish data in the DHT. The data is stored
+        in this node and sent to the K nodes closest to the key found by
+        a node lookup, and also to all the active peers for the keys
+        registered with replicate_widely().
 
         @param key: The hashtable key of the data
         @type key: str
@@ -560,24 +674,135 @@ class DHT(object):
         if value_to_store:
             self.log.info('Storing key to DHT: %s', key)
             self.log.datadump('Value to store: %s', value_to_store)
-            self.iterative_find_node(
-                key,
-                lambda msg, findKey=key, value=value_to_store,
-                       original_publisher_id=original_publisher_id, age=age:
-                self.store_key_value(msg, findKey, value, original_publisher_id, age)
+
+            merged_value = self._merge_and_store(
+                key, value_to_store, original_publisher_id, age
             )
+            if merged_value is None:
+                return
+            # Other nodes merge index updates into their own copy of the
+            # index, so only the update itself is sent to them, unless
+            # they are too old to; see store_key_value().
+            if self._is_index_update(value_to_store):
+                full_value = merged_value
+            else:
+                value_to_store = merged_value
+                full_value = None
+
+            if key in self.wide_replication_keys:
+                with self._peers_lock:
+                    nodes_to_store = [
+                        (node.hostname, node.port, node.guid)
+                        for node in self.active_peers
+                    ]
+                self.store_key_value(
+                    nodes_to_store, key, value_to_store,
+                    original_publisher_id, age, full_value
+                )
+
+            # The search, once started. It may call back before
+            # iterative_find_node() returns it.
+            search = []
+            stored = []
+
+            def on_nodes_found(nodes):
+                # The search calls back again on late responses.
+                if stored:
+                    return
+                stored.append(True)
+                if search:
+                    self.cancel_search(search[0].find_id)
+                self.store_key_value(
+                    self.closest_nodes(key, nodes), key, value_to_store,
+                    original_publisher_id, age, full_value
+                )
 
-            nodes_to_store = []
-            for node in self.transport.dht.active_peers:
-                nodes_to_store.append((node.hostname, node.port, node.guid))
+            new_search = self.iterative_find_node(key, on_nodes_found)
+            if stored:
+                # Done already
+                self.cancel_search(new_search.find_id)
+            else:
+                search.append(new_search)
+
+    def replicate_widely(self, key):
+        """
+        Store `key` on all the active peers, besides the K nodes closest
+        to it, whenever this node stores it. This is for indexes that
+        every node reads, such as the notary index.
+        """
+        self.wide_replication_keys.add(key)
+
+    def closest_nodes(self, key, nodes, count=constants.K):
+        """
+        Return the `count` nodes of `nodes`, (hostname, port, guid, ...)
+        tuples, closest to `key`, leaving out this node.
+        """
+        key_value = int(key, 16)
+        candidates = {}
+        for node in nodes:
+            guid = node[2]
+            if guid == self.transport.guid or guid in candidates:
+                continue
+            try:
+                candidates[guid] = (int(guid, 16) ^ key_value, node)
+            except (TypeError, ValueError):
+                # e.g. seed nodes
+                continue
+        return [node for _, node in sorted(candidates.values())[:count]]
 
-            self.store_key_value(nodes_to_store, key, value_to_store, original_publisher_id, age)
+    def store_key_value(self, nodes, key, value, original_publisher_id, age,
+                        full_value=None):
+        """
+        Send a store of (key, value) to each of `nodes`.
 
-    @_synchronized
-    def store_key_value(self, nodes, key, value, original_publisher_id, age):
+        @param full_value: If `value` is an index update, the whole
+                           updated index, which is sent instead to the
+                           peers too old to merge updates: they would
+                           store the update as the index.
+        """
 
         self.log.datadump('Store Key Value: (%s, %s %s)', nodes, key, type(value))
 
+        for node in nodes:
+            self.log.debug('Sending data to store in DHT: %s', node)
+            #uri = network_util.get_peer_url(node[0], node[1])
+            guid = node[2]
+
+            if guid[:4] != 'seed':
+
+                peer = self.routing_table.get_contact(guid)
+
+                if guid == self.transport.guid:
+                    continue
+
+                if not peer:
+                    peer = self.transport.get_crypto_peer(guid, node[0], node[1])
+
+                if full_value is not None and not self.merges_index_updates(peer):
+                    peer.send(proto_store(key, full_value, original_publisher_id, age))
+                else:
+                    peer.send(proto_store(key, value, original_publisher_id, age))
+
+    @staticmethod
+    def merges_index_updates(peer):
+        """Whether a peer's protocol version merges index updates."""
+        try:
+            version = tuple(int(part) for part in peer.version.split('.'))
+        except (AttributeError, TypeError, ValueError):
+            # Not heard from yet
+            return False
+        return version >= constants.INDEX_UPDATE_MIN_VERSION
+
+    @_synchronized('_datastore_lock')
+    def _merge_and_store(self, key, value, original_publisher_id, age):
+        """
+        Merge index updates into the value already stored under `key`
+        and store the result in our own node.
+
+        @return: The value that was stored, or None if there was
+                 nothing to store.
+        """
+
         try:
 
             value_json = json.loads(value)
@@ -600,38 +825,36 @@ class DHT(object):
                         existing_index['notaries'].remove(value_json['notary_index_remove'])
                         value = existing_index
                     else:
-                        return
-                else:
-                    return
-
-            # Add listing to keyword index
-            if 'keyword_index_add' in value_json:
-                existing_index = self.data_store[key]
-
-                if existing_index is not None:
-                    if not value_json['keyword_index_add'] in existing_index['listings']:
-                        existing_index['listings'].append(value_json['keyword_index_add'])
-                    value = existing_index
-                else:
-                    value = {'listings': [value_json['keyword_index_add']]}
-
-                self.log.info('Keyword Index: %s', value)
-
-            if 'keyword_index_remove' in value_json:
-
-                existing_index = self.data_store[key]
-
-                if existing_index is not None:
-
-                    if value_json['keyword_index_remove'] in existing_index['listings']:
-                        existing_index['listings'].remove(value_json['keyword_index_remove'])
-                        value = existing_index
-                    else:
-                        return
-
+                        return None
                 else:
+                    return None
+
+            # Add listings to or remove them from a keyword index shard;
+            # either update is a listing or a list of listings.
+            if 'keyword_index_add' in value_json or 'keyword_index_remove' in value_json:
+                shard = value_json.get('shard', 0)
+                keyword = value_json.get('keyword')
+                if keyword is not None and self.keyword_index_key(keyword, shard) != key:
+                    self.log.warning('Keyword %r is not that of %s', keyword, key)
+                    keyword = None
+                value, overflow = self._update_keyword_shard(
+                    self.data_store[key],
+                    shard,
+                    add=self._as_listings(value_json.get('keyword_index_add')),
+                    remove=self._as_listings(value_json.get('keyword_index_remove')),
+                    keyword=keyword
+                )
+                if overflow is not None:
+                    # Stored once the datastore lock is released
+                    self.transport.loop.add_callback(
+                        self.iterative_store,
+                        self.keyword_index_key(overflow['keyword'], overflow['shard']),
+                        json.dumps(overflow)
+                    )
+                if value is None:
                     # Not in keyword index anyways
-                    return
+                    return None
+                self.log.info('Keyword Index: %s', value)
 
         except Exception as exc:
             self.log.debug('Value is not a JSON array: %s', exc)
@@ -640,28 +863,104 @@ class DHT(object):
         originally_published = now - age
 
         # Store it in your own node
-        self.data_store.set_item(
-            key, value, now, originally_published, original_publisher_id, market_id=self.market_id
-        )
-
-        for node in nodes:
-            self.log.debug('Sending data to store in DHT: %s', node)
-            #uri = network_util.get_peer_url(node[0], node[1])
-            guid = node[2]
-
-            if guid[:4] != 'seed':
-
-                peer = self.routing_table.get_contact(guid)
+        self._store_locally(key, value, originally_published, original_publisher_id)
+        return value
 
-                if guid == self.transport.guid:
-                    break
+    @staticmethod
+    def _is_index_update(value):
+        try:
+            value_json = json.loads(value)
+        except (TypeError, ValueError):
+            return False
+        return isinstance(value_json, dict) and any(
+            update in value_json for update in (
+                'notary_index_add', 'notary_index_remove',
+                'keyword_index_add', 'keyword_index_remove'
+            )
+        )
 
-                if not peer:
-                    peer = self.transport.get_crypto_peer(guid, node[0], node[1])
+    @staticmethod
+    def _as_listings(update):
+        if update is None:
+            return []
+        if isinstance(update, dict):
+            return [update]
+        return update
 
-                peer.send(proto_store(key, value, original_publisher_id, age))
+    @staticmethod
+    def _update_keyword_shard(existing_index, shard, add=(), remove=(), keyword=None):
+        """
+        Apply an update to a shard of a keyword index. A shard is a set
+        of listings, kept in the order they were last added in.
+
+        When a shard is full, the listings added longest ago are moved
+        to its overflow shard, shard + KEYWORD_INDEX_SHARDS, and its
+        'shards' grows to cover it. From then on the updates of the
+        shard are also passed on to the overflow shard, so that it
+        keeps no stale copy of a listing re-added or removed here.
+
+        @param existing_index: The stored shard, or None.
+        @param shard: The number of the shard.
+        @param add: The listings ({'guid': ..., 'key': ...}) to add.
+        @param remove: The listings to remove.
+        @param keyword: The keyword of the index, if the update has it.
+                        Without it, as from older peers, the key of the
+                        overflow shard is not known and the listings
+                        added longest ago are dropped instead.
+
+        @return: The updated shard, or None if the update only removes
+                 listings none of which are in it; and the update to
+                 store in the overflow shard, or None.
+        """
+        listings = collections.OrderedDict()
+        shards = constants.KEYWORD_INDEX_SHARDS
+        if existing_index is not None:
+            for listing in existing_index.get('listings', []):
+                listings[(listing.get('guid'), listing.get('key'))] = listing
+            shards = max(shards, existing_index.get('shards', shards))
+            keyword = keyword or existing_index.get('keyword')
+        overflow_shard = shard + constants.KEYWORD_INDEX_SHARDS
+        overflowed = shards > overflow_shard
+
+        removed = False
+        for listing in remove:
+            if listings.pop((listing.get('guid'), listing.get('key')), None) is not None:
+                removed = True
+
+        for listing in add:
+            # Re-added listings move to the end.
+            listings.pop((listing.get('guid'), listing.get('key')), None)
+            listings[(listing.get('guid'), listing.get('key'))] = listing
+        moved = []
+        while len(listings) > constants.KEYWORD_INDEX_SHARD_SIZE:
+            moved.append(listings.popitem(last=False)[1])
+        can_overflow = (keyword is not None and
+                        overflow_shard < constants.KEYWORD_INDEX_MAX_SHARDS)
+        if moved and can_overflow:
+            overflowed = True
+            shards = max(shards, overflow_shard + 1)
+        else:
+            moved = []
+
+        overflow = None
+        if overflowed and (moved or add or remove):
+            overflow = {'shard': overflow_shard, 'keyword': keyword}
+            if moved:
+                overflow['keyword_index_add'] = moved
+            if add or remove:
+                overflow['keyword_index_remove'] = list(remove) + list(add)
+
+        if not add and not removed:
+            return None, overflow
+        value = {
+            'listings': listings.values(),
+            'shard': shard,
+            'shards': shards
+        }
+        if keyword is not None:
+            value['keyword'] = keyword
+        return value, overflow
 
-    @_synchronized
     def _on_store_value(self, msg):
 
         key = msg['key']
@@ -672,15 +971,11 @@ class DHT(object):
         self.log.info('Storing key %s for %s', key, original_publisher_id)
         self.log.datadump('Value: %s', value)
 
-        now = int(time.time())
-        originally_published = now - age
-
         if value:
-            self.data_store.set_item(key, value, now, originally_published, original_publisher_id, self.market_id)
+            self._merge_and_store(key, value, original_publisher_id, age)
         else:
             self.log.error('No value to store')
 
-    @_synchronized
     def store(self, key, value, original_publisher_id=None, age=0, **kwargs):
         """ Store the received data in this node's local hash table
 
@@ -720,12 +1015,18 @@ class DHT(object):
 
         now = int(time.time())
         originally_published = now - age
+        self._store_locally(key, value, originally_published, original_publisher_id)
+        return 'OK'
+
+    def _store_locally(self, key, value, originally_published, original_publisher_id):
+        """ Store a (key, value) pair in our own datastore, as published
+        just now, and schedule it for republishing """
+        now = int(time.time())
         self.data_store.set_item(
             key, value, now, originally_published, original_publisher_id, market_id=self.market_id
         )
-        return 'OK'
+        self.republisher.schedule(key, now, originally_published, original_publisher_id)
 
-    @_synchronized
     def iterative_find_node(self, key, callback=None):
         """ The basic Kademlia node lookup operation
 
@@ -733,11 +1034,14 @@ class DHT(object):
 
         @param key: the 160-bit key (i.e. the node or value ID) to search for
         @type key: str
+
+        @return: The search started for the key.
+        @rtype: DHTSearch
         """
         self.log.info('Looking for node at: %s', key)
-        self.iterative_find(key, [], callback=callback)
+        return self.iterative_find(key, [], callback=callback)
 
-    @_synchronized
+    @_synchronized('_searches_lock')
     def iterative_find(self, key, startup_shortlist=None, call='findNode', callback=None):
         """
         - Create a new DHTSearch object and add the key and call back to it
@@ -761,25 +1065,28 @@ class DHT(object):
         if startup_shortlist == [] or startup_shortlist is None:
 
             # Retrieve closest nodes and add them to the shortlist for the search
-            close_nodes = self.routing_table.find_close_nodes(key, constants.ALPHA, self.settings['guid'])
-            shortlist = []
-
-            for close_node in close_nodes:
-                if close_node.guid:
-                    shortlist.append((close_node.hostname, close_node.port, close_node.guid))
+            with self._peers_lock:
+                close_nodes = self.routing_table.find_close_nodes(key, constants.ALPHA, self.settings['guid'])
+                shortlist = [
+                    (close_node.hostname, close_node.port, close_node.guid)
+                    for close_node in close_nodes
+                    if close_node.guid
+                ]
+
+                # Refresh the KBucket for this key
+                if key != self.settings['guid']:
+                    self.routing_table.touch_kbucket(key)
 
             if len(shortlist) > 0:
                 new_search.add_to_shortlist(shortlist)
 
-            # Refresh the KBucket for this key
-            if key != self.settings['guid']:
-                self.routing_table.touch_kbucket(key)
-
             # Abandon the search if the shortlist has no nodes
             if len(new_search.shortlist) == 0:
                 self.log.info('Search Finished')
+                self.cancel_search(new_search.find_id)
                 if callback is not None:
                     callback([])
+                    return new_search
                 else:
                     return []
 
@@ -787,22 +1094,24 @@ class DHT(object):
             new_search.shortlist = startup_shortlist
 
         self._search_iteration(new_search, find_value=find_value)
+        return new_search
 
-    @_synchronized
+    @_synchronized('_searches_lock')
     def _search_iteration(self, new_search, find_value=False):
 
         # Update slow nodes count
         new_search.slow_node_count[0] = len(new_search.active_probes)
 
-        for i, active_peer in enumerate(self.active_peers):
-            if not active_peer.guid and not active_peer.seed:
-                self.log.debug('Deleting active peer with no GUID')
-                del self.active_peers[i]
+        with self._peers_lock:
+            for i, active_peer in enumerate(self.active_peers):
+                if not active_peer.guid and not active_peer.seed:
+                    self.log.debug('Deleting active peer with no GUID')
+                    del self.active_peers[i]
 
-        # Sort shortlist from closest to farthest
-        self.active_peers.sort(lambda firstNode, secondNode, targetKey=new_search.key: cmp(
-            self.routing_table.distance(firstNode.guid, targetKey),
-            self.routing_table.distance(secondNode.guid, targetKey)))
+            # Sort shortlist from closest to farthest
+            self.active_peers.sort(lambda firstNode, secondNode, targetKey=new_search.key: cmp(
+                self.routing_table.distance(firstNode.guid, targetKey),
+                self.routing_table.distance(secondNode.guid, targetKey)))
 
         # TODO: Put this in the callback
         # if new_search.key in new_search.find_value_result:
@@ -819,10 +1128,10 @@ class DHT(object):
         # new_search.callback(new_search.shortlist)
         # return
 
-        # Update closest node
-        if len(self.active_peers):
-            closest_peer = self.active_peers[0]
-            new_search.previous_closest_node = (closest_peer.hostname, closest_peer.port, closest_peer.guid)
+            # Update closest node
+            if len(self.active_peers):
+                closest_peer = self.active_peers[0]
+                new_search.previous_closest_node = (closest_peer.hostname, closest_peer.port, closest_peer.guid)
 
         # Sort short list again
         if len(new_search.shortlist) > 1:
@@ -874,7 +1183,7 @@ class DHT(object):
                     else:
                         self.log.error('No contact was found for this guid: %s', node[2])
 
-    @_synchronized
+    @_synchronized('_searches_lock')
     def active_search_exists(self, find_id):
 
         active_search_exists = False
@@ -884,7 +1193,13 @@ class DHT(object):
         if not active_search_exists:
             return False
 
-    @_synchronized
+    @_synchronized('_searches_lock')
+    def cancel_search(self, find_id):
+        """Drop the search with the given id; no further queries are sent."""
+        self.searches = [
+            search for search in self.searches if search.find_id != find_id
+        ]
+
     def iterative_find_value(self, key, callback=None):
         self.iterative_find(key, call='findValue', callback=callback)
 
@@ -0,0 +1,260 @@
+"""
+Cached verification of the PGP signatures of contracts.
+
+Classes:
+    GPGVerifier -- Verifies contract signatures once, remembering the
+                   results in the database.
+"""
+
+import Queue
+import collections
+import hashlib
+import logging
+import threading
+import time
+
+import gnupg
+from tornado import ioloop
+
+from node import constants
+from node.contract_cache import contract_digest
+
+
+def _key_digest(public_key):
+    if isinstance(public_key, unicode):
+        public_key = public_key.encode('utf-8')
+    return hashlib.sha1(public_key).hexdigest()
+
+
+class GPGVerifier(object):
+    """
+    Verifies the signatures of contracts with gpg, which is a process
+    spawned per call, as few times as possible.
+
+    The fingerprint of the key each contract was signed with is kept by
+    the digest of the contract text, in memory and in the
+    verified_contracts table, so a contract seen before is not verified
+    again, even after a restart. Failed verifications are not kept, as
+    they may succeed once the signing key is imported.
+
+    A signature only verifies a contract if it was made with the public
+    key given with it, and not with any other key of the keyring. Public
+    keys are imported the first time they are seen, remembering the
+    fingerprints gpg reports for them. Queued verifications are done by
+    a single worker thread, which verifies a contract queued several
+    times only once.
+    """
+
+    def __init__(self, db_connection, market_id, gpg=None, io_loop=None,
+                 cache_size=constants.VERIFY_CACHE_SIZE,
+                 batch_size=constants.VERIFY_BATCH_SIZE):
+        """
+        @param db_connection: The database verification results are
+                              kept in.
+        @type db_connection: node.db_store.Obdb
+
+        @param market_id: The id of the market, for logging purposes.
+        @type market_id: int
+
+        @param gpg: The gpg the keys are imported in. Defaults to one
+                    using the default keyring, created on first use.
+        @type gpg: gnupg.GPG
+
+        @param io_loop: The IOLoop the callbacks of queued verifications
+                        are run on. Defaults to the current one.
+        @type io_loop: tornado.ioloop.IOLoop
+
+        @param cache_size: Number of results kept in memory.
+        @type cache_size: int
+
+        @param batch_size: Most verifications the worker does at once.
+        @type batch_size: int
+        """
+        self.db_connection = db_connection
+        self._gpg = gpg
+        self.io_loop = io_loop or ioloop.IOLoop.current()
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+
+        # Contract digest -> signer fingerprint, least recently used first
+        self._verified = collections.OrderedDict()
+        # Public key digest -> fingerprints gpg imported it as
+        self._key_fingerprints = {}
+        # Protects the two above
+        self._lock = threading.Lock()
+        # Serializes the use of gpg
+        self._gpg_lock = threading.Lock()
+
+        self._queue = Queue.Queue()
+        self._worker = None
+
+        self.log = logging.getLogger(
+            '[%s] %s' % (market_id, self.__class__.__name__)
+        )
+
+    @property
+    def gpg(self):
+        if self._gpg is None:
+            self._gpg = gnupg.GPG()
+        return self._gpg
+
+    def verify(self, raw_contract, public_key):
+        """
+        Verify the signature of a contract, importing the public key of
+        its signer if needed. This blocks if the contract has not been
+        verified before; use verify_async() from the IOLoop.
+
+        @param raw_contract: The clearsigned contract.
+        @param public_key: The armored public key of the signer.
+        @return: The fingerprint of the signing key, or None if the
+                 signature does not verify or was made with another key.
+        """
+        digest = contract_digest(raw_contract)
+        fingerprints = self.import_key(public_key)
+        if not fingerprints:
+            return None
+        fingerprint = (self.get_verified(digest) or
+                       self._verify(digest, raw_contract))
+        return self._signed_with(digest, fingerprint, fingerprints)
+
+    def verify_async(self, raw_contract, public_key, callback):
+        """
+        Verify the signature of a contract in the worker thread.
+
+        @param callback: Called on the IOLoop as callback(fingerprint),
+                         see verify(). It is called at once if the
+                         contract has been verified before.
+        """
+        digest = contract_digest(raw_contract)
+        with self._lock:
+            fingerprints = self._key_fingerprints.get(_key_digest(public_key))
+        if fingerprints is not None:
+            fingerprint = self.get_verified(digest)
+            if fingerprint is not None:
+                callback(self._signed_with(digest, fingerprint, fingerprints))
+                return
+
+        self._queue.put((digest, raw_contract, public_key, callback))
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._work)
+            self._worker.daemon = True
+            self._worker.start()
+
+    def get_verified(self, digest):
+        """Return the signer of a verified contract, by digest, or None."""
+        with self._lock:
+            fingerprint = self._verified.pop(digest, None)
+            if fingerprint is not None:
+                self._verified[digest] = fingerprint
+                return fingerprint
+
+        rows = self.db_connection.select_entries(
+            "verified_contracts", {"digest": digest},
+            select_fields="fingerprint"
+        )
+        if not rows:
+            return None
+        fingerprint = rows[0]['fingerprint']
+        self._remember(digest, fingerprint)
+        return fingerprint
+
+    def import_key(self, public_key):
+        """
+        Import a public key, unless it has been imported before.
+
+        @return: The fingerprints gpg imported the key as; empty if it
+                 could not be imported.
+        """
+        key_digest = _key_digest(public_key)
+        with self._lock:
+            fingerprints = self._key_fingerprints.get(key_digest)
+        if fingerprints is not None:
+            return fingerprints
+
+        with self._gpg_lock:
+            result = self.gpg.import_keys(public_key)
+        fingerprints = frozenset(result.fingerprints)
+        if not fingerprints:
+            # Not remembered, so that it is tried again.
+            self.log.warning('Cannot import key %s', key_digest)
+            return fingerprints
+        self.log.debug('Imported key %s: %s', key_digest,
+                       ', '.join(fingerprints))
+        with self._lock:
+            self._key_fingerprints[key_digest] = fingerprints
+        return fingerprints
+
+    def _signed_with(self, digest, fingerprint, fingerprints):
+        if fingerprint is None or fingerprint in fingerprints:
+            return fingerprint
+        self.log.warning('Contract %s is not signed with the key of its '
+                         'seller', digest)
+        return None
+
+    def _verify(self, digest, raw_contract):
+        with self._gpg_lock:
+            verified = self.gpg.verify(raw_contract)
+        if not verified:
+            return None
+
+        # The primary key, which is what importing the key reports,
+        # rather than the subkey that may have signed.
+        fingerprint = verified.pubkey_fingerprint or verified.fingerprint
+        self._remember(digest, fingerprint)
+        try:
+            self.db_connection.insert_entry("verified_contracts", {
+                "digest": digest,
+                "fingerprint": fingerprint,
+                "created": int(time.time())
+            })
+        except Exception as exc:
+            # Verified concurrently by another caller.
+            self.log.debug('Cannot store verification of %s: %s',
+                           digest, exc)
+        return fingerprint
+
+    def _remember(self, digest, fingerprint):
+        with self._lock:
+            self._verified.pop(digest, None)
+            self._verified[digest] = fingerprint
+            while len(self._verified) > self.cache_size:
+                self._verified.popitem(last=False)
+
+    def _work(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+            self._verify_batch(batch)
+
+    def _verify_batch(self, batch):
+        # digest -> (raw contract, [(public key, callback)]), in queue order
+        contracts = collections.OrderedDict()
+        for digest, raw_contract, public_key, callback in batch:
+            contracts.setdefault(digest, (raw_contract, []))[1].append(
+                (public_key, callback)
+            )
+
+        for digest, (raw_contract, waiting) in contracts.iteritems():
+            fingerprint = None
+            verified = False
+            for public_key, callback in waiting:
+                try:
+                    fingerprints = self.import_key(public_key)
+                    if fingerprints and not verified:
+                        verified = True
+                        fingerprint = (self.get_verified(digest) or
+                                       self._verify(digest, raw_contract))
+                except Exception as exc:
+                    self.log.error('Cannot verify contract %s: %s',
+                                   digest, exc)
+                    fingerprints = frozenset()
+                self.io_loop.add_callback(
+                    callback,
+                    self._signed_with(digest, fingerprint, fingerprints)
+                    if fingerprints else None
+                )
+        self.log.debug('Verified %d contracts', len(contracts))
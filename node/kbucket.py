@@ -1,15 +1,25 @@
+from __future__ import absolute_import
+
 import logging
+import time
 
+from dht import kbucket
 from node import constants, guid
 
 
-class BucketFull(Exception):
+class BucketFull(kbucket.FullBucketError):
     """Raised when the bucket is full."""
     pass
 
 
-class KBucket(object):
-    """FILLME"""
+class KBucket(kbucket.CachingKBucket):
+    """
+    A replacement-caching KBucket holding peer connections.
+
+    This adapts dht.kbucket.CachingKBucket to the interface expected
+    by the DHT: contacts may be given as guid.GUIDMixin instances or
+    as raw guids, and removing an absent contact is an error.
+    """
 
     def __init__(self, range_min, range_max, market_id):
         """
@@ -23,24 +33,31 @@ class KBucket(object):
                           covered by this KBucket.
         @type: int
 
-        @param market_id: FILLME
+        @param market_id: The id of the market this KBucket belongs to,
+                          strictly for logging purposes.
         """
+        super(KBucket, self).__init__(range_min, range_max)
 
         self.last_accessed = 0
-        self.range_min = range_min
-        self.range_max = range_max
-        self.contacts = []
         self.market_id = market_id
 
         self.log = logging.getLogger(
             '[%s] %s' % (market_id, self.__class__.__name__)
         )
 
-    def __len__(self):
-        return len(self.contacts)
+    @property
+    def contacts(self):
+        """The contact list, least recently seen first."""
+        return self._contacts
+
+    def _spawn(self, range_min, range_max):
+        return self.__class__(range_min, range_max, self.market_id)
 
-    def __iter__(self):
-        return iter(self.contacts)
+    @staticmethod
+    def _to_guid(contact):
+        if isinstance(contact, guid.GUIDMixin):
+            return contact.guid
+        return contact
 
     def add_contact(self, contact):
         """
@@ -57,25 +74,16 @@ class KBucket(object):
         """
         if isinstance(contact, basestring):
             contact = guid.GUIDMixin(contact)
+
+        # Since the guid index is keyed by guid, a contact C1 that is
+        # already present will be replaced by the new contact C2 even
+        # if it's not exactly the same as C2. This is the intended
+        # behaviour; the fresh contact may have updated add-on data
+        # (e.g. optimization-specific stuff).
         try:
-            # Assume contact exists. Attempt to remove the old one...
-            self.contacts.remove(contact)
-            # ... and add the new one at the end of the list.
-            self.contacts.append(contact)
-
-            # The code above works as follows:
-            # Assume C1 is the existing contact and C2 is the new contact.
-            # Iff C1 is equal to C2, it will be removed from the list.
-            # Since Contact.__eq__ compares only GUIDs, contact C1 will
-            # be replaced even if it's not exactly the same as C2.
-            # This is the intended behaviour; the fresh contact may have
-            # updated add-on data (e.g. optimization-specific stuff).
-        except ValueError:
-            # The contact wasn't there after all, so add it.
-            if len(self.contacts) < constants.K:
-                self.contacts.append(contact)
-            else:
-                raise BucketFull('No space in bucket to insert contact')
+            self._push_contact(contact)
+        except kbucket.FullBucketError:
+            raise BucketFull('No space in bucket to insert contact')
 
     def get_contact(self, contact_id):
         """
@@ -87,71 +95,48 @@ class KBucket(object):
         @rtype: guid.GUIDMixin or None
         """
         self.log.debugv('[get_contact] %s', contact_id)
-        for contact in self.contacts:
-            if contact == contact_id:
-                self.log.debugv('[get_contact] Found %s', contact)
-                return contact
-        self.log.debugv('[get_contact] No Results')
-        return None
-
-    def get_contacts(self, count=-1, exclude_contact=None):
+        return super(KBucket, self).get_contact(self._to_guid(contact_id))
+
+    def get_contacts(self, count=-1, excluded_guid=None):
         """
-        Return a list containing up to the first `count` number of contacts.
+        Return a list containing up to `count` number of contacts.
 
         @param count: The amount of contacts to return;
                       if 0 or less, return all contacts.
         @type count: int
-        @param exclude_contact: A contact to exclude; if this contact is in
-                                the list of returned values, it will be
-                                discarded before returning. If a str is
-                                passed as this argument, it must be the
-                                contact's ID.
-        @type exclude_contact: guid.GUIDMixin or str or unicode
-
-        @return: The first `count` contacts in the contact list.
-                 This amount is capped by the available contacts
-                 and the bucket size, of course. If no contacts
-                 are present, an empty list is returned.
+        @param excluded_guid: A contact to exclude; if this contact is in
+                              the list of returned values, it will be
+                              discarded before returning. If a str is
+                              passed as this argument, it must be the
+                              contact's ID.
+        @type excluded_guid: guid.GUIDMixin or str or unicode
+
+        @return: Up to `count` contacts from the contact list; newer
+                 contacts are preferred. This amount is capped by the
+                 available contacts and the bucket size, of course. If
+                 no contacts are present, an empty list is returned.
         @rtype:  list of guid.GUIDMixin
         """
-
-        current_len = len(self)
-        if not current_len:
-            return []
-
         if count <= 0:
-            count = current_len
-        else:
-            count = min(count, current_len)
-
-        # Return no more contacts than bucket size.
-        count = min(count, constants.K)
-
-        contact_list = self.contacts[:count]
-        if exclude_contact is not None:
-            try:
-                # NOTE: If the exclude_contact is removed, the resulting
-                # list has one less contact than expected. Not sure if
-                # this is a bug.
-                contact_list.remove(exclude_contact)
-            except ValueError:
-                self.log.debug(
-                    '[kbucket.get_contacts() warning] '
-                    'tried to exclude non-existing contact (%s)',
-                    exclude_contact
-                )
-        return contact_list
+            count = -1
+        return super(KBucket, self).get_contacts(
+            count, self._to_guid(excluded_guid)
+        )
 
     def remove_contact(self, contact):
         """
-        Remove given contact from contact list.
+        Remove given contact from contact list, and refill the list
+        from the replacement cache.
 
         @param contact: The ID of the contact to remove.
         @type contact: guid.GUIDMixin or str or unicode
 
         @raise ValueError: The specified contact is not in this bucket.
         """
-        self.contacts.remove(contact)
+        contact_guid = self._to_guid(contact)
+        if contact_guid not in self._guid_index:
+            raise ValueError('Contact %s not in bucket' % contact_guid)
+        self.remove_guid(contact_guid)
 
     def key_in_range(self, key):
         """
@@ -170,3 +155,8 @@ class KBucket(object):
         if isinstance(key, basestring):
             key = int(key, base=16)
         return self.range_min <= key < self.range_max
+
+    def is_stale(self):
+        """Whether the bucket has not been accessed for REFRESH_TIMEOUT."""
+        idle = int(time.time()) - self.last_accessed
+        return idle * 1000 >= constants.REFRESH_TIMEOUT
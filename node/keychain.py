@@ -0,0 +1,97 @@
+"""
+Derivation of the BIP32 keys of contracts and orders.
+
+Contract and order keys are the children m/1/0/n of the wallet of the
+node's seed, where n is the id of their keystore row. Deriving a key
+from the seed takes three pure-Python EC steps before the child itself;
+this module keeps the m/1/0 chain node of each seed in memory, along
+with the most recently used children.
+
+Classes:
+    KeyChain -- The m/1/0 chain of a seed, with memoized children.
+
+Functions:
+    get_keychain -- The shared KeyChain of a seed.
+"""
+
+import collections
+import threading
+
+import bitcoin
+
+from node import constants
+
+_KEYCHAINS = {}
+_KEYCHAINS_LOCK = threading.Lock()
+
+
+def get_keychain(seed):
+    """Return the KeyChain of `seed`, creating it on first use."""
+    with _KEYCHAINS_LOCK:
+        keychain = _KEYCHAINS.get(seed)
+        if keychain is None:
+            keychain = _KEYCHAINS[seed] = KeyChain(seed)
+        return keychain
+
+
+class KeyChain(object):
+    """
+    The m/1/0 chain of the BIP32 wallet of a seed, from which the keys
+    of contracts and orders are derived.
+    """
+
+    def __init__(self, seed, cache_size=constants.BIP32_KEY_CACHE_SIZE):
+        """
+        @param seed: The BIP32 seed of the node, from its settings.
+        @type seed: str
+
+        @param cache_size: Number of derived keys kept in memory.
+        @type cache_size: int
+        """
+        self.seed = seed
+        self.cache_size = cache_size
+        self._chain = None
+        # (kind, key_id) -> key, least recently used first.
+        self._keys = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    @property
+    def chain(self):
+        """The extended private key of m/1/0."""
+        if self._chain is None:
+            wallet = bitcoin.bip32_ckd(bitcoin.bip32_master_key(self.seed), 1)
+            self._chain = bitcoin.bip32_ckd(wallet, 0)
+        return self._chain
+
+    def _get(self, kind, key_id, derive):
+        key = (kind, key_id)
+        with self._lock:
+            value = self._keys.pop(key, None)
+            if value is None:
+                value = derive(key_id)
+            self._keys[key] = value
+            if len(self._keys) > self.cache_size:
+                self._keys.popitem(last=False)
+        return value
+
+    def _derive_priv(self, key_id):
+        return bitcoin.bip32_ckd(self.chain, key_id)
+
+    def get_child(self, key_id):
+        """Return the extended private key of m/1/0/key_id."""
+        return self._get('priv', key_id, self._derive_priv)
+
+    def get_signing_key(self, key_id):
+        """Return the private key of m/1/0/key_id, in WIF."""
+        return self._get('wif', key_id, lambda key_id: bitcoin.encode_privkey(
+            bitcoin.bip32_extract_key(self.get_child(key_id)), 'wif'
+        ))
+
+    def get_pubkey(self, key_id):
+        """Return the uncompressed public key of m/1/0/key_id, in hex."""
+        return self._get('pub', key_id, lambda key_id: bitcoin.encode_pubkey(
+            bitcoin.bip32_extract_key(
+                bitcoin.bip32_privtopub(self.get_child(key_id))
+            ),
+            'hex'
+        ))
@@ -0,0 +1,119 @@
+"""
+Batched publication of our listings to the DHT keyword indexes.
+
+Classes:
+    KeywordPublisher -- Groups keyword index updates by DHT key.
+"""
+
+import collections
+import json
+import logging
+
+from tornado import ioloop
+
+from node import constants
+
+
+class KeywordPublisher(object):
+    """
+    Collects the keyword index updates of our listings and stores them
+    in the DHT in batches.
+
+    The updates for one shard of a keyword index, from any number of
+    listings, are merged into a single store, so that each distinct DHT
+    key costs one lookup. Of a listing's updates for a shard only the
+    latest is kept. Every `interval` seconds at most `batch_size` keys
+    are stored.
+    """
+
+    def __init__(self, transport, market_id, io_loop=None,
+                 interval=constants.KEYWORD_PUBLISH_INTERVAL,
+                 batch_size=constants.KEYWORD_PUBLISH_BATCH_SIZE):
+        """
+        @param transport: The transport the updates are stored through.
+        @type transport: node.transport.CryptoTransportLayer
+
+        @param market_id: The id of the market, for logging purposes.
+        @type market_id: int
+
+        @param io_loop: The IOLoop the batches are scheduled on. Defaults
+                        to the current one.
+        @type io_loop: tornado.ioloop.IOLoop
+
+        @param interval: Seconds between two batches.
+        @type interval: int
+
+        @param batch_size: Maximum number of keys stored per batch.
+        @type batch_size: int
+        """
+        self.transport = transport
+        self.io_loop = io_loop or ioloop.IOLoop.current()
+        self.interval = interval
+        self.batch_size = batch_size
+
+        # DHT key -> (keyword, shard, {listing key: update}), in queueing
+        # order
+        self._pending = collections.OrderedDict()
+        self._timeout = None
+
+        self.log = logging.getLogger(
+            '[%s] %s' % (market_id, self.__class__.__name__)
+        )
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, keyword, listing_key):
+        """Add one of our listings to the index of `keyword`."""
+        self._queue(keyword, 'keyword_index_add', listing_key)
+
+    def remove(self, keyword, listing_key):
+        """Remove one of our listings from the index of `keyword`."""
+        self._queue(keyword, 'keyword_index_remove', listing_key)
+
+    def _queue(self, keyword, update, listing_key):
+        dht = self.transport.dht
+        shard = dht.keyword_index_shard(listing_key)
+        keyword_key = dht.keyword_index_key(keyword, shard)
+
+        pending = self._pending.get(keyword_key)
+        if pending is None:
+            pending = self._pending[keyword_key] = (keyword, shard, {})
+        pending[2][listing_key] = update
+
+        if self._timeout is None:
+            self._timeout = self.io_loop.call_later(
+                self.interval, self.publish
+            )
+
+    def publish(self):
+        """
+        Store the next batch of pending updates, one store per key.
+
+        @return: The number of keys stored.
+        @rtype: int
+        """
+        self._timeout = None
+
+        count = 0
+        while self._pending and count < self.batch_size:
+            keyword_key, (keyword, shard, updates) = self._pending.popitem(last=False)
+            # The keyword lets the nodes storing a full shard find its
+            # overflow shard, see DHT._update_keyword_shard().
+            value = {'shard': shard, 'keyword': keyword}
+            for listing_key, update in updates.iteritems():
+                value.setdefault(update, []).append({
+                    'guid': self.transport.guid,
+                    'key': listing_key
+                })
+            self.transport.store(
+                keyword_key, json.dumps(value), self.transport.guid
+            )
+            count += 1
+
+        self.log.debug('Published %d keyword keys, %d pending', count, len(self))
+        if self._pending:
+            self._timeout = self.io_loop.call_later(
+                self.interval, self.publish
+            )
+        return count
@@ -0,0 +1,250 @@
+"""
+Local full-text index of the listings this node has seen.
+
+Classes:
+    ListingIndex -- SQLite FTS4 index of own and network listings.
+"""
+
+import json
+import logging
+import re
+import struct
+import threading
+import time
+
+from sqlite3 import dbapi2
+
+from node import constants
+
+# Weight of a hit in each column of listings_fts, in order.
+_COLUMN_WEIGHTS = (4.0, 2.0, 1.0)
+
+_TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def _rank(matchinfo):
+    """
+    Rank a match from its matchinfo(listings_fts, 'pcx'): the sum, over
+    the query terms and columns, of the column weight times the share
+    of all the hits of the term in that column which are in this row.
+    """
+    info = struct.unpack('@%dI' % (len(matchinfo) / 4), str(matchinfo))
+    phrases, columns = info[0], info[1]
+    score = 0.0
+    for phrase in range(phrases):
+        for column in range(columns):
+            offset = 2 + 3 * (phrase * columns + column)
+            hits_this_row, hits_all_rows = info[offset], info[offset + 1]
+            if hits_this_row:
+                score += (_COLUMN_WEIGHTS[column] * hits_this_row /
+                          float(hits_all_rows))
+    return score
+
+
+class ListingIndex(object):
+    """
+    Full-text index of the listings of this node and of the verified
+    listings it has received from the network, so that keyword
+    searches can be answered locally before the network is asked.
+
+    Searches match every term of the query, each as a prefix, and are
+    ranked by where the terms appear: title, then keywords, then
+    description. Only the `candidates` most recently indexed matches
+    are ranked, which bounds the cost of a search for a common word.
+    The index keeps a connection of its own.
+
+    Up to `max_rows` listings of other stores are kept; the least
+    recently added or found are evicted first. Our own listings are
+    never evicted.
+    """
+
+    def __init__(self, db_connection, market_id, own_guid=None,
+                 max_rows=constants.LISTING_INDEX_MAX_ROWS,
+                 candidates=constants.LISTING_SEARCH_CANDIDATES):
+        """
+        @param db_connection: The database the index is kept in.
+        @type db_connection: node.db_store.Obdb
+
+        @param market_id: The id of the market the listings are in.
+        @type market_id: int
+
+        @param own_guid: Our GUID, whose listings are never evicted.
+        @type own_guid: str
+
+        @param max_rows: Most listings of other stores kept.
+        @type max_rows: int
+
+        @param candidates: Most matches ranked per search.
+        @type candidates: int
+        """
+        self.db_connection = db_connection
+        self.market_id = market_id
+        self.own_guid = own_guid
+        self.max_rows = max_rows
+        self.candidates = candidates
+        self._con = None
+        self._lock = threading.RLock()
+        self.log = logging.getLogger(
+            '[%s] %s' % (market_id, self.__class__.__name__)
+        )
+
+    def _get_connection(self):
+        if self._con is None:
+            con = dbapi2.connect(
+                self.db_connection.db_path, timeout=10, check_same_thread=False
+            )
+            if not self.db_connection.disable_sqlite_crypt:
+                con.execute("PRAGMA key = '%s';" % constants.DB_PASSPHRASE)
+            con.create_function('listing_rank', 1, _rank)
+            self._con = con
+        return self._con
+
+    def close(self):
+        with self._lock:
+            if self._con is not None:
+                self._con.close()
+                self._con = None
+
+    def add(self, key, contract_body, signed_contract_body, guid, nickname=''):
+        """
+        Index a listing, replacing any previous version of it.
+
+        @param key: The DHT key of the listing.
+        @param contract_body: The parsed JSON of the listing.
+        @type contract_body: dict
+        @param signed_contract_body: The signed text of the listing.
+        @param guid: The GUID of the seller.
+        @param nickname: The nickname of the seller.
+        """
+        contract = contract_body.get('Contract') or {}
+        keywords = contract.get('item_keywords') or []
+        if isinstance(keywords, basestring):
+            keywords = [keywords]
+
+        now = int(time.time())
+        with self._lock:
+            con = self._get_connection()
+            with con:
+                self._remove(con, key)
+                cur = con.execute(
+                    "INSERT INTO listings(key, market_id, guid, nickname, "
+                    "contract_body, signed_contract_body, updated, used) "
+                    "VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, self.market_id, guid, nickname,
+                     json.dumps(contract_body), signed_contract_body,
+                     now, now)
+                )
+                con.execute(
+                    "INSERT INTO listings_fts(docid, item_title, "
+                    "item_keywords, item_desc) VALUES(?, ?, ?, ?)",
+                    (cur.lastrowid, contract.get('item_title') or '',
+                     ' '.join(keywords), contract.get('item_desc') or '')
+                )
+                if guid != self.own_guid:
+                    self._evict(con)
+
+    def remove(self, key):
+        """Remove a listing from the index."""
+        with self._lock:
+            con = self._get_connection()
+            with con:
+                self._remove(con, key)
+
+    def _remove(self, con, key):
+        rows = con.execute(
+            "SELECT id FROM listings WHERE key = ? AND market_id = ?",
+            (key, self.market_id)
+        ).fetchall()
+        self._delete(con, rows)
+
+    def _evict(self, con):
+        # The listings of other stores beyond the `max_rows` most
+        # recently used
+        rows = con.execute(
+            "SELECT id FROM listings WHERE market_id = ? AND guid IS NOT ? "
+            "ORDER BY used DESC, id DESC LIMIT -1 OFFSET ?",
+            (self.market_id, self.own_guid, self.max_rows)
+        ).fetchall()
+        if rows:
+            self.log.debug('Evicting %d listings', len(rows))
+        self._delete(con, rows)
+
+    @staticmethod
+    def _delete(con, rows):
+        for (listing_id,) in rows:
+            con.execute("DELETE FROM listings_fts WHERE docid = ?", (listing_id,))
+            con.execute("DELETE FROM listings WHERE id = ?", (listing_id,))
+
+    def __len__(self):
+        with self._lock:
+            return self._get_connection().execute(
+                "SELECT COUNT(*) FROM listings WHERE market_id = ?",
+                (self.market_id,)
+            ).fetchone()[0]
+
+    @staticmethod
+    def make_query(text):
+        """
+        Turn search text into an FTS query matching all of its words as
+        prefixes, or None if it has no words.
+        """
+        terms = _TERM_RE.findall(text.lower())
+        if not terms:
+            return None
+        return ' '.join('%s*' % term for term in terms)
+
+    def search(self, text, limit=20, offset=0):
+        """
+        Search the index.
+
+        @param text: The words to search for.
+        @param limit: Maximum number of results.
+        @param offset: Number of results to skip, for paging.
+        @return: The best matching listings, best first, as dicts with
+                 the key, guid, nickname, contract_body (parsed) and
+                 signed_contract_body of each.
+        """
+        query = self.make_query(text)
+        if query is None:
+            return []
+
+        # The matches are taken in docid order, which FTS4 gives without
+        # sorting, so that matchinfo() and listing_rank() only run for
+        # the candidates, rather than for every match before the LIMIT.
+        candidates = max(self.candidates, offset + limit)
+        with self._lock:
+            con = self._get_connection()
+            rows = con.execute(
+                "SELECT listings.id, listings.key, listings.guid, "
+                "listings.nickname, listings.contract_body, "
+                "listings.signed_contract_body "
+                "FROM (SELECT docid, matchinfo(listings_fts, 'pcx') AS info "
+                "      FROM listings_fts WHERE listings_fts MATCH ? "
+                "      ORDER BY docid DESC LIMIT ?) AS matches "
+                "JOIN listings ON listings.id = matches.docid "
+                "WHERE listings.market_id = ? "
+                "ORDER BY listing_rank(matches.info) DESC, "
+                "listings.updated DESC "
+                "LIMIT ? OFFSET ?",
+                (query, candidates, self.market_id, limit, offset)
+            ).fetchall()
+            if rows:
+                # Found listings are kept longer.
+                with con:
+                    con.executemany(
+                        "UPDATE listings SET used = ? WHERE id = ?",
+                        [(int(time.time()), row[0]) for row in rows]
+                    )
+        self.log.debug('%d listings match %r', len(rows), query)
+
+        return [
+            {
+                'key': key,
+                'guid': guid,
+                'nickname': nickname,
+                'contract_body': json.loads(contract_body),
+                'signed_contract_body': signed_contract_body
+            }
+            for _, key, guid, nickname, contract_body, signed_contract_body
+            in rows
+        ]
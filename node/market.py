@@ -1,21 +1,28 @@
 """
 This module manages all market related activities
 """
+import functools
 import gnupg
 import hashlib
 import json
 import logging
-from PIL import Image, ImageOps
+import os
 import random
-from StringIO import StringIO
 import re
 from tornado import ioloop
 
 from node import constants
-from node.data_uri import DataURI
+from node.connection import sign_message
+from node.contract_cache import ContractCache
+from node.gpg_verifier import GPGVerifier
+from node.keychain import get_keychain
+from node.keyword_publisher import KeywordPublisher
+from node.listing_index import ListingIndex
 from node.orders import Orders
+from node.peer_images import PeerImageCache
 from node.protocol import proto_page, query_page
-import bitcoin
+from node.store_listings import listing_digest
+from node.thumbnails import ThumbnailCache
 import time
 
 
@@ -50,9 +57,28 @@ class Market(object):
         self.market_id = transport.market_id
         self.peers = self.dht.get_active_peers()
         self.db_connection = db_connection
+        # Parsed contracts, shared with the orders and the web socket
+        # handler
+        self.contract_cache = ContractCache()
+        self.listing_index = ListingIndex(
+            db_connection, self.market_id, transport.guid
+        )
+        self.keyword_publisher = KeywordPublisher(
+            transport, self.market_id, io_loop=self.loop
+        )
+        db_dir = os.path.dirname(db_connection.db_path)
+        self.thumbnails = ThumbnailCache(
+            os.path.join(db_dir, 'images'), self.market_id, io_loop=self.loop
+        )
+        self.peer_images = PeerImageCache(
+            transport, self.market_id, os.path.join(db_dir, 'peer_images'),
+            io_loop=self.loop
+        )
 
         self.pages = {}
         self.mypage = None
+        # Our signed page message, see get_page_envelope()
+        self.page_envelope = None
         self.signature = None
         self.nickname = ""
         self.log = logging.getLogger(
@@ -60,6 +86,9 @@ class Market(object):
         self.settings = self.transport.settings
 
         self.gpg = gnupg.GPG()
+        self.verifier = GPGVerifier(
+            db_connection, self.market_id, self.gpg, io_loop=self.loop
+        )
 
         self.all_messages = (
             'query_myorders',
@@ -67,6 +96,8 @@ class Market(object):
             'query_page',
             'query_listing',
             'query_listings',
+            'query_image',
+            'image',
             'inbox_message'
         )
 
@@ -87,7 +118,10 @@ class Market(object):
         # Recurring republish for DHT
         self.start_listing_republisher()
 
-        self.orders = Orders(transport, self.market_id, db_connection, self.gpg)
+        self.orders = Orders(
+            transport, self.market_id, db_connection, self.gpg, self.verifier,
+            self.contract_cache
+        )
 
     def start_listing_republisher(self):
         # Periodically refresh buckets
@@ -96,6 +130,9 @@ class Market(object):
                                              io_loop=self.loop)
         refresh_cb.start()
 
+        # Incrementally republish the data stored in the DHT
+        self.dht.republisher.start(self.loop)
+
     def disable_welcome_screen(self):
         """This just flags the welcome screen to not show on startup"""
         self.db_connection.update_entries(
@@ -113,27 +150,6 @@ class Market(object):
         """Add incoming information to log"""
         self.log.debug("Listings %s", results)
 
-    @staticmethod
-    def process_contract_image(image):
-        """Get image from web client for use on server side"""
-        uri = DataURI(image)
-        image_data = uri.data
-        # mime_type = uri.mimetype
-        charset = uri.charset
-
-        image = Image.open(StringIO(image_data))
-        cropped_image = ImageOps.fit(image, (200, 200), centering=(0.5, 0.5))
-        data = StringIO()
-        cropped_image.save(data, format='PNG', quality=75, optimize=True)
-        new_uri = DataURI.make(
-            'image/png',
-            charset=charset,
-            base64=True,
-            data=data.getvalue())
-        data.close()
-
-        return new_uri
-
     @staticmethod
     def get_contract_id():
         """Choice of number of new contract to prevent guessing the sequence of contract' id.
@@ -163,56 +179,48 @@ class Market(object):
 
     def save_contract_to_db(self, contract_id, body, signed_body, key, updating_contract=False):
         """Insert contract to database"""
-        if not updating_contract:
-            self.db_connection.insert_entry(
-                "contracts",
-                {
-                    "id": contract_id,
-                    "market_id": self.transport.market_id,
-                    "contract_body": json.dumps(body),
-                    "signed_contract_body": str(signed_body),
-                    "state": "seed",
-                    "deleted": 0,
-                    "key": key
-                }
-            )
-        else:
-            self.db_connection.update_entries(
-                "contracts",
-                {
-                    "market_id": self.transport.market_id,
-                    "contract_body": json.dumps(body),
-                    "signed_contract_body": str(signed_body),
-                    "state": "seed",
-                    "deleted": 0,
-                    "key": key
-                },
-                {
-                    "id": contract_id
-                }
-            )
+        contract = {
+            "market_id": self.transport.market_id,
+            "contract_body": json.dumps(body),
+            "signed_contract_body": str(signed_body),
+            "state": "seed",
+            "deleted": 0,
+            "key": key
+        }
+
+        previous = []
+        with self.db_connection.transaction():
+            if updating_contract:
+                previous = self.db_connection.select_entries(
+                    "contracts", {"id": contract_id}, select_fields="key"
+                )
+            if previous:
+                self.db_connection.update_entries(
+                    "contracts",
+                    contract,
+                    {
+                        "id": contract_id
+                    }
+                )
+            else:
+                contract["id"] = contract_id
+                self.db_connection.insert_entry("contracts", contract)
+
+        for row in previous:
+            self.listing_index.remove(row['key'])
+        self.index_contract(key, body, signed_body)
+
+    def index_contract(self, key, body, signed_body):
+        """Add one of our own listings to the local search index"""
+        self.listing_index.add(
+            key, body, str(signed_body), self.transport.guid,
+            self.transport.nickname
+        )
 
     def update_keywords_on_network(self, key, keywords):
         """Update keyword for sharing it with nodes"""
         for keyword in keywords:
-            keyword = keyword.upper()
-            hash_value = hashlib.new('ripemd160')
-            keyword_key = 'keyword-%s' % keyword
-            hash_value.update(keyword_key.encode('utf-8'))
-            keyword_key = hash_value.hexdigest()
-
-            self.log.debug("Sending keyword to network: %s", keyword_key)
-
-            self.transport.store(
-                keyword_key,
-                json.dumps({
-                    'keyword_index_add': {
-                        "guid": self.transport.guid,
-                        "key": key
-                    }
-                }),
-                self.transport.guid
-            )
+            self.keyword_publisher.add(keyword, key)
 
     def refund_recipient(self, recipient_id, order_id):
         self.log.debug('Refunding recipient')
@@ -220,11 +228,8 @@ class Market(object):
     def generate_new_pubkey(self, contract_id):
         self.log.debug('Generating new pubkey for contract')
 
-        # Retrieve next key id from DB
-        next_key_id = len(self.db_connection.select_entries("keystore", select_fields="id")) + 1
-
-        # Store updated key in DB
-        self.db_connection.insert_entry(
+        # The id of the new keystore row is the index of the child key
+        key_id = self.db_connection.insert_entry(
             "keystore",
             {
                 'contract_id': contract_id
@@ -232,17 +237,16 @@ class Market(object):
         )
 
         # Generate new child key (m/1/0/n)
-        wallet = bitcoin.bip32_ckd(bitcoin.bip32_master_key(self.settings.get('bip32_seed')), 1)
-        wallet_chain = bitcoin.bip32_ckd(wallet, 0)
-        bip32_identity_priv = bitcoin.bip32_ckd(wallet_chain, next_key_id)
-        bip32_identity_pub = bitcoin.bip32_privtopub(bip32_identity_priv)
-        pubkey = bitcoin.encode_pubkey(bitcoin.bip32_extract_key(bip32_identity_pub), 'hex')
+        return get_keychain(self.settings.get('bip32_seed')).get_pubkey(key_id)
 
-        return pubkey
-
-    def save_contract(self, contract, contract_id=None):
+    def save_contract(self, contract, contract_id=None, callback=None):
         """Sign, store contract in the database and update the keyword in the
-        network
+        network. A contract with an image is stored once the image has been
+        processed, so this may return before it is.
+
+        @param callback: Called as callback(error) once the contract is
+                         stored, with None, or with the reason it could
+                         not be.
         """
         updating_contract = True if contract_id else False
 
@@ -259,15 +263,50 @@ class Market(object):
         seller['seller_GUID'] = self.settings['guid']
         seller['seller_refund_addr'] = self.settings['refundAddress']
 
-        # Process and crop thumbs for images
-        if 'item_images' in contract['Contract']:
-            if 'image1' in contract['Contract']['item_images']:
-                img = contract['Contract']['item_images']['image1']
-                new_uri = self.process_contract_image(img)
-                contract['Contract']['item_images'] = new_uri
+        # Store the image and crop its thumbnail off the IOLoop, then
+        # sign and store the contract
+        images = contract['Contract'].get('item_images') or {}
+        if 'image1' in images:
+            self.thumbnails.add(
+                images['image1'],
+                functools.partial(
+                    self.on_contract_image, contract, contract_id,
+                    updating_contract, callback
+                )
+            )
         else:
             self.log.debug('No image for contract')
+            self.store_contract(contract, contract_id, updating_contract)
+            if callback is not None:
+                callback(None)
+
+    def on_contract_image(self, contract, contract_id, updating_contract,
+                          callback, image_hash):
+        """Reference the stored image of a contract, then store it"""
+        if image_hash is None:
+            self.log.error('Could not read the image of contract %s',
+                           contract_id)
+            if callback is not None:
+                callback('The image of the contract could not be read.')
+            return
+
+        # Peers fetch the image by hash, see on_query_image()
+        contract['Contract']['item_image_hashes'] = [image_hash]
+        del contract['Contract']['item_images']
+        try:
+            self.store_contract(contract, contract_id, updating_contract)
+        except Exception as exc:
+            # Run from the IOLoop, where the error would only be logged.
+            self.log.error('Could not store contract %s: %s',
+                           contract_id, exc)
+            if callback is not None:
+                callback('The contract could not be stored.')
+            return
+        if callback is not None:
+            callback(None)
 
+    def store_contract(self, contract, contract_id, updating_contract):
+        """Sign a contract, store it in the database and on the network"""
         # Line break the signing data
         out_text = self.linebreak_signing_data(contract)
 
@@ -369,17 +408,24 @@ class Market(object):
 
     def republish_contracts(self):
         """Update information about contracts in the network"""
-        listings = self.db_connection.select_entries("contracts", {"deleted": 0})
+        # Loaded at once rather than streamed: publishing a contract
+        # writes to the database, and a stream would hold a reader
+        # connection the whole time.
+        listings = self.db_connection.select_entries(
+            "contracts",
+            {"deleted": 0},
+            select_fields=['key', 'signed_contract_body', 'contract_body']
+        )
         for listing in listings:
             self.transport.store(
                 listing['key'],
-                listing.get('signed_contract_body'),
+                listing['signed_contract_body'],
                 self.transport.guid
             )
 
             # Push keyword index out again
-            contract_body = json.loads(listing.get('contract_body'))
-            self.log.debug('Listing: %s', listing)
+            contract_body = json.loads(listing['contract_body'])
+            self.log.debug('Listing: %s', listing['key'])
             self.log.debug('Contract: %s', contract_body)
 
             contract = contract_body.get('Contract')
@@ -387,7 +433,10 @@ class Market(object):
             keywords = contract.get('item_keywords') if contract is not None else []
             self.log.debug('Found keywords to republish: %s', keywords)
 
-            self.update_keywords_on_network(listing.get('key'), keywords)
+            self.update_keywords_on_network(listing['key'], keywords)
+            self.index_contract(
+                listing['key'], contract_body, listing['signed_contract_body']
+            )
 
         # Updating the DHT index of your store's listings
         self.update_listings_index()
@@ -446,7 +495,8 @@ class Market(object):
         # Calculate index of contracts
         contract_ids = self.db_connection.select_entries(
             "contracts",
-            {"market_id": self.transport.market_id, "deleted": 0}
+            {"market_id": self.transport.market_id, "deleted": 0},
+            select_fields="key"
         )
         my_contracts = []
         for contract_id in contract_ids:
@@ -493,28 +543,14 @@ class Market(object):
         """Remove from DHT keyword indices"""
         contract = self.db_connection.select_entries("contracts", {"id": contract_id})[0]
         contract_key = contract['key']
+        self.listing_index.remove(contract_key)
 
         contract = json.loads(contract['contract_body'])
         contract_keywords = contract['Contract']['item_keywords']
         self.log.debug('Keywords to remove: %s', contract_keywords)
 
         for keyword in contract_keywords:
-            # Remove keyword from index
-            hash_value = hashlib.new('ripemd160')
-            keyword_key = 'keyword-%s' % keyword
-            hash_value.update(keyword_key.encode('utf-8'))
-            keyword_key = hash_value.hexdigest()
-
-            self.transport.store(
-                keyword_key,
-                json.dumps({
-                    'keyword_index_remove': {
-                        "guid": self.transport.guid,
-                        "key": contract_key
-                    }
-                }),
-                self.transport.guid
-            )
+            self.keyword_publisher.remove(keyword, contract_key)
 
     def send_inbox_message(self, msg):
         """Send message for market internally"""
@@ -590,58 +626,95 @@ class Market(object):
         my_contracts = []
 
         for contract in contracts:
-            try:
-                contract_body = json.loads(u"%s" % contract['contract_body'])
-            except (KeyError, ValueError) as err:
-                self.log.error('Problem loading the contract body JSON: %s',
-                               err.message)
-                continue
-            try:
-                contract_field = contract_body['Contract']
-            except KeyError:
-                self.log.error('Contract field not found in contract_body')
-                continue
-            except TypeError:
-                self.log.error('Malformed contract_body: %s',
-                               str(contract_body))
-                continue
-            item_price = contract_field.get('item_price')
-            if item_price is None or item_price < 0:
-                item_price = 0
-            try:
-                item_delivery = contract_field['item_delivery']
-            except KeyError:
-                self.log.error('item_delivery not found in Contract field')
-                continue
-            except TypeError:
-                self.log.error('Malformed Contract field: %s',
-                               str(contract_field))
-                continue
-            shipping_price = item_delivery.get('shipping_price')
-            if shipping_price is None or shipping_price < 0:
-                shipping_price = 0
-
-            my_contracts.append({
-                'key': contract.get('key', ''),
-                'id': contract.get('id', ''),
-                'item_images': contract_field.get('item_images'),
-                'signed_contract_body': contract.get('signed_contract_body', ''),
-                'contract_body': contract_body,
-                'unit_price': item_price,
-                'deleted': contract.get('deleted'),
-                'shipping_price': shipping_price,
-                'item_title': contract_field.get('item_title'),
-                'item_desc': contract_field.get('item_desc'),
-                'item_condition': contract_field.get('item_condition'),
-                'item_quantity_available': contract_field.get('item_quantity'),
-                'item_remote_images': contract_field.get('item_remote_images'),
-                'item_keywords': contract_field.get('item_keywords')
-            })
+            listing = self.make_listing(contract)
+            if listing is not None:
+                my_contracts.append(listing)
 
         return {
             "contracts": my_contracts, "page": page,
-            "total_contracts": len(
-                self.db_connection.select_entries("contracts", {"deleted": "0"}))}
+            "total_contracts": self.db_connection.count_entries(
+                "contracts", {"deleted": "0"})}
+
+    def get_contracts_after(self, cursor, limit):
+        """
+        Select the contracts of the market following the one with id
+        `cursor`, in id order.
+
+        @param cursor: The id of the last contract already seen, or None
+                       to start from the first.
+        @param limit: Maximum number of contracts to select.
+        @return: The listings of the contracts, and the id of the last
+                 contract selected, or `cursor` if there are none.
+        """
+        where = {"market_id": self.market_id, "deleted": 0}
+        if cursor is not None:
+            where["id"] = {"value": cursor, "sign": ">"}
+        contracts = self.db_connection.select_entries(
+            "contracts", where, limit=limit
+        )
+
+        listings = []
+        for contract in contracts:
+            cursor = contract['id']
+            listing = self.make_listing(contract)
+            if listing is not None:
+                listings.append(listing)
+        return listings, cursor
+
+    def make_listing(self, contract):
+        """
+        Build the listing sent to the GUI and to other nodes from a row
+        of the contracts table, or return None if it is malformed.
+        """
+        try:
+            contract_body = self.contract_cache.parse(
+                u"%s" % contract['contract_body'], json.loads
+            )
+        except (KeyError, ValueError) as err:
+            self.log.error('Problem loading the contract body JSON: %s',
+                           err.message)
+            return None
+        try:
+            contract_field = contract_body['Contract']
+        except KeyError:
+            self.log.error('Contract field not found in contract_body')
+            return None
+        except TypeError:
+            self.log.error('Malformed contract_body: %s',
+                           str(contract_body))
+            return None
+        item_price = contract_field.get('item_price')
+        if item_price is None or item_price < 0:
+            item_price = 0
+        try:
+            item_delivery = contract_field['item_delivery']
+        except KeyError:
+            self.log.error('item_delivery not found in Contract field')
+            return None
+        except TypeError:
+            self.log.error('Malformed Contract field: %s',
+                           str(contract_field))
+            return None
+        shipping_price = item_delivery.get('shipping_price')
+        if shipping_price is None or shipping_price < 0:
+            shipping_price = 0
+
+        return {
+            'key': contract.get('key', ''),
+            'id': contract.get('id', ''),
+            'item_images': contract_field.get('item_images'),
+            'signed_contract_body': contract.get('signed_contract_body', ''),
+            'contract_body': contract_body,
+            'unit_price': item_price,
+            'deleted': contract.get('deleted'),
+            'shipping_price': shipping_price,
+            'item_title': contract_field.get('item_title'),
+            'item_desc': contract_field.get('item_desc'),
+            'item_condition': contract_field.get('item_condition'),
+            'item_quantity_available': contract_field.get('item_quantity'),
+            'item_remote_images': contract_field.get('item_remote_images'),
+            'item_keywords': contract_field.get('item_keywords')
+        }
 
     def undo_remove_contract(self, contract_id):
         """Restore removed contract"""
@@ -651,6 +724,12 @@ class Market(object):
             {"deleted": "0"},
             {"market_id": self.market_id, "id": contract_id}
         )
+        for contract in self.db_connection.select_entries(
+                "contracts", {"market_id": self.market_id, "id": contract_id}):
+            self.index_contract(
+                contract['key'], json.loads(contract['contract_body']),
+                contract['signed_contract_body']
+            )
 
     def save_settings(self, msg):
         """Update local settings"""
@@ -661,6 +740,8 @@ class Market(object):
             hash_value = hashlib.new('ripemd160')
             hash_value.update('notary-index')
             key = hash_value.hexdigest()
+            # Every node reads the notary index.
+            self.dht.replicate_widely(key)
 
             if msg['notary']:
                 self.log.info('Letting the network know you are now a notary')
@@ -693,6 +774,7 @@ class Market(object):
             msg,
             {'market_id': self.transport.market_id}
         )
+        self.page_envelope = None
 
     def get_settings(self):
         """Get local settings"""
@@ -748,8 +830,6 @@ class Market(object):
     def on_query_page(self, msg):
         """Return your page info if someone requests it on the network"""
         self.log.info("Someone is querying for your page")
-        settings = []
-        settings = self.get_settings()
 
         peer = self.dht.routing_table.get_contact(msg['senderGUID'])
         if not peer:
@@ -763,12 +843,21 @@ class Market(object):
                 msg['avatar_url']
             )
 
-        def send_page_query():
-            """Send a request for the local identity page"""
-
+        if peer:
             self.log.debug('Sending page')
+            peer.send_envelope(self.get_page_envelope())
+        else:
+            self.log.error('Could not find peer to send page to.')
 
-            peer.send(proto_page(
+    def get_page_envelope(self):
+        """
+        Return our page message, signed and serialized for sending to
+        any peer. It is built once and then only again after
+        save_settings() changes the settings.
+        """
+        if self.page_envelope is None:
+            settings = self.get_settings()
+            self.page_envelope = sign_message(self.transport, proto_page(
                 self.transport.uri,
                 self.transport.pubkey,
                 self.transport.guid,
@@ -785,11 +874,7 @@ class Market(object):
                 self.transport.sin,
                 settings['homepage'],
                 settings['avatar_url']))
-
-        if peer:
-            send_page_query()
-        else:
-            self.log.error('Could not find peer to send page to.')
+        return self.page_envelope
 
     def validate_on_query_myorders(self, *data):
         self.log.debug('Validating on query myorders message.')
@@ -799,6 +884,40 @@ class Market(object):
         """Run if someone is querying for your page"""
         self.log.debug("Someone is querying for your page: %s", peer)
 
+    def validate_on_query_image(self, *data):
+        self.log.debug('Validating on query image message.')
+        keys = ("senderGUID", "image_hash", "size")
+        return (all(k in data[0] for k in keys) and
+                data[0]['size'] in constants.THUMBNAIL_SIZES)
+
+    def on_query_image(self, msg):
+        """Send a thumbnail of one of our contract images to a peer"""
+        self.log.debug('Someone is querying for image %s', msg['image_hash'])
+        self.thumbnails.get(
+            msg['image_hash'], msg['size'],
+            functools.partial(
+                self.send_image, msg['senderGUID'], msg['image_hash'],
+                msg['size']
+            )
+        )
+
+    def send_image(self, guid, image_hash, size, thumbnail):
+        """Answer a query_image message, with no data if the image is unknown"""
+        self.transport.send({
+            'type': 'image',
+            'image_hash': image_hash,
+            'size': size,
+            'data': thumbnail.encode('base64') if thumbnail else None
+        }, guid)
+
+    def validate_on_image(self, *data):
+        self.log.debug('Validating on image message.')
+        keys = ("senderGUID", "image_hash", "size")
+        return all(k in data[0] for k in keys)
+
+    def on_image(self, msg):
+        self.peer_images.on_image(msg)
+
     def validate_on_inbox_message(self, *data):
         self.log.debug('Validating on inbox message.')
         return True
@@ -835,18 +954,17 @@ class Market(object):
             self.check_inbox_count()
 
     def check_inbox_count(self):
-        messages = self.db_connection.select_entries(
+        count = self.db_connection.count_entries(
             "inbox",
             {
                 "recipient_guid": self.transport.guid
-            },
-            select_fields="id"
+            }
         )
 
         if self.transport.handler:
             self.transport.handler.send_to_client(
                 None,
-                {"type": "inbox_count", "count": len(messages)}
+                {"type": "inbox_count", "count": count}
             )
 
     def validate_on_query_listing(self, *data):
@@ -874,10 +992,54 @@ class Market(object):
         return "senderGUID" in data[0]
 
     def on_query_listings(self, peer, page=0):
-        """Run if someone is querying your listings"""
+        """
+        Run if someone is querying your listings. If the query lists the
+        digests of the listings the peer already has, only the others
+        are sent, followed by a listing_sync message with the digests of
+        the ones it has which were removed.
+
+        Queries with a window are streamed, see stream_listings();
+        others get a page of listing_result messages.
+        """
         self.log.info("Someone is querying your listings: %s", peer)
+        if 'window' in peer:
+            self.stream_listings(peer)
+            return
+
+        page = peer.get('page', page)
         contracts = self.get_contracts(page, remote=True)
 
+        known = peer.get('known')
+        known_digests = set(known or [])
+        sent = 0
+        for contract in contracts['contracts']:
+            if listing_digest(contract['key']) in known_digests:
+                continue
+            contract['type'] = "listing_result"
+            self.transport.send(contract, peer['senderGUID'])
+            sent += 1
+        self.log.info('Sent %d of %d listing results',
+                      sent, len(contracts['contracts']))
+
+        if known is not None:
+            current_digests = set(
+                listing_digest(contract['key'])
+                for contract in self.db_connection.select_entries(
+                    "contracts",
+                    {"market_id": self.market_id, "deleted": 0},
+                    select_fields="key"
+                )
+            )
+            self.transport.send(
+                {
+                    "type": "listing_sync",
+                    "v": constants.VERSION,
+                    "page": page,
+                    "removed": sorted(known_digests - current_digests),
+                    "total_contracts": contracts['total_contracts']
+                },
+                peer['senderGUID'])
+
         if len(contracts['contracts']) == 0:
             self.transport.send(
                 {
@@ -885,13 +1047,80 @@ class Market(object):
                     'v': constants.VERSION
                 },
                 peer['senderGUID'])
-            return
-        else:
-            for contract in contracts['contracts']:
-                contract = contract
-                contract['type'] = "listing_result"
-                self.transport.send(contract, peer['senderGUID'])
-                self.log.info('Send listing result')
+
+    def stream_listings(self, query):
+        """
+        Send the next window of our listings to the peer querying them.
+
+        Up to query['window'] contracts following the contract id
+        query['cursor'] are sent, leaving out those whose digests are in
+        query['known'], in listing_results frames of LISTING_FRAME_SIZE
+        listings. Each frame is sent on its own IOLoop iteration, once
+        the previous one is sent, see _send_in_turn(). A
+        listing_sync message follows with the cursor the next window
+        starts after and whether there are more listings. The removed
+        listings are reported with the first window.
+        """
+        guid = query['senderGUID']
+        window = max(1, min(int(query['window']), constants.LISTING_WINDOW_MAX))
+        cursor = query.get('cursor')
+        known_digests = set(query.get('known') or [])
+
+        listings, next_cursor = self.get_contracts_after(cursor, window)
+        listings = [
+            listing for listing in listings
+            if listing_digest(listing['key']) not in known_digests
+        ]
+
+        where = {"market_id": self.market_id, "deleted": 0}
+        total_contracts = self.db_connection.count_entries("contracts", where)
+        removed = []
+        if cursor is None and known_digests:
+            current_digests = set(
+                listing_digest(contract['key'])
+                for contract in self.db_connection.select_entries(
+                    "contracts", where, select_fields="key"
+                )
+            )
+            removed = sorted(known_digests - current_digests)
+        more = False
+        if next_cursor is not None:
+            where["id"] = {"value": next_cursor, "sign": ">"}
+            more = self.db_connection.exists("contracts", where)
+
+        frame_size = constants.LISTING_FRAME_SIZE
+        messages = [
+            {
+                "type": "listing_results",
+                "v": constants.VERSION,
+                "contracts": listings[start:start + frame_size]
+            }
+            for start in range(0, len(listings), frame_size)
+        ]
+        messages.append({
+            "type": "listing_sync",
+            "v": constants.VERSION,
+            "cursor": next_cursor,
+            "more": more,
+            "removed": removed,
+            "total_contracts": total_contracts
+        })
+        if total_contracts == 0:
+            messages.append({
+                "type": "no_listing_result",
+                'v': constants.VERSION
+            })
+        self.log.info('Streaming %d listings to %s', len(listings), guid)
+        self.loop.add_callback(self._send_in_turn, messages, guid)
+
+    def _send_in_turn(self, messages, guid):
+        """
+        Send the first of `messages` to `guid`, and the others each on a
+        later IOLoop iteration, so that other work runs in between.
+        """
+        self.transport.send(messages[0], guid)
+        if len(messages) > 1:
+            self.loop.add_callback(self._send_in_turn, messages[1:], guid)
 
     def validate_on_peer(self, *data):
         self.log.debug('Validating on peer message.')
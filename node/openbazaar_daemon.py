@@ -36,6 +36,41 @@ class OpenBazaarStaticHandler(tornado.web.StaticFileHandler):
         self.set_header("X-Content-Type-Options", "nosniff")
 
 
+class ImageHandler(tornado.web.RequestHandler):
+    """
+    Serves thumbnails of contract images by image hash: ours from the
+    thumbnail cache, and those of the store given by the guid argument
+    from the peer image cache, which fetches them from the store.
+    """
+
+    def initialize(self, market):
+        # pylint: disable=arguments-differ
+        self.market = market
+
+    @tornado.web.asynchronous
+    def get(self, image_hash, size=None):
+        size = int(size) if size else constants.THUMBNAIL_SIZE
+        if size not in constants.THUMBNAIL_SIZES:
+            raise tornado.web.HTTPError(404)
+        guid = self.get_argument('guid', None)
+        if guid is None or guid == self.market.transport.guid:
+            self.market.thumbnails.get(image_hash, size, self.on_thumbnail)
+        else:
+            self.market.peer_images.get(
+                guid, image_hash, size, self.on_thumbnail
+            )
+
+    def on_thumbnail(self, thumbnail):
+        if thumbnail is None:
+            self.send_error(404)
+            return
+        # Content addressed, so the response never changes.
+        self.set_header("Content-Type", "image/png")
+        self.set_header("Cache-Control", "max-age=31536000")
+        self.set_header("X-Content-Type-Options", "nosniff")
+        self.finish(thumbnail)
+
+
 class OpenBazaarContext(object):
     """
     This Object holds all of the runtime parameters
@@ -200,6 +235,8 @@ class MarketApplication(tornado.web.Application):
             (r"/", MainHandler),
             (r"/main", MainHandler),
             (r"/html/(.*)", OpenBazaarStaticHandler, {'path': './html'}),
+            (r"/images/([0-9a-f]{64})(?:-(\d+))?\.png", ImageHandler,
+             {'market': self.market}),
             (r"/ws", WebSocketHandler,
              {
                  'transport': self.transport,
@@ -301,6 +338,7 @@ class MarketApplication(tornado.web.Application):
 
         self.cleanup_upnp_port_mapping()
         self.loop.stop()
+        self.market.thumbnails.close()
 
         self.transport.shutdown()
         self.shutdown_mutex.release()
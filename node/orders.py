@@ -14,13 +14,14 @@ from bitcoin import (
 )
 
 from decimal import Decimal
-from node import trust
 from node.multisig import Multisig
 import obelisk
 from twisted.internet import reactor
-import bitcoin
 from node import constants
-import threading
+from node.contract_cache import ContractCache, contract_digest
+from node.gpg_verifier import GPGVerifier
+from node.keychain import get_keychain
+from node.payment_poller import PaymentPoller
 
 
 
@@ -41,12 +42,28 @@ class Orders(object):
         WAITING_FOR_PAYMENT = 'Waiting for Payment'
         COMPLETED = 'Completed'
 
-    def __init__(self, transport, market_id, db_connection, gpg):
+    # Nickname of the peer whose guid is in the given orders column.
+    _NICKNAME_QUERY = (
+        "(SELECT nickname FROM peers WHERE peers.guid = orders.%s "
+        "ORDER BY peers.id LIMIT 1)"
+    )
+
+    def __init__(self, transport, market_id, db_connection, gpg,
+                 verifier=None, contract_cache=None):
         self.transport = transport
         self.market_id = market_id
         self.log = logging.getLogger('[%s] %s' % (self.market_id, self.__class__.__name__))
         self.gpg = gpg
+        self.verifier = verifier or GPGVerifier(
+            db_connection, market_id, gpg, io_loop=transport.loop
+        )
         self.db_connection = db_connection
+        if contract_cache is None:
+            contract_cache = ContractCache()
+        self.contract_cache = contract_cache
+        self.payment_poller = PaymentPoller(
+            market_id, self._on_payment_amount, io_loop=transport.loop
+        )
         self.orders = None
 
         self.transport.add_callbacks([
@@ -204,6 +221,44 @@ class Orders(object):
 
         return notary_data_json
 
+    @staticmethod
+    def parse_contract(raw_contract, state):
+        """
+        Extract the offer, buyer and notary data of a signed order
+        contract, splitting the contract only once for the bid part.
+
+        @param raw_contract: The signed contract body of the order.
+        @param state: The state of the order.
+        @return: A tuple (offer_json, buyer_json, notary_json), where
+                 notary_json is None for orders not notarized yet.
+        """
+        offer_data_json = Orders.get_offer_json(raw_contract, state)
+
+        if state in [Orders.State.NOTARIZED, Orders.State.NEED_TO_PAY]:
+            start_line = 8
+        else:
+            start_line = 6
+        offer_data = ''.join(raw_contract.split('\n')[start_line:])
+        index_of_seller_signature = offer_data.find('-----BEGIN PGP SIGNATURE-----', 0, len(offer_data))
+
+        # Find Buyer Data in Contract
+        bid_data_index = offer_data.find('"Buyer"', index_of_seller_signature, len(offer_data))
+        if state in [Orders.State.SENT]:
+            end_of_bid_index = offer_data.find('-----BEGIN PGP SIGNATURE', bid_data_index, len(offer_data))
+        else:
+            end_of_bid_index = offer_data.find('- -----BEGIN PGP SIGNATURE', bid_data_index, len(offer_data))
+        buyer_data_json = json.loads("{" + offer_data[bid_data_index:end_of_bid_index])
+
+        if state == Orders.State.SENT:
+            return offer_data_json, buyer_data_json, None
+
+        # Find Notary Data in Contract
+        notary_data_index = offer_data.find('"Notary"', end_of_bid_index, len(offer_data))
+        end_of_notary_index = offer_data.find('-----BEGIN PGP SIGNATURE', notary_data_index, len(offer_data))
+        notary_data_json = json.loads("{" + offer_data[notary_data_index:end_of_notary_index])
+
+        return offer_data_json, buyer_data_json, notary_data_json
+
     @staticmethod
     def get_qr_code(item_title, address, total):
         if isinstance(item_title, unicode):
@@ -216,21 +271,108 @@ class Orders(object):
         output.close()
         return qr_code
 
-    def get_order(self, order_id, by_buyer_id=False):
+    def get_parsed_contract(self, _order):
+        """
+        Return the sections of an order's contract, as parse_contract
+        does, parsing the contract only the first time it is seen.
+
+        Parsed sections are cached in memory and persisted in the order
+        row along with the digest of the contract they come from.
+
+        @param _order: The row of the order in the orders table.
+        """
+        raw_contract = _order['signed_contract_body']
+        digest = contract_digest(raw_contract)
+        key = (digest, _order['state'])
+
+        sections = self.contract_cache.get(key)
+        if sections is None:
+            sections = self._load_parsed_contract(_order, digest)
+            self.contract_cache.put(key, sections, len(raw_contract))
+        return sections
+
+    def _load_parsed_contract(self, _order, digest):
+        if _order.get('contract_digest') == digest and _order.get('parsed_contract'):
+            parsed = json.loads(_order['parsed_contract'])
+            if parsed['state'] == _order['state']:
+                return parsed['offer'], parsed['buyer'], parsed['notary']
+
+        offer_data_json, buyer_data_json, notary_json = self.parse_contract(
+            _order['signed_contract_body'], _order['state']
+        )
+        if offer_data_json:
+            self.db_connection.update_entries(
+                "orders",
+                {
+                    "contract_digest": digest,
+                    "parsed_contract": json.dumps({
+                        "state": _order['state'],
+                        "offer": offer_data_json,
+                        "buyer": buyer_data_json,
+                        "notary": notary_json
+                    })
+                },
+                {"id": _order['id']}
+            )
+        return offer_data_json, buyer_data_json, notary_json
+
+    def get_multisig(self, _order):
+        """
+        Return the 2-of-3 redemption script and the address of the
+        escrow of a notarized order. They are derived from the contract
+        the first time and stored on the order row.
+
+        @param _order: The row of the order in the orders table; it is
+                       updated with the script and address.
+        @return: A tuple (script, address).
+        """
+        if not _order.get('multisig_script') or not _order.get('address'):
+            offer_data_json, buyer_data_json, notary_json = self.get_parsed_contract(_order)
+            pubkeys = [
+                offer_data_json['Seller']['seller_BTC_uncompressed_pubkey'],
+                buyer_data_json['Buyer']['buyer_BTC_uncompressed_pubkey'],
+                notary_json['Notary']['notary_BTC_uncompressed_pubkey']
+            ]
+            _order['multisig_script'] = mk_multisig_script(pubkeys, 2, 3)
+            _order['address'] = scriptaddr(_order['multisig_script'])
+            self.db_connection.update_entries(
+                "orders",
+                {
+                    "multisig_script": _order['multisig_script'],
+                    "address": _order['address']
+                },
+                {"id": _order['id']}
+            )
+        return _order['multisig_script'], _order['address']
 
-        notary_fee = ""
+    def _on_payment_amount(self, order_id, total):
+        if self.transport.handler is not None:
+            self.transport.handler.send_to_client(None, {"type": "order_payment_amount",
+                                                         "order_id": order_id,
+                                                         "value": total})
+
+    def get_order(self, order_id, by_buyer_id=False):
 
         if not by_buyer_id:
             _order = self.db_connection.select_entries("orders", {"order_id": order_id})[0]
         else:
             _order = self.db_connection.select_entries("orders", {"buyer_order_id": order_id})[0]
+
+        return self._build_order(_order, order_id)
+
+    def _build_order(self, _order, order_id):
+        """
+        Build the order object sent to the client from its DB row.
+
+        @param _order: The row of the order in the orders table.
+        @param order_id: The id the order is known by to the client.
+        """
+        notary_fee = ""
         total_price = 0
 
-        offer_data_json = self.get_offer_json(_order['signed_contract_body'], _order['state'])
-        buyer_data_json = self.get_buyer_json(_order['signed_contract_body'], _order['state'])
+        offer_data_json, _, notary_json = self.get_parsed_contract(_order)
 
-        if _order['state'] != Orders.State.SENT:
-            notary_json = self.get_notary_json(_order['signed_contract_body'], _order['state'])
+        if notary_json is not None:
             notary = notary_json['Notary']['notary_GUID']
         else:
             notary = ""
@@ -244,25 +386,8 @@ class Orders(object):
                                Orders.State.SHIPPED,
                                Orders.State.COMPLETED):
 
-            def send_to_client_callback(total):
-                if self.transport.handler is not None:
-                    self.transport.handler.send_to_client(None, {"type": "order_payment_amount",
-                                                                 "order_id": order_id,
-                                                                 "value": total})
-
-            pubkeys = [
-                offer_data_json['Seller']['seller_BTC_uncompressed_pubkey'],
-                buyer_data_json['Buyer']['buyer_BTC_uncompressed_pubkey'],
-                notary_json['Notary']['notary_BTC_uncompressed_pubkey']
-            ]
-
-            script = mk_multisig_script(pubkeys, 2, 3)
-            payment_address = scriptaddr(script)
-
-            def get_unspent():
-                trust.get_unspent(payment_address, send_to_client_callback)
-
-            threading.Thread(target=get_unspent).start()
+            self.get_multisig(_order)
+            self.payment_poller.watch(order_id, _order['address'])
 
             if 'shipping_price' in _order:
                 shipping_price = _order['shipping_price'] if _order['shipping_price'] != '' else 0
@@ -310,6 +435,7 @@ class Orders(object):
                  "merchant_tx": _order.get('merchant_tx'),
                  "merchant_sigs": _order.get('merchant_sigs'),
                  "merchant_script": _order.get('merchant_script'),
+                 "multisig_script": _order.get('multisig_script'),
                  "updated": _order.get('updated')}
 
         if len(offer_data_json['Contract']['item_remote_images']):
@@ -326,103 +452,41 @@ class Orders(object):
         if not page:
             page = 0
 
-        orders = []
-
+        where = {"market_id": self.market_id}
         if merchant is None:
             if notarizations:
                 self.log.info('Retrieving notarizations')
-                order_ids = self.db_connection.select_entries(
-                    "orders",
-                    {"market_id": self.market_id},
-                    order_field="updated",
-                    order="DESC",
-                    limit=10,
-                    limit_offset=page * 10,
-                    select_fields=['order_id']
-                )
-                for result in order_ids:
-                    if result['merchant'] != self.transport.guid and result['buyer'] != self.transport.guid:
-                        order = self.get_order(result['order_id'])
-                        orders.append(order)
-                all_orders = self.db_connection.select_entries(
-                    "orders",
-                    {"market_id": self.market_id}
-                )
-                total_orders = 0
-                for order in all_orders:
-                    if order['merchant'] != self.transport.guid and order['buyer'] != self.transport.guid:
-                        total_orders += 1
-            else:
-                order_ids = self.db_connection.select_entries(
-                    "orders",
-                    {"market_id": self.market_id},
-                    order_field="updated",
-                    order="DESC",
-                    limit=10,
-                    limit_offset=page * 10,
-                    select_fields=['order_id']
-                )
-                for result in order_ids:
-                    order = self.get_order(result['order_id'])
-                    orders.append(order)
-                total_orders = len(self.db_connection.select_entries(
-                    "orders",
-                    {"market_id": self.market_id}
-                ))
+                # IS NOT, unlike <>, also matches the orders for which
+                # a party is not known yet (NULL).
+                where["merchant"] = {"sign": "IS NOT", "value": self.transport.guid}
+                where["buyer"] = {"sign": "IS NOT", "value": self.transport.guid}
+        elif merchant:
+            where["merchant"] = self.transport.guid
         else:
-            if merchant:
-                order_ids = self.db_connection.select_entries(
-                    "orders",
-                    {"market_id": self.market_id,
-                     "merchant": self.transport.guid},
-                    order_field="updated",
-                    order="DESC",
-                    limit=10,
-                    limit_offset=page * 10,
-                    select_fields=['order_id']
-                )
-                for result in order_ids:
-                    order = self.get_order(result['order_id'])
-                    orders.append(order)
+            where["buyer"] = self.transport.guid
 
-                all_orders = self.db_connection.select_entries(
-                    "orders",
-                    {"market_id": self.market_id}
-                )
-                total_orders = 0
-                for order in all_orders:
-                    if order['merchant'] == self.transport.guid:
-                        total_orders += 1
-            else:
-                order_ids = self.db_connection.select_entries(
-                    "orders",
-                    {"market_id": self.market_id},
-                    order_field="updated",
-                    order="DESC", limit=10,
-                    limit_offset=page * 10
-                )
-                for result in order_ids:
-                    if result['buyer'] == self.transport.guid:
-                        order = self.get_order(result['order_id'])
-                        orders.append(order)
-
-                all_orders = self.db_connection.select_entries(
-                    "orders",
-                    {"market_id": self.market_id}
-                )
-                total_orders = 0
-                for order in all_orders:
-                    if order['buyer'] == self.transport.guid:
-                        total_orders += 1
-
-        for order in orders:
+        # The page and the nicknames of both parties in one query.
+        rows = self.db_connection.select_entries(
+            "orders",
+            where,
+            order_field="updated",
+            order="DESC",
+            limit=10,
+            limit_offset=page * 10,
+            select_fields=[
+                "*",
+                self._NICKNAME_QUERY % "buyer" + " AS buyer_nickname",
+                self._NICKNAME_QUERY % "merchant" + " AS merchant_nickname"
+            ]
+        )
+        total_orders = self.db_connection.count_entries("orders", where)
 
-            buyer = self.db_connection.select_entries("peers", {"guid": order['buyer']})
-            if len(buyer) > 0:
-                order['buyer_nickname'] = buyer[0]['nickname']
-            merchant = self.db_connection.select_entries("peers", {"guid": order['merchant']})
-            if len(merchant) > 0:
-                order['merchant_nickname'] = merchant[0]['nickname']
+        orders = []
+        for row in rows:
+            order = self._build_order(row, row['order_id'])
+            order['buyer_nickname'] = row['buyer_nickname']
+            order['merchant_nickname'] = row['merchant_nickname']
+            orders.append(order)
 
         return {"total": total_orders, "orders": orders}
 
@@ -430,18 +494,14 @@ class Orders(object):
         # Get BIP32 child signing key for this order id
         rows = self.db_connection.select_entries("keystore", {
             'contract_id': contract_id
-        })
+        }, select_fields="id")
 
         if len(rows):
             key_id = rows[0]['id']
 
             settings = self.get_settings()
 
-            wallet = bitcoin.bip32_ckd(bitcoin.bip32_master_key(settings.get('bip32_seed')), 1)
-            wallet_chain = bitcoin.bip32_ckd(wallet, 0)
-            bip32_identity_priv = bitcoin.bip32_ckd(wallet_chain, key_id)
-            # bip32_identity_pub = bitcoin.bip32_privtopub(bip32_identity_priv)
-            return bitcoin.encode_privkey(bitcoin.bip32_extract_key(bip32_identity_priv), 'wif')
+            return get_keychain(settings.get('bip32_seed')).get_signing_key(key_id)
 
         else:
             self.log.error('No keys found for that contract id: #%s', contract_id)
@@ -500,16 +560,9 @@ class Orders(object):
 
             seller = offer_data_json['Seller']
             buyer = bid_data_json['Buyer']
-            notary = notary_data_json['Notary']
-
-            pubkeys = [
-                seller['seller_BTC_uncompressed_pubkey'],
-                buyer['buyer_BTC_uncompressed_pubkey'],
-                notary['notary_BTC_uncompressed_pubkey']
-            ]
 
-            script = mk_multisig_script(pubkeys, 2, 3)
-            multi_address = scriptaddr(script)
+            script = order['multisig_script']
+            multi_address = order['address']
 
             def callback(exc, history, order):
 
@@ -589,10 +642,11 @@ class Orders(object):
 
         new_order['address'] = self._multisig.address
 
-        if len(self.db_connection.select_entries("orders", {"order_id": new_order['id']})) > 0:
-            self.db_connection.update_entries("orders", {new_order}, {"order_id": new_order['id']})
-        else:
-            self.db_connection.insert_entry("orders", new_order)
+        with self.db_connection.transaction():
+            if self.db_connection.exists("orders", {"order_id": new_order['id']}):
+                self.db_connection.update_entries("orders", new_order, {"order_id": new_order['id']})
+            else:
+                self.db_connection.insert_entry("orders", new_order)
 
         self.transport.send(new_order, new_order['buyer'].decode('hex'))
 
@@ -631,9 +685,8 @@ class Orders(object):
         try:
             self.log.debug('%s', contract_data_json)
             seller_pgp = contract_data_json['Seller']['seller_PGP']
-            self.gpg.import_keys(seller_pgp)
 
-            if self.gpg.verify(contract):
+            if self.verifier.verify(contract, seller_pgp):
                 self.log.info('Verified Contract')
                 self.log.info(self.get_shipping_address())
                 try:
@@ -682,12 +735,13 @@ class Orders(object):
     def receive_order(self, new_order):  # action
         new_order['state'] = Orders.State.RECEIVED
 
-        order_id = random.randint(0, 1000000)
-        while len(self.db_connection.select_entries("orders", {'id': order_id})) > 0:
+        with self.db_connection.transaction():
             order_id = random.randint(0, 1000000)
+            while self.db_connection.exists("orders", {'id': order_id}):
+                order_id = random.randint(0, 1000000)
 
-        new_order['order_id'] = order_id
-        self.db_connection.insert_entry("orders", new_order)
+            new_order['order_id'] = order_id
+            self.db_connection.insert_entry("orders", new_order)
         self.transport.send(new_order, new_order['seller'].decode('hex'))
 
     def get_settings(self):
@@ -718,11 +772,8 @@ class Orders(object):
 
         settings = self.get_settings()
 
-        # Retrieve next key id from DB
-        next_key_id = len(self.db_connection.select_entries("keystore", select_fields="id")) + 1
-
-        # Store updated key in DB
-        self.db_connection.insert_entry(
+        # The id of the new keystore row is the index of the child key
+        key_id = self.db_connection.insert_entry(
             "keystore",
             {
                 'order_id': order_id
@@ -730,13 +781,7 @@ class Orders(object):
         )
 
         # Generate new child key (m/1/0/n)
-        wallet = bitcoin.bip32_ckd(bitcoin.bip32_master_key(settings.get('bip32_seed')), 1)
-        wallet_chain = bitcoin.bip32_ckd(wallet, 0)
-        bip32_identity_priv = bitcoin.bip32_ckd(wallet_chain, next_key_id)
-        bip32_identity_pub = bitcoin.bip32_privtopub(bip32_identity_priv)
-        pubkey = bitcoin.encode_pubkey(bitcoin.bip32_extract_key(bip32_identity_pub), 'hex')
-
-        return pubkey
+        return get_keychain(settings.get('bip32_seed')).get_pubkey(key_id)
 
     def new_order(self, msg):
 
@@ -744,7 +789,7 @@ class Orders(object):
 
         # Save order locally in database
         order_id = random.randint(0, 1000000)
-        while (len(self.db_connection.select_entries("orders", {"id": order_id}))) > 0:
+        while self.db_connection.exists("orders", {"id": order_id}):
             order_id = random.randint(0, 1000000)
 
         seller = self.transport.dht.routing_table.get_contact(msg['sellerGUID'])
@@ -846,7 +891,7 @@ class Orders(object):
 
         # Generate unique id for this bid
         order_id = random.randint(0, 1000000)
-        while len(self.db_connection.select_entries("contracts", {"id": order_id})) > 0:
+        while self.db_connection.exists("contracts", {"id": order_id}):
             order_id = random.randint(0, 1000000)
 
         # Add to contract and sign
@@ -858,8 +903,7 @@ class Orders(object):
         bidder_pgp_end_index = contract_stripped.find("buyer_GUID", 0, len(contract_stripped))
         bidder_pgp = contract_stripped[bidder_pgp_start_index + 13:bidder_pgp_end_index]
 
-        self.gpg.import_keys(bidder_pgp)
-        if self.gpg.verify(contract):
+        if self.verifier.verify(contract, bidder_pgp):
             self.log.info('Sellers contract verified')
 
         notary_section = {}
@@ -945,15 +989,6 @@ class Orders(object):
             bid_data_json['Buyer']['buyer_order_id']
         )
 
-        pubkeys = [
-            offer_data_json['Seller']['seller_BTC_uncompressed_pubkey'],
-            bid_data_json['Buyer']['buyer_BTC_uncompressed_pubkey'],
-            notary_pubkey
-        ]
-
-        script = mk_multisig_script(pubkeys, 2, 3)
-        multisig_address = scriptaddr(script)
-
         self.db_connection.insert_entry(
             "orders", {
                 'market_id': self.transport.market_id,
@@ -965,6 +1000,7 @@ class Orders(object):
                 'merchant': offer_data_json['Seller']['seller_GUID'],
                 'buyer': bid_data_json['Buyer']['buyer_GUID'],
                 'address': multisig_address,
+                'multisig_script': script,
                 'item_price': offer_data_json['Contract'].get('item_price', 0),
                 'shipping_price': offer_data_json['Contract']['item_delivery'].get('shipping_price', ""),
                 'note_for_merchant': bid_data_json['Buyer']['note_for_seller'],
@@ -1126,7 +1162,7 @@ class Orders(object):
             state = 'Waiting for Payment'
 
             merchant_order_id = random.randint(0, 1000000)
-            while len(self.db_connection.select_entries("orders", {"id": order_id})) > 0:
+            while self.db_connection.exists("orders", {"id": merchant_order_id}):
                 merchant_order_id = random.randint(0, 1000000)
 
             buyer_id = "%s-%s" % (
@@ -1157,6 +1193,7 @@ class Orders(object):
                     'buyer': bid_data_json['Buyer']['buyer_GUID'],
                     'notary': notary_data_json['Notary']['notary_GUID'],
                     'address': multisig_address,
+                    'multisig_script': script,
                     'shipping_address': shipping_address,
                     'item_price': offer_data_json['Contract'].get('item_price', 0),
                     'shipping_price': offer_data_json['Contract']['item_delivery'].get('shipping_price', 0),
@@ -1194,6 +1231,7 @@ class Orders(object):
                     'buyer': bid_data_json['Buyer']['buyer_GUID'],
                     'notary': notary_data_json['Notary']['notary_GUID'],
                     'address': multisig_address,
+                    'multisig_script': script,
                     'shipping_address': json.dumps(self.get_shipping_address()),
                     'item_price': offer_data_json['Contract'].get('item_price', 0),
                     'shipping_price': offer_data_json['Contract']['item_delivery'].get('shipping_price', ''),
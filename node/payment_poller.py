@@ -0,0 +1,164 @@
+"""
+Batched polling of the balances of order escrow addresses.
+
+Classes:
+    PaymentPoller -- Polls the watched addresses in one periodic batch.
+"""
+
+import logging
+import threading
+import time
+
+import bitcoin
+from tornado import ioloop
+
+from node import constants
+
+
+class PaymentPoller(object):
+    """
+    Keeps the set of escrow addresses whose orders are being viewed and
+    polls all of their balances in one batch, from a single thread,
+    every `interval` seconds.
+
+    The balance of an address is reported for each of its orders when
+    it is first known and then whenever it changes. An address stops
+    being polled when none of its orders has been watched for
+    `watch_timeout` seconds.
+    """
+
+    def __init__(self, market_id, callback, io_loop=None,
+                 interval=constants.PAYMENT_POLL_INTERVAL,
+                 watch_timeout=constants.PAYMENT_WATCH_TIMEOUT):
+        """
+        @param market_id: The id of the market, for logging purposes.
+        @type market_id: int
+
+        @param callback: Called on the IOLoop as callback(order_id, total)
+                         with the total, in satoshis, of the unspent
+                         outputs of the escrow address of the order.
+
+        @param io_loop: The IOLoop the polls are scheduled on. Defaults
+                        to the current one.
+        @type io_loop: tornado.ioloop.IOLoop
+
+        @param interval: Seconds between two polls.
+        @type interval: int
+
+        @param watch_timeout: Seconds after which an address which has
+                              not been watched is dropped.
+        @type watch_timeout: int
+        """
+        self.callback = callback
+        self.io_loop = io_loop or ioloop.IOLoop.current()
+        self.interval = interval
+        self.watch_timeout = watch_timeout
+
+        # address -> {'orders': set of order ids, 'watched': last watch
+        # time, 'total': last polled total or None}
+        self._watches = {}
+        self._lock = threading.Lock()
+        self._polling = False
+        self._poll_again = False
+        self._callback = None
+
+        self.log = logging.getLogger(
+            '[%s] %s' % (market_id, self.__class__.__name__)
+        )
+
+    def __len__(self):
+        return len(self._watches)
+
+    def start(self):
+        if self._callback is not None:
+            return
+        self._callback = ioloop.PeriodicCallback(
+            self.poll, self.interval * 1000, io_loop=self.io_loop
+        )
+        self._callback.start()
+
+    def stop(self):
+        if self._callback is not None:
+            self._callback.stop()
+            self._callback = None
+
+    def watch(self, order_id, address):
+        """
+        Report the balance of `address` for `order_id`, now if it is
+        known and on the next polls otherwise.
+
+        This may be called from any thread; the callback and the polls
+        run on the IOLoop.
+        """
+        with self._lock:
+            watch = self._watches.get(address)
+            new_address = watch is None
+            if new_address:
+                watch = self._watches[address] = {
+                    'orders': set(), 'watched': None, 'total': None
+                }
+            watch['orders'].add(order_id)
+            watch['watched'] = time.time()
+            total = watch['total']
+
+        if total is not None:
+            self.io_loop.add_callback(self.callback, order_id, total)
+
+        if self._callback is None:
+            # Nothing to poll until the first order is viewed.
+            self.io_loop.add_callback(self.start)
+        if new_address:
+            self.io_loop.add_callback(self.poll)
+
+    def poll(self):
+        """Start polling all the watched addresses, in a thread."""
+        if self._polling:
+            self._poll_again = True
+            return
+
+        expired = time.time() - self.watch_timeout
+        with self._lock:
+            for address, watch in self._watches.items():
+                if watch['watched'] < expired:
+                    del self._watches[address]
+            addresses = list(self._watches)
+        if not addresses:
+            return
+
+        self._polling = True
+        thread = threading.Thread(
+            target=self._poll_addresses, args=(addresses,)
+        )
+        thread.daemon = True
+        thread.start()
+
+    def _poll_addresses(self, addresses):
+        totals = {}
+        for address in addresses:
+            try:
+                unspent = bitcoin.unspent(address)
+            except Exception as exc:
+                self.log.debug('Error retrieving unspent outputs of %s: %s',
+                               address, exc)
+                continue
+            totals[address] = sum(tx['value'] for tx in unspent)
+        self.io_loop.add_callback(self._on_poll_done, totals)
+
+    def _on_poll_done(self, totals):
+        self._polling = False
+
+        reports = []
+        with self._lock:
+            for address, total in totals.iteritems():
+                watch = self._watches.get(address)
+                if watch is None or watch['total'] == total:
+                    continue
+                watch['total'] = total
+                reports.extend((order_id, total) for order_id in watch['orders'])
+        for order_id, total in reports:
+            self.callback(order_id, total)
+
+        self.log.debug('Polled %d addresses', len(totals))
+        if self._poll_again:
+            self._poll_again = False
+            self.poll()
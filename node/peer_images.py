@@ -0,0 +1,265 @@
+"""
+Contract images fetched by hash from the stores which sell them.
+
+Classes:
+    PeerImageCache -- Fetches thumbnails from stores and keeps the most
+                      recently used ones on disk.
+"""
+
+import binascii
+import collections
+import errno
+import logging
+import os
+import re
+import tempfile
+import urllib
+from cStringIO import StringIO
+
+from PIL import Image
+from tornado import ioloop
+
+from node import constants
+
+_HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+_GUID_RE = re.compile(r'^[0-9a-f]{40}$')
+_NAME_RE = re.compile(r'^[0-9a-f]{40}-[0-9a-f]{64}-\d+\.png$')
+
+
+def image_url(image_hash, guid=None, size=None):
+    """
+    Return the path our web server serves an image at.
+
+    @param guid: The GUID of the store the image is fetched from if we
+                 do not have it, or None for our own images.
+    @param size: The size of the thumbnail, or None for the default.
+    """
+    url = '/images/%s' % image_hash
+    if size is not None:
+        url += '-%d' % size
+    url += '.png'
+    if guid is not None:
+        url += '?' + urllib.urlencode({'guid': guid})
+    return url
+
+
+def with_image_url(contract_body, guid):
+    """
+    Return a contract for the web client, with item_images pointing at
+    the URL of the first image it references by hash, if any.
+
+    The contract is copied, not changed, since parsed contracts are
+    shared by the caches they come from.
+    """
+    if not isinstance(contract_body, dict):
+        return contract_body
+    contract = contract_body.get('Contract')
+    if not isinstance(contract, dict):
+        return contract_body
+    hashes = contract.get('item_image_hashes')
+    if not hashes or not _HASH_RE.match(str(hashes[0])):
+        return contract_body
+
+    contract_body = dict(contract_body)
+    contract_body['Contract'] = dict(contract)
+    contract_body['Contract']['item_images'] = image_url(hashes[0], guid)
+    return contract_body
+
+
+def listing_with_image_url(listing, guid):
+    """with_image_url() for a listing made by Market.make_listing()."""
+    contract_body = with_image_url(listing['contract_body'], guid)
+    if contract_body is listing['contract_body']:
+        return listing
+    listing = dict(listing)
+    listing['contract_body'] = contract_body
+    listing['item_images'] = contract_body['Contract']['item_images']
+    return listing
+
+
+class PeerImageCache(object):
+    """
+    Fetches the thumbnails of the contract images of other stores, with
+    a query_image message to the store, and keeps them in a directory
+    up to `max_bytes`, evicting the least recently used ones first.
+
+    Concurrent requests for the same thumbnail share one query. A
+    thumbnail is only kept if it is a PNG of the size asked for, sent
+    by the store it was asked from. Since a thumbnail cannot be checked
+    against the hash of the image it was rendered from, thumbnails are
+    kept per store, so that a store cannot replace those of another.
+    """
+
+    def __init__(self, transport, market_id, cache_dir, io_loop=None,
+                 max_bytes=constants.PEER_IMAGE_CACHE_MAX_BYTES,
+                 timeout=constants.PEER_IMAGE_TIMEOUT):
+        """
+        @param transport: The transport queries are sent with.
+        @type transport: node.transport.CryptoTransportLayer
+
+        @param market_id: The id of the market, for logging purposes.
+        @type market_id: int
+
+        @param cache_dir: The directory the thumbnails are kept in.
+        @type cache_dir: str
+
+        @param io_loop: The IOLoop query timeouts are scheduled on.
+                        Defaults to the current one.
+        @type io_loop: tornado.ioloop.IOLoop
+
+        @param max_bytes: Most bytes of thumbnails kept.
+        @type max_bytes: int
+
+        @param timeout: Seconds after which a query is given up on.
+        @type timeout: int
+        """
+        self.transport = transport
+        self.cache_dir = cache_dir
+        self.io_loop = io_loop or ioloop.IOLoop.current()
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+
+        # File name -> size, least recently used first. Loaded from the
+        # directory on first use.
+        self._files = None
+        self._bytes = 0
+        # (store GUID, image hash, size) -> callbacks waiting for the
+        # thumbnail
+        self._pending = {}
+
+        self.log = logging.getLogger(
+            '[%s] %s' % (market_id, self.__class__.__name__)
+        )
+
+    @property
+    def files(self):
+        if self._files is None:
+            self._files = collections.OrderedDict()
+            try:
+                names = os.listdir(self.cache_dir)
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+                names = []
+            entries = []
+            for name in names:
+                if _NAME_RE.match(name):
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                    entries.append((stat.st_mtime, name, stat.st_size))
+            for _, name, size in sorted(entries):
+                self._files[name] = size
+                self._bytes += size
+        return self._files
+
+    @staticmethod
+    def _name(guid, image_hash, size):
+        return '%s-%s-%d.png' % (guid, image_hash, size)
+
+    def get(self, guid, image_hash, size, callback):
+        """
+        Get a thumbnail, from the cache or else from the store `guid`.
+
+        @param callback: Called as callback(thumbnail), with the PNG
+                         thumbnail, or None if the store does not send
+                         it in time.
+        """
+        if not _GUID_RE.match(guid) or not _HASH_RE.match(image_hash):
+            callback(None)
+            return
+
+        name = self._name(guid, image_hash, size)
+        if name in self.files:
+            try:
+                with open(os.path.join(self.cache_dir, name), 'rb') as image_file:
+                    thumbnail = image_file.read()
+            except IOError as exc:
+                self.log.error('Cannot read cached image %s: %s', name, exc)
+                self._bytes -= self.files.pop(name)
+            else:
+                # Most recently used
+                self.files[name] = self.files.pop(name)
+                callback(thumbnail)
+                return
+
+        pending_key = (guid, image_hash, size)
+        if pending_key in self._pending:
+            self._pending[pending_key].append(callback)
+            return
+        callbacks = self._pending[pending_key] = [callback]
+
+        self.log.debug('Fetching image %s from %s', name, guid)
+        self.transport.send({
+            'type': 'query_image',
+            'image_hash': image_hash,
+            'size': size
+        }, guid)
+        self.io_loop.call_later(
+            self.timeout, self._expire, pending_key, callbacks
+        )
+
+    def on_image(self, msg):
+        """Handle the answer of a store to one of our queries."""
+        # Only the store a query was sent to can answer it.
+        pending_key = (msg.get('senderGUID'), msg['image_hash'], msg['size'])
+        if pending_key not in self._pending:
+            return
+
+        thumbnail = msg.get('data')
+        if thumbnail is not None:
+            try:
+                thumbnail = thumbnail.decode('base64')
+            except binascii.Error:
+                thumbnail = ''
+            if self._is_thumbnail(thumbnail, msg['size']):
+                self._store(self._name(*pending_key), thumbnail)
+            else:
+                self.log.warning('Invalid image %s from %s',
+                                 msg['image_hash'], msg.get('senderGUID'))
+                thumbnail = None
+        self._resolve(pending_key, thumbnail)
+
+    def _expire(self, pending_key, callbacks):
+        # Unless this query was answered and another one sent since.
+        if self._pending.get(pending_key) is callbacks:
+            self.log.debug('No answer for image %s from %s',
+                           pending_key[1], pending_key[0])
+            self._resolve(pending_key, None)
+
+    def _resolve(self, pending_key, thumbnail):
+        for callback in self._pending.pop(pending_key, ()):
+            callback(thumbnail)
+
+    @staticmethod
+    def _is_thumbnail(data, size):
+        try:
+            # Only the header is read.
+            image = Image.open(StringIO(data))
+        except IOError:
+            return False
+        return image.format == 'PNG' and image.size == (size, size)
+
+    def _store(self, name, data):
+        if len(data) > self.max_bytes:
+            return
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir, 0o700)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+        handle, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(handle, 'wb') as tmp_file:
+            tmp_file.write(data)
+        os.rename(tmp_path, os.path.join(self.cache_dir, name))
+
+        self._bytes -= self.files.pop(name, 0)
+        self.files[name] = len(data)
+        self._bytes += len(data)
+
+        while self._bytes > self.max_bytes:
+            evicted, evicted_size = self.files.popitem(last=False)
+            self._bytes -= evicted_size
+            try:
+                os.remove(os.path.join(self.cache_dir, evicted))
+            except OSError as exc:
+                self.log.error('Cannot evict image %s: %s', evicted, exc)
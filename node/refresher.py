@@ -0,0 +1,166 @@
+"""
+Paced refreshing of the DHT routing table.
+
+Classes:
+    RoutingTableRefresher -- Refreshes stale buckets with bounded lookups.
+"""
+
+import collections
+import logging
+import random
+import time
+
+from node import constants
+
+
+class RoutingTableRefresher(object):
+    """
+    Refreshes the stale buckets of the routing table by looking up a
+    random ID in each of them.
+
+    Instead of firing every lookup at once, the lookups of a refresh
+    cycle are spread at random over `spread` seconds and at most
+    `concurrency` of them are in flight at any time. A bucket which
+    ordinary traffic has touched since the cycle started is skipped.
+    """
+
+    def __init__(self, dht, market_id,
+                 concurrency=constants.REFRESH_CONCURRENCY,
+                 spread=constants.REFRESH_SPREAD,
+                 lookup_timeout=constants.REFRESH_LOOKUP_TIMEOUT):
+        """
+        @param dht: The DHT whose routing table will be refreshed.
+        @type dht: node.dht.DHT
+
+        @param market_id: The id of the market, for logging purposes.
+        @type market_id: int
+
+        @param concurrency: Maximum number of lookups in flight.
+        @type concurrency: int
+
+        @param spread: Seconds over which the lookups of a cycle
+                       are spread.
+        @type spread: int
+
+        @param lookup_timeout: Seconds after which an unfinished lookup
+                               is abandoned.
+        @type lookup_timeout: int
+        """
+        self.dht = dht
+        self.concurrency = concurrency
+        self.spread = spread
+        self.lookup_timeout = lookup_timeout
+
+        # IDs whose start time has come, waiting for a free slot.
+        self._pending = collections.deque()
+        # Lookups in flight: node_id -> [search, timeout handle]
+        self._in_flight = {}
+        self._cycle = None
+        self.last_cycle = None
+
+        self.log = logging.getLogger(
+            '[%s] %s' % (market_id, self.__class__.__name__)
+        )
+
+    @property
+    def running(self):
+        return self._cycle is not None
+
+    def refresh(self):
+        """
+        Start a refresh cycle for the buckets which are currently stale,
+        unless the previous cycle is still running.
+        """
+        if self.running:
+            self.log.info('Previous refresh cycle still running')
+            return
+
+        with self.dht._peers_lock:
+            node_ids = self.dht.routing_table.get_refresh_list(0, False)
+
+        self._cycle = {
+            'started': time.time(),
+            'buckets': len(node_ids),
+            'refreshed': 0,
+            'skipped': 0,
+            'messages': 0
+        }
+        self.log.info('Refreshing %d buckets', len(node_ids))
+
+        loop = self.dht.transport.loop
+        for node_id in node_ids:
+            loop.call_later(
+                random.uniform(0, self.spread), self._enqueue, node_id
+            )
+        self._maybe_finish()
+
+    def _enqueue(self, node_id):
+        self._pending.append(node_id)
+        self._start_lookups()
+
+    def _start_lookups(self):
+        while self._pending and len(self._in_flight) < self.concurrency:
+            node_id = self._pending.popleft()
+
+            if not self._is_stale(node_id):
+                self._cycle['skipped'] += 1
+                continue
+
+            # Registered before the lookup starts, as it may finish
+            # (and call back) right away.
+            self._in_flight[node_id] = [None, None]
+            search = self.dht.iterative_find_node(
+                node_id,
+                callback=lambda _, node_id=node_id: self._on_lookup_done(node_id)
+            )
+            lookup = self._in_flight.get(node_id)
+            if lookup is not None:
+                lookup[0] = search
+                lookup[1] = self.dht.transport.loop.call_later(
+                    self.lookup_timeout, self._on_lookup_done, node_id
+                )
+            elif search:
+                self.dht.cancel_search(search.find_id)
+
+        self._maybe_finish()
+
+    def _is_stale(self, node_id):
+        with self.dht._peers_lock:
+            try:
+                index = self.dht.routing_table.kbucket_index(node_id)
+            except (KeyError, RuntimeError):
+                # The bucket has been split since; refresh anyway.
+                return True
+            return self.dht.routing_table.buckets[index].is_stale()
+
+    def _on_lookup_done(self, node_id):
+        # The search callback may fire more than once; only the first
+        # call (or the timeout) counts.
+        lookup = self._in_flight.pop(node_id, None)
+        if lookup is None:
+            return
+
+        search, timeout = lookup
+        if timeout is not None:
+            self.dht.transport.loop.remove_timeout(timeout)
+        if search:
+            self._cycle['messages'] += search.contacted_now
+            self.dht.cancel_search(search.find_id)
+        self._cycle['refreshed'] += 1
+
+        self._start_lookups()
+
+    def _maybe_finish(self):
+        cycle = self._cycle
+        if cycle is None or self._in_flight:
+            return
+        if cycle['refreshed'] + cycle['skipped'] < cycle['buckets']:
+            return
+
+        cycle['duration'] = time.time() - cycle['started']
+        self.log.info(
+            'Refreshed %(refreshed)d buckets (%(skipped)d skipped) in '
+            '%(duration).1fs, sending %(messages)d messages', cycle
+        )
+        self.last_cycle = cycle
+        self._cycle = None
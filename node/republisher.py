@@ -0,0 +1,197 @@
+"""
+Incremental republishing of the data stored in the DHT.
+
+Classes:
+    RepublishScheduler -- Republishes/expires stored data as it falls due.
+"""
+
+import heapq
+import logging
+import time
+
+from tornado import ioloop
+
+from node import constants
+
+
+class RepublishScheduler(object):
+    """
+    Keeps a priority queue of the keys in the DHT datastore, ordered by
+    the time each of them is next due for republishing, replication or
+    expiry, and processes the due keys in bounded batches.
+
+    Each tick handles at most `batch_size` keys and at most
+    `bandwidth_budget` bytes of values, so that a large datastore is
+    republished gradually instead of in one storm.
+    """
+
+    def __init__(self, dht, market_id,
+                 tick_interval=constants.REPUBLISH_TICK_INTERVAL,
+                 batch_size=constants.REPUBLISH_BATCH_SIZE,
+                 bandwidth_budget=constants.REPUBLISH_BANDWIDTH_BUDGET):
+        """
+        @param dht: The DHT whose datastore will be republished.
+        @type dht: node.dht.DHT
+
+        @param market_id: The id of the market, for logging purposes.
+        @type market_id: int
+
+        @param tick_interval: Seconds between two batches.
+        @type tick_interval: int
+
+        @param batch_size: Maximum number of keys republished per batch.
+        @type batch_size: int
+
+        @param bandwidth_budget: Maximum number of value bytes
+                                 republished per batch.
+        @type bandwidth_budget: int
+        """
+        self.dht = dht
+        self.tick_interval = tick_interval
+        self.batch_size = batch_size
+        self.bandwidth_budget = bandwidth_budget
+
+        # Heap of (due_time, key); entries whose due time does not match
+        # self._due_times[key] are stale and skipped when popped.
+        self._queue = []
+        self._due_times = {}
+        self._republished_count = 0
+        self._callback = None
+
+        self.log = logging.getLogger(
+            '[%s] %s' % (market_id, self.__class__.__name__)
+        )
+
+    def __len__(self):
+        return len(self._due_times)
+
+    def start(self, io_loop):
+        """
+        Schedule everything in the datastore and start processing
+        batches periodically on the given IOLoop.
+        """
+        self.load()
+        self._callback = ioloop.PeriodicCallback(
+            self.tick, self.tick_interval * 1000, io_loop=io_loop
+        )
+        self._callback.start()
+
+    def stop(self):
+        if self._callback is not None:
+            self._callback.stop()
+            self._callback = None
+
+    def load(self):
+        """Schedule all the keys in the datastore, in one query."""
+        for entry in self.dht.data_store.get_metadata():
+            self.schedule(*entry)
+        self.log.info('Scheduled %d keys for republishing', len(self))
+
+    def schedule(self, key, last_published, originally_published,
+                 original_publisher_id):
+        """
+        (Re)schedule `key` according to its metadata, superseding any
+        previous schedule for it.
+        """
+        due_time = self._get_due_time(
+            last_published, originally_published, original_publisher_id
+        )
+        self._due_times[key] = due_time
+        heapq.heappush(self._queue, (due_time, key))
+
+    def _get_due_time(self, last_published, originally_published,
+                      original_publisher_id):
+        due_time = last_published + constants.REPUBLISH_INTERVAL
+        if original_publisher_id != self.dht.settings['guid']:
+            # Data we are only replicating is dropped when it expires.
+            due_time = min(
+                due_time,
+                originally_published + constants.DATE_EXPIRE_TIMEOUT
+            )
+        return due_time
+
+    def tick(self):
+        """
+        Republish, replicate or expire the keys that are due, within
+        the batch size and bandwidth budget.
+
+        @return: The number of keys republished or replicated.
+        @rtype: int
+        """
+        now = int(time.time())
+        count = 0
+        budget = self.bandwidth_budget
+
+        while self._queue and count < self.batch_size:
+            due_time, key = self._queue[0]
+            if due_time > now:
+                break
+            heapq.heappop(self._queue)
+            if self._due_times.get(key) != due_time:
+                # Superseded by a later schedule.
+                continue
+            del self._due_times[key]
+
+            entry = self.dht.data_store.get_entry(key)
+            if entry is None:
+                continue
+
+            publisher_id = entry['originalPublisherID']
+            own_data = publisher_id == self.dht.settings['guid']
+            expires = entry['originallyPublished'] + constants.DATE_EXPIRE_TIMEOUT
+
+            if not own_data and now >= expires:
+                # This key/value pair has expired and has not been
+                # republished by the original publishing node,
+                # so remove it.
+                self.log.debug('Expiring key %s', key)
+                del self.dht.data_store[key.decode('hex')]
+                continue
+
+            if now < entry['lastPublished'] + constants.REPUBLISH_INTERVAL:
+                # Stored again since it was scheduled.
+                self.schedule(
+                    key, entry['lastPublished'],
+                    entry['originallyPublished'], publisher_id
+                )
+                continue
+
+            size = len(unicode(entry['value']))
+            if size > budget and count > 0:
+                # Out of bandwidth for this batch; retry on next tick.
+                self.schedule(
+                    key, entry['lastPublished'],
+                    entry['originallyPublished'], publisher_id
+                )
+                break
+
+            if own_data:
+                # This node is the original publisher; it has to
+                # republish the data before it expires.
+                self.dht.iterative_store(key, entry['value'])
+            else:
+                # This node replicates the data until it expires,
+                # without changing the metadata associated with it.
+                self.dht.iterative_store(
+                    key, entry['value'], publisher_id,
+                    now - entry['originallyPublished']
+                )
+            self.schedule(
+                key, now, entry['originallyPublished'], publisher_id
+            )
+            budget -= size
+            count += 1
+
+        if count:
+            self._republished_count += count
+            self.log.debug('Republished %d keys, %d pending', count, len(self))
+        elif self._republished_count:
+            # A round of republishing has just finished.
+            self.log.info('Republished %d keys', self._republished_count)
+            self._republished_count = 0
+            if self.dht.transport.handler:
+                self.dht.transport.handler.send_to_client(
+                    None,
+                    {"type": "republish_notify", "msg": "P2P Data Republished"}
+                )
+        return count
@@ -6,10 +6,13 @@ Classes:
     OptimizedTreeRoutingTable -- Implementation
 """
 
+from __future__ import absolute_import
+
 from abc import ABCMeta, abstractmethod
 import logging
 import time
 
+from dht import routingtable, util
 from node import constants, guid, kbucket
 
 
@@ -213,7 +216,7 @@ class RoutingTable(object):
         pass
 
 
-class OptimizedTreeRoutingTable(RoutingTable):
+class OptimizedTreeRoutingTable(RoutingTable, routingtable.RoutingTable):
     """
     This class implements a routing table used by a Node class.
 
@@ -223,12 +226,14 @@ class OptimizedTreeRoutingTable(RoutingTable):
     covers some range of ID values, and together all of the KBuckets cover
     the entire ID space, without any overlaps.
 
-    Note: This implementation adds nodes in the tree (the KBuckets) in
-    an on-demand fashion, as described in section 2.4 of the 13-page
-    version of the Kademlia paper[1]. It also uses the contact accounting
-    optimization specified in section 4.1 of the said paper (optimized
-    node accounting without PINGs). This results in much less network
-    traffic, at the expense of some memory.
+    The heavy lifting is done by dht.routingtable.RoutingTable: KBuckets
+    are located by binary search, split on demand as described in
+    section 2.4 of the 13-page version of the Kademlia paper[1], and
+    keep a replacement cache as per the contact accounting optimization
+    of section 4.1 of the said paper (optimized node accounting without
+    PINGs). Each KBucket indexes its contacts by guid, so looking up a
+    contact does not scan the bucket. This class adapts it to the
+    interface expected by the DHT.
 
     [1]: http://pdos.csail.mit.edu/~petar/papers/maymounkov-kademlia-lncs.pdf
     """
@@ -239,20 +244,32 @@ class OptimizedTreeRoutingTable(RoutingTable):
 
         For details, see RoutingTable documentation.
         """
-        super(OptimizedTreeRoutingTable, self).__init__(
-            parent_node_id, market_id
-        )
+        RoutingTable.__init__(self, parent_node_id, market_id)
+        routingtable.RoutingTable.__init__(self, parent_node_id, market_id)
 
-        # Cache containing nodes eligible to replace stale KBucket entries
-        self.replacement_cache = {}
+    def _make_kbucket(self, range_min, range_max):
+        return kbucket.KBucket(range_min, range_max, self.market_id)
 
-        self.buckets = [
-            kbucket.KBucket(
-                range_min=0,
-                range_max=2**constants.BIT_NODE_ID_LEN,
-                market_id=market_id
-            )
-        ]
+    @property
+    def buckets(self):
+        """The list of KBuckets, ordered by the ID range they cover."""
+        return self._buckets
+
+    @buckets.setter
+    def buckets(self, value):
+        self._buckets = value
+
+    @property
+    def replacement_cache(self):
+        """
+        Contacts eligible to replace stale KBucket entries, as a dict
+        mapping the index of each KBucket to its cached contacts.
+        """
+        return dict(
+            (bucket_index, bucket.get_cached_contacts())
+            for bucket_index, bucket in enumerate(self._buckets)
+            if bucket.get_cached_contacts()
+        )
 
     def add_contact(self, contact):
         """
@@ -270,75 +287,7 @@ class OptimizedTreeRoutingTable(RoutingTable):
             self.log.info('Trying to add yourself. Leaving.')
             return
 
-        bucket_index = self.kbucket_index(contact.guid)
-        old_contact = self.buckets[bucket_index].get_contact(contact.guid)
-
-        if old_contact:
-            self.remove_contact(contact.guid)
-
-        try:
-            self.buckets[bucket_index].add_contact(contact)
-        except kbucket.BucketFull:
-            # The bucket is full; see if it can be split (by checking if
-            # its range includes the host node's id)
-            if self.buckets[bucket_index].key_in_range(self.parent_node_id):
-                self.split_bucket(bucket_index)
-                # Retry the insertion attempt
-                self.add_contact(contact)
-            else:
-                # We can't split the KBucket
-                # NOTE: This implementation follows section 4.1 of the 13
-                # page version of the Kademlia paper (optimized contact
-                # accounting without PINGs - results in much less network
-                # traffic, at the expense of some memory)
-
-                # Put the new contact in our replacement cache for the
-                # corresponding KBucket (or update it's position if it
-                # exists already)
-
-                if bucket_index not in self.replacement_cache:
-                    self.replacement_cache[bucket_index] = []
-                if contact in self.replacement_cache[bucket_index]:
-                    self.replacement_cache[bucket_index].remove(contact)
-                # TODO: Using k to limit the size of the contact
-                # replacement cache - maybe define a separate value for
-                # this in constants.py?
-                elif len(self.replacement_cache) >= constants.K:
-                    self.replacement_cache.pop(0)
-                self.replacement_cache[bucket_index].append(contact)
-        # elif old_contact.port == contact.port:
-        #     self.log.info('Remove contact')
-        #     self.remove_contact(contact.guid)
-        #
-        #     try:
-        #         self.buckets[bucket_index].add_contact(contact)
-        #     except kbucket.BucketFull:
-        #         # The bucket is full; see if it can be split (by checking
-        #         # if its range includes the host node's id)
-        #         if self.buckets[bucket_index].key_in_range(self.parent_node_id):
-        #             self.split_bucket(bucket_index)
-        #             # Retry the insertion attempt
-        #             self.add_contact(contact)
-        #         else:
-        #             # We can't split the KBucket
-        #             # NOTE: This implementation follows section 4.1 of the
-        #             # 13 page version of the Kademlia paper (optimized
-        #             # contact accounting without PINGs - results in much
-        #             # less network traffic, at the expense of some memory)
-        #
-        #             # Put the new contact in our replacement cache for the
-        #             # corresponding KBucket (or update it's position if
-        #             # it exists already)
-        #             if bucket_index not in self.replacement_cache:
-        #                 self.replacement_cache[bucket_index] = []
-        #             if contact in self.replacement_cache[bucket_index]:
-        #                 self.replacement_cache[bucket_index].remove(contact)
-        #             # TODO: Using k to limit the size of the contact
-        #             # replacement cache - maybe define a separate value
-        #             # for this in constants.py?
-        #             elif len(self.replacement_cache) >= constants.K:
-        #                 self.replacement_cache.pop(0)
-        #             self.replacement_cache[bucket_index].append(contact)
+        routingtable.RoutingTable.add_contact(self, contact)
 
     def find_close_nodes(self, key, count, node_id=None):
         """
@@ -362,38 +311,9 @@ class OptimizedTreeRoutingTable(RoutingTable):
                  node is returning all of the contacts that it knows of.
         @rtype: list
         """
-        bucket_index = self.kbucket_index(key)
-        bucket = self.buckets[bucket_index]
-        closest_nodes = bucket.get_contacts(constants.K, node_id)
-
-        # This method must return k contacts (even if we have the node with
-        # the specified key as node ID), unless there is less than k remote
-        # nodes in the routing table.
-        i = 1
-        can_go_lower = bucket_index - i >= 0
-        can_go_higher = bucket_index + i < len(self.buckets)
-        # Fill up the node list to k nodes, starting with the closest
-        # neighbouring nodes known.
-        while len(closest_nodes) < constants.K and (can_go_lower or can_go_higher):
-            # TODO: this may need to be optimized
-            if can_go_lower:
-                bucket = self.buckets[bucket_index - i]
-                closest_nodes.extend(
-                    bucket.get_contacts(
-                        constants.K - len(closest_nodes), node_id
-                    )
-                )
-                can_go_lower = bucket_index - (i + 1) >= 0
-            if can_go_higher:
-                bucket = self.buckets[bucket_index + i]
-                closest_nodes.extend(
-                    bucket.get_contacts(
-                        constants.K - len(closest_nodes), node_id
-                    )
-                )
-                can_go_higher = bucket_index + (i + 1) < len(self.buckets)
-            i += 1
-
+        closest_nodes = routingtable.RoutingTable.find_close_nodes(
+            self, self._to_guid(key), count, node_id
+        )
         self.log.datadump('Closest Nodes: %s', closest_nodes)
         return closest_nodes
 
@@ -403,8 +323,9 @@ class OptimizedTreeRoutingTable(RoutingTable):
 
         For details, see RoutingTable documentation.
         """
-        bucket_index = self.kbucket_index(node_id)
-        return self.buckets[bucket_index].get_contact(node_id)
+        return routingtable.RoutingTable.get_contact(
+            self, self._to_guid(node_id)
+        )
 
     def get_refresh_list(self, start_index=0, force=False):
         """
@@ -418,52 +339,39 @@ class OptimizedTreeRoutingTable(RoutingTable):
             # Copy the list to avoid accidental mutation.
             return list(self.buckets[start_index:])
 
-        now = int(time.time())
-        timeout = constants.REFRESH_TIMEOUT
         return [
             # Since range_min is always in the KBucket's range
             # return that as a representative.
             self.num_to_id(bucket.range_min)
             for bucket in self.buckets[start_index:]
-            if now - bucket.last_accessed >= timeout
+            if bucket.is_stale()
         ]
 
     def remove_contact(self, node_id):
         """
         Remove the node with the specified ID from the routing table.
+        The KBucket refills itself from its replacement cache.
 
         For details, see RoutingTable documentation.
         """
         bucket_index = self.kbucket_index(node_id)
         try:
             self.buckets[bucket_index].remove_contact(node_id)
+            self.version += 1
         except ValueError:
             self.log.error("Attempted to remove absent contact %s.", node_id)
-        else:
-            # Replace this stale contact with one from our replacement
-            # cache, if available.
-            try:
-                cached = self.replacement_cache[bucket_index].pop()
-            except KeyError:
-                # No replacement cache for this bucket.
-                pass
-            except IndexError:
-                # No cached contact for this bucket.
-                pass
-            else:
-                self.buckets[bucket_index].add_contact(cached)
         finally:
             self.log.datadump('Contacts: %s', self.buckets[bucket_index].contacts)
 
     def update_contact(self, contact):
         """
-        Replace existing contact with updated contact
+        Note that the details of a contact in the table (e.g. its
+        nickname or public key) have been updated in place.
 
         :param contact:
         :return:
         """
-        # bucket_index = self.kbucket_index(contact.guid)
-        # self.buckets[bucket_index].update_contact(contact)
+        self.version += 1
 
     def touch_kbucket(self, node_id, timestamp=None):
         """
@@ -494,26 +402,27 @@ class OptimizedTreeRoutingTable(RoutingTable):
         @return: The index of the KBucket responsible for the specified key
         @rtype: int
         """
-        if isinstance(node_id, guid.GUIDMixin):
-            key = node_id.guid
-        else:
-            key = node_id
-
-        # TODO: Since we are using monotonic node ID spaces,
-        # this *begs* to be done with binary search.
-        indexes = [
-            i
-            for i, bucket in enumerate(self.buckets)
-            if bucket.key_in_range(key)
-        ]
+        key = self._to_guid(node_id)
+        if not isinstance(key, basestring):
+            raise KeyError("No KBucket responsible for key %s." % key)
 
-        if not indexes:
+        try:
+            index = routingtable.RoutingTable._get_kbucket_index(self, key)
+        except util.BadGUIDError:
             raise KeyError("No KBucket responsible for key %s." % key)
-        elif len(indexes) > 1:
-            raise RuntimeError(
-                "Many KBuckets responsible for key %s." % key
-            )
-        return indexes[0]
+
+        # Since the KBuckets are sorted, any overlapping KBucket
+        # would be a neighbour of the one we found.
+        for neighbour_index in (index - 1, index + 1):
+            if 0 <= neighbour_index < len(self.buckets):
+                if self.buckets[neighbour_index].key_in_range(key):
+                    raise RuntimeError(
+                        "Many KBuckets responsible for key %s." % key
+                    )
+        return index
+
+    def _get_kbucket_index(self, node_id):
+        return self.kbucket_index(node_id)
 
     def split_bucket(self, old_bucket_index):
         """
@@ -524,21 +433,12 @@ class OptimizedTreeRoutingTable(RoutingTable):
                                  list of KBuckets)
         @type old_bucket_index: int
         """
-        # Halve the range of the current (old) KBucket.
-        old_bucket = self.buckets[old_bucket_index]
-        split_point = (old_bucket.range_max -
-                       (old_bucket.range_max - old_bucket.range_min) // 2)
-        # Create a new KBucket to cover the range split off from the old one.
-        new_bucket = kbucket.KBucket(
-            split_point, old_bucket.range_max, self.market_id
-        )
-        old_bucket.range_max = split_point
-        # Now, add the new bucket into the routing table tree
+        new_bucket = self.buckets[old_bucket_index].split_kbucket()
         self.buckets.insert(old_bucket_index + 1, new_bucket)
-        # Finally, copy all nodes that belong to the new KBucket into it...
-        for contact in old_bucket.contacts:
-            if new_bucket.key_in_range(contact.guid):
-                new_bucket.add_contact(contact)
-        # ...and remove them from the old bucket
-        for contact in new_bucket.contacts:
-            old_bucket.remove_contact(contact)
+        self.version += 1
+
+    @staticmethod
+    def _to_guid(node_id):
+        if isinstance(node_id, guid.GUIDMixin):
+            return node_id.guid
+        return node_id
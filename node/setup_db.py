@@ -5,7 +5,6 @@ from sqlite3 import dbapi2
 
 _PASSPHRASE = constants.DB_PASSPHRASE
 
-# TODO: Use indexes.
 # TODO: Maybe it makes sense to put tags on a different table
 
 _SCHEMA = (
@@ -97,6 +96,9 @@ _SCHEMA = (
             'merchant_sigs TEXT',
             'merchant_script TEXT',
             'merchant_tx TEXT',
+            'multisig_script TEXT',
+            'contract_digest TEXT',
+            'parsed_contract TEXT',
             'updated INT',
             'created INT',
             'FOREIGN KEY(market_id) REFERENCES markets(id)'
@@ -217,9 +219,55 @@ _SCHEMA = (
             'created INT',
             'received INT'
         )
+    ),
+    (
+        'verified_contracts',
+        (
+            'id INTEGER PRIMARY KEY AUTOINCREMENT',
+            'digest TEXT',
+            'fingerprint TEXT',
+            'created INT'
+        )
+    ),
+    (
+        'listings',
+        (
+            'id INTEGER PRIMARY KEY AUTOINCREMENT',
+            'key TEXT',
+            'market_id INT',
+            'guid TEXT',
+            'nickname TEXT',
+            'contract_body TEXT',
+            'signed_contract_body TEXT',
+            'updated INT',
+            'used INT'
+        )
     )
 )
 
+# Full-text indexes, see node.listing_index
+_FTS_TABLES = (
+    'CREATE VIRTUAL TABLE listings_fts USING fts4('
+    'item_title, item_keywords, item_desc, '
+    'tokenize=unicode61, prefix="2,3")',
+)
+
+_INDEXES = (
+    'CREATE INDEX orders_order_id ON orders(order_id)',
+    'CREATE INDEX orders_buyer_order_id ON orders(buyer_order_id)',
+    'CREATE INDEX orders_market_id_updated ON orders(market_id, updated)',
+    'CREATE INDEX peers_guid ON peers(guid)',
+    'CREATE INDEX peers_hostname ON peers(hostname)',
+    'CREATE INDEX contracts_market_id_deleted ON contracts(market_id, deleted)',
+    'CREATE INDEX inbox_recipient_guid ON inbox(recipient_guid)',
+    'CREATE INDEX inbox_sender_guid ON inbox(sender_guid)',
+    'CREATE INDEX keystore_contract_id ON keystore(contract_id)',
+    'CREATE UNIQUE INDEX datastore_key_market_id ON datastore(key, market_id)',
+    'CREATE UNIQUE INDEX verified_contracts_digest ON verified_contracts(digest)',
+    'CREATE UNIQUE INDEX listings_key_market_id ON listings(key, market_id)',
+    'CREATE INDEX listings_market_id_used ON listings(market_id, used)',
+)
+
 
 def setup_db(db_path, disable_sqlite_crypt=False):
     if os.path.isfile(db_path):
@@ -236,3 +284,9 @@ def setup_db(db_path, disable_sqlite_crypt=False):
 
         for table, fields in _SCHEMA:
             cur.execute('CREATE TABLE %s (%s)' % (table, ','.join(fields)))
+
+        for statement in _FTS_TABLES:
+            cur.execute(statement)
+
+        for index in _INDEXES:
+            cur.execute(index)
@@ -0,0 +1,99 @@
+"""
+Delta synchronization of the listings of a store.
+
+A node browsing a store sends the digests of the listings it already
+has; the store sends back only the listings it is missing, followed by
+the digests of those it has that were removed. Listing keys are
+derived from the signed contract, so a changed listing has a new key
+and is sent like a missing one.
+
+Classes:
+    StoreListingCache -- The listings received from each store.
+
+Functions:
+    listing_digest -- The short digest listings are reconciled by.
+"""
+
+import collections
+import json
+import threading
+
+from node import constants
+
+
+def listing_digest(key):
+    """Return the digest of a listing key exchanged in a sync."""
+    return key[:constants.LISTING_DIGEST_LENGTH]
+
+
+class StoreListingCache(object):
+    """
+    The listings this node has received from other stores, by store.
+
+    Its memory is bounded by the total JSON length of the cached
+    listings; the stores browsed least recently are evicted first.
+    """
+
+    def __init__(self, max_bytes=constants.STORE_LISTING_CACHE_MAX_BYTES):
+        """
+        @param max_bytes: Total length of the cached listings above which
+                          the least recently browsed stores are evicted.
+        @type max_bytes: int
+        """
+        self.max_bytes = max_bytes
+        # guid -> {digest: (listing, size)}, least recently used first.
+        self._stores = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._stores)
+
+    def _get_store(self, guid):
+        store = self._stores.pop(guid, None)
+        if store is None:
+            store = {}
+        self._stores[guid] = store
+        return store
+
+    def listings(self, guid):
+        """Return the cached listings of a store."""
+        with self._lock:
+            store = self._get_store(guid)
+            return [listing for listing, _ in store.itervalues()]
+
+    def known(self, guid):
+        """Return the digests of the cached listings of a store."""
+        with self._lock:
+            return sorted(self._get_store(guid))
+
+    def add(self, guid, listing):
+        """Cache a listing received from a store."""
+        size = len(json.dumps(listing))
+        with self._lock:
+            store = self._get_store(guid)
+            old = store.pop(listing_digest(listing['key']), None)
+            if old is not None:
+                self._size -= old[1]
+            store[listing_digest(listing['key'])] = (listing, size)
+            self._size += size
+
+            while self._size > self.max_bytes and len(self._stores) > 1:
+                _, evicted = self._stores.popitem(last=False)
+                self._size -= sum(size for _, size in evicted.itervalues())
+
+    def remove(self, guid, digests):
+        """
+        Drop the listings of a store with the given digests.
+
+        @return: The removed listings.
+        """
+        removed = []
+        with self._lock:
+            store = self._get_store(guid)
+            for digest in digests:
+                entry = store.pop(digest, None)
+                if entry is not None:
+                    self._size -= entry[1]
+                    removed.append(entry[0])
+        return removed
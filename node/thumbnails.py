@@ -0,0 +1,188 @@
+"""
+Content-addressed on-disk cache of contract images and their thumbnails.
+
+Classes:
+    ThumbnailCache -- Stores images by hash and renders thumbnails in a
+                      worker pool.
+"""
+
+import errno
+import hashlib
+import logging
+import os
+import re
+import tempfile
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+from PIL import Image, ImageOps
+from tornado import ioloop
+
+from node import constants
+from node.data_uri import DataURI
+
+_HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+def image_hash(data):
+    """Return the content hash an image is cached under."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def render_thumbnail(data, size):
+    """
+    Crop and scale an image to a `size` x `size` PNG.
+
+    @param data: The encoded image, in any format PIL reads.
+    @return: The encoded PNG.
+    """
+    image = Image.open(StringIO(data))
+    cropped_image = ImageOps.fit(image, (size, size), centering=(0.5, 0.5))
+    output = StringIO()
+    cropped_image.save(output, format='PNG', quality=75, optimize=True)
+    return output.getvalue()
+
+
+class ThumbnailCache(object):
+    """
+    Keeps the images of our contracts in a directory, each in a file
+    named after the SHA-256 hash of its content, so that contracts can
+    reference them by hash and an image added twice is stored once.
+
+    Thumbnails are rendered from the stored image the first time a size
+    is asked for and kept next to it. Decoding and rendering happen in
+    a pool of worker threads; results are handed back on the IOLoop.
+    """
+
+    def __init__(self, cache_dir, market_id, io_loop=None,
+                 workers=constants.THUMBNAIL_WORKERS):
+        """
+        @param cache_dir: The directory the images are kept in. It is
+                          created when the first image is added.
+        @type cache_dir: str
+
+        @param market_id: The id of the market, for logging purposes.
+        @type market_id: int
+
+        @param io_loop: The IOLoop callbacks are run on. Defaults to the
+                        current one.
+        @type io_loop: tornado.ioloop.IOLoop
+
+        @param workers: Number of worker threads.
+        @type workers: int
+        """
+        self.cache_dir = cache_dir
+        self.io_loop = io_loop or ioloop.IOLoop.current()
+        self.workers = workers
+        self._pool = None
+        self.log = logging.getLogger(
+            '[%s] %s' % (market_id, self.__class__.__name__)
+        )
+
+    def close(self):
+        """Finish the work queued and stop the worker threads."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def path(self, image_hash_, size=None):
+        """Return the file of an image, or of one of its thumbnails."""
+        if not _HASH_RE.match(image_hash_):
+            raise ValueError('Not an image hash: %r' % image_hash_)
+        if size is None:
+            return os.path.join(self.cache_dir, image_hash_)
+        return os.path.join(self.cache_dir, '%s-%d.png' % (image_hash_, size))
+
+    def add(self, image_uri, callback):
+        """
+        Store an image and render its default thumbnail, in a worker.
+
+        @param image_uri: The image as a data URI.
+        @param callback: Called on the IOLoop as callback(image_hash), or
+                         with None if the image cannot be read.
+        """
+        self._run(self._add, (image_uri,), callback, None)
+
+    def get(self, image_hash_, size, callback):
+        """
+        Get a thumbnail of a stored image, rendering it in a worker if
+        it is not cached yet.
+
+        @param size: One of constants.THUMBNAIL_SIZES.
+        @param callback: Called on the IOLoop as callback(thumbnail),
+                         with the PNG thumbnail or None if the image is
+                         not stored.
+        """
+        if size not in constants.THUMBNAIL_SIZES:
+            raise ValueError('Unsupported thumbnail size: %r' % size)
+        self._run(self.thumbnail, (image_hash_, size), callback, None)
+
+    def _run(self, func, args, callback, default):
+        if self._pool is None:
+            self._pool = ThreadPool(self.workers)
+
+        def work():
+            try:
+                result = func(*args)
+            except Exception as exc:
+                self.log.error('Image processing failed: %s', exc)
+                result = default
+            self.io_loop.add_callback(callback, result)
+
+        self._pool.apply_async(work)
+
+    def _add(self, image_uri):
+        data = DataURI(image_uri).data
+        # Fail before anything is stored if PIL cannot read the image.
+        thumbnail = render_thumbnail(data, constants.THUMBNAIL_SIZE)
+
+        image_hash_ = image_hash(data)
+        self._write(self.path(image_hash_), data)
+        self._write(self.path(image_hash_, constants.THUMBNAIL_SIZE), thumbnail)
+        self.log.debug('Stored image %s', image_hash_)
+        return image_hash_
+
+    def thumbnail(self, image_hash_, size):
+        """
+        Return a thumbnail of a stored image, rendering and storing it
+        if needed, or None if the image is not stored. This blocks; use
+        get() from the IOLoop.
+        """
+        path = self.path(image_hash_, size)
+        cached = self._read(path)
+        if cached is not None:
+            return cached
+
+        data = self._read(self.path(image_hash_))
+        if data is None:
+            return None
+        thumbnail = render_thumbnail(data, size)
+        self._write(path, thumbnail)
+        return thumbnail
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, 'rb') as image_file:
+                return image_file.read()
+        except IOError as exc:
+            if exc.errno == errno.ENOENT:
+                return None
+            raise
+
+    def _write(self, path, data):
+        if os.path.exists(path):
+            # Content addressed: the file already has this content.
+            return
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir, 0o700)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+        # Write then rename so that readers never see a partial file.
+        handle, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(handle, 'wb') as tmp_file:
+            tmp_file.write(data)
+        os.rename(tmp_path, path)
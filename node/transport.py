@@ -661,22 +661,25 @@ class CryptoTransportLayer(TransportLayer):
         self.log.debugv('Validating store value message.')
         return True
 
+    # DHT messages arrive on the listener thread; hand them over to
+    # the event loop, so that DHT state is mutated from one place and
+    # the listener can keep reading packets.
     def on_store(self, msg):
-        self.dht._on_store_value(msg)
+        self.loop.add_callback(self.dht._on_store_value, msg)
 
     def validate_on_findNode(self, msg): # pylint: disable=invalid-name
         self.log.debugv('Validating find node message.')
         return True
 
     def on_findNode(self, msg): # pylint: disable=invalid-name
-        self.dht.on_find_node(msg)
+        self.loop.add_callback(self.dht.on_find_node, msg)
 
     def validate_on_findNodeResponse(self, msg): # pylint: disable=invalid-name
         self.log.debugv('Validating find node response message.')
         return True
 
     def on_findNodeResponse(self, msg): # pylint: disable=invalid-name
-        self.dht.on_find_node_response(msg)
+        self.loop.add_callback(self.dht.on_find_node_response, msg)
 
     def _setup_settings(self):
         try:
@@ -822,7 +825,9 @@ class CryptoTransportLayer(TransportLayer):
             callback('Joined')
 
     def get_past_peers(self):
-        result = self.db_connection.select_entries("peers", {"market_id": self.market_id})
+        result = self.db_connection.select_entries(
+            "peers", {"market_id": self.market_id}, select_fields=["hostname", "port"]
+        )
         return [(peer['hostname'], peer['port']) for peer in result]
 
     def search_for_my_node(self):
@@ -945,6 +950,13 @@ class CryptoTransportLayer(TransportLayer):
                       msg_type, nickname, hostname, guid)
         self.log.datadump('Raw message: %s', json.dumps(msg, ensure_ascii=False))
         #self.dht.add_peer(uri, pubkey, guid, nickname)
+
+        # What the peer understands, see DHT.store_key_value()
+        if guid and msg.get('v'):
+            peer = self.dht.routing_table.get_contact(guid)
+            if peer is not None:
+                peer.version = msg['v']
+
         self.trigger_callbacks(msg['type'], msg)
 
     def store(self, *args, **kwargs):
@@ -959,3 +971,4 @@ class CryptoTransportLayer(TransportLayer):
     def shutdown(self):
         print "CryptoTransportLayer.shutdown()!"
         print "Notice: explicit DHT Shutdown not implemented."
+        self.dht.data_store.flush()
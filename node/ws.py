@@ -1,8 +1,8 @@
+import functools
 import threading
 import logging
 import subprocess
 import pycountry
-import gnupg
 import obelisk
 import json
 import random
@@ -10,7 +10,6 @@ import time
 import urllib2
 from bitcoin import (
     apply_multisignatures,
-    mk_multisig_script,
     mktx,
     multisign,
     scriptaddr
@@ -19,6 +18,9 @@ from tornado import iostream
 import tornado.websocket
 from twisted.internet import reactor
 from node import constants, protocol, trust
+from node.keychain import get_keychain
+from node.peer_images import listing_with_image_url, with_image_url
+from node.store_listings import StoreListingCache
 from node.backuptool import BackupTool, Backup, BackupJSONEncoder
 import bitcoin
 
@@ -31,6 +33,14 @@ class ProtocolHandler(object):
         self.transport = transport
         self.handler = handler
         self.db_connection = db_connection
+        # Shared with the market, see Market.contract_cache
+        self.contract_cache = self.market.contract_cache
+        self.store_listings = StoreListingCache()
+        # guid -> (cursor, more) of the listings streamed from a store
+        self.store_cursors = {}
+        # (keyword, next shard, number of shards) of the keyword index
+        # being searched
+        self.search_shard = None
 
         self.transport.set_websocket_handler(self)
 
@@ -42,6 +52,8 @@ class ProtocolHandler(object):
             'listing_results',
             'listing_result',
             'no_listing_result',
+            'query_listing_result',
+            'listing_sync',
             'release_funds_tx',
             'all'
         )
@@ -67,12 +79,14 @@ class ProtocolHandler(object):
             "review": self.client_review,
             "order": self.client_order,
             "search": self.client_query_network_products,
+            "search_more": self.client_query_network_products_more,
             "shout": self.client_shout,
             "get_notaries": self.client_get_notaries,
             "add_trusted_notary": self.client_add_trusted_notary,
             "add_node": self.client_add_guid,
             "remove_trusted_notary": self.client_remove_trusted_notary,
             "query_store_products": self.client_query_store_products,
+            "query_store_products_more": self.client_query_store_products_more,
             "check_order_count": self.client_check_order_count,
             "check_inbox_count": self.client_check_inbox_count,
             "query_orders": self.client_query_orders,
@@ -211,14 +225,8 @@ class ProtocolHandler(object):
             buyer = bid_data_json['Buyer']
             notary = notary_data_json['Notary']
 
-            pubkeys = [
-                seller['seller_BTC_uncompressed_pubkey'],
-                buyer['buyer_BTC_uncompressed_pubkey'],
-                notary['notary_BTC_uncompressed_pubkey']
-            ]
-
-            script = mk_multisig_script(pubkeys, 2, 3)
-            multi_address = scriptaddr(script)
+            script = order['multisig_script']
+            multi_address = order['address']
 
             def get_history_callback(escrow, history, order):
 
@@ -337,14 +345,14 @@ class ProtocolHandler(object):
 
     def validate_on_listing_results(self, *data):
         self.log.debug('Validating on listing results message.')
-        return "contracts" in data
+        return "contracts" in data[0] and "senderGUID" in data[0]
 
     def on_listing_results(self, msg):
+        """A frame of listings streamed by a store."""
         self.log.datadump('Found results %s', msg)
-        self.send_to_client(None, {
-            "type": "store_contracts",
-            "products": msg['contracts']
-        })
+        for contract in msg['contracts']:
+            contract['senderGUID'] = msg['senderGUID']
+            self.on_listing_result(contract)
 
     def validate_on_no_listing_result(self, *data):
         self.log.debug('Validating on no listing result message.')
@@ -362,11 +370,98 @@ class ProtocolHandler(object):
 
     def on_listing_result(self, msg):
         self.log.datadump('Found result %s', msg)
+        if 'contract_body' in msg:
+            msg = listing_with_image_url(msg, msg.get('senderGUID'))
+        if msg.get('senderGUID') and msg.get('key'):
+            self.store_listings.add(msg['senderGUID'], msg)
         self.send_to_client(None, {
             "type": "store_contract",
             "contract": msg
         })
 
+    def validate_on_listing_sync(self, *data):
+        self.log.debug('Validating on listing sync message.')
+        return "senderGUID" in data[0] and "removed" in data[0]
+
+    def on_listing_sync(self, msg):
+        if 'cursor' in msg:
+            self.store_cursors[msg['senderGUID']] = (
+                msg['cursor'], msg.get('more', False)
+            )
+        removed = self.store_listings.remove(msg['senderGUID'], msg['removed'])
+        self.log.debug('%d listings of %s were removed',
+                       len(removed), msg['senderGUID'])
+        if removed:
+            self.send_to_client(None, {
+                "type": "store_contracts_removed",
+                "keys": [listing['key'] for listing in removed]
+            })
+
+    def validate_on_query_listing_result(self, *data):
+        self.log.debug('Validating on query listing result message.')
+        return True
+
+    def on_query_listing_result(self, msg):
+        # The listings themselves are forwarded to the client by on_all,
+        # once this has pointed their images at our web server; they
+        # are indexed once their signature verifies.
+        for listing in msg.get('listing') or []:
+            key = listing.get('key')
+            if not key:
+                continue
+            raw_contract = listing.get('signed_contract_body')
+            contract_data_json = self.verify_listing(
+                raw_contract, functools.partial(self.index_listing, key)
+            )
+            if contract_data_json is not None:
+                listing['contract_body'] = json.dumps(with_image_url(
+                    contract_data_json,
+                    contract_data_json['Seller'].get('seller_GUID')
+                ))
+
+    def verify_listing(self, raw_contract, callback):
+        """
+        Verify the signature of a listing in the background.
+
+        @param callback: Called as callback(raw_contract,
+                         contract_data_json) if the signature verifies.
+        @return: The parsed JSON of the listing, or None if it can not
+                 be parsed.
+        """
+        try:
+            contract_data_json = self.contract_cache.parse(
+                raw_contract, self.get_listing_json
+            )
+            seller_pubkey = contract_data_json['Seller']['seller_PGP']
+        except Exception:
+            self.log.debug('Error getting JSON contract')
+            return None
+
+        def on_verified(fingerprint):
+            if not fingerprint:
+                self.log.error('Could not verify signature of contract.')
+                return
+            callback(raw_contract, contract_data_json)
+
+        self.market.verifier.verify_async(
+            raw_contract, seller_pubkey, on_verified
+        )
+        return contract_data_json
+
+    def index_listing(self, key, raw_contract, contract_data_json):
+        """Add a verified network listing to the local search index."""
+        contract_guid = contract_data_json['Seller'].get('seller_GUID')
+        self.market.listing_index.add(
+            key, contract_data_json, raw_contract, contract_guid,
+            self.get_nickname(contract_guid)
+        )
+
+    def get_nickname(self, guid):
+        if guid == self.transport.guid:
+            return self.transport.nickname
+        peer = self.transport.dht.routing_table.get_contact(guid)
+        return peer.nickname if peer is not None else ""
+
     def client_stop_server(self, socket_handler, msg):
         self.log.error('Killing OpenBazaar')
         self.market_application.shutdown()
@@ -425,18 +520,17 @@ class ProtocolHandler(object):
 
     def client_check_order_count(self, socket_handler, msg):
         self.log.debug('Checking order count')
-        orders = self.db_connection.select_entries(
+        count = self.db_connection.count_entries(
             "orders",
             {
                 "market_id": self.transport.market_id,
                 "state": "Waiting for Payment"
-            },
-            select_fields="order_id"
+            }
         )
 
         self.send_to_client(
             None,
-            {"type": "order_count", "count": len(orders)}
+            {"type": "order_count", "count": count}
         )
 
     def client_check_inbox_count(self, socket_handler, msg):
@@ -496,6 +590,10 @@ class ProtocolHandler(object):
 
         page = msg['page'] if 'page' in msg else 0
         contracts = self.market.get_contracts(page)
+        contracts['contracts'] = [
+            listing_with_image_url(listing, None)
+            for listing in contracts['contracts']
+        ]
 
         self.send_to_client(None, {
             "type": "contracts",
@@ -563,13 +661,28 @@ class ProtocolHandler(object):
 
     def client_create_contract(self, socket_handler, contract):
         self.log.datadump('New Contract: %s', contract)
-        self.market.save_contract(contract)
+        self.market.save_contract(contract, callback=self.on_contract_saved)
 
     def client_update_contract(self, socket_handler, msg):
         contract_id = msg.get('contract_id')
         contract = msg.get('contract')
         self.log.datadump('New Contract: %s', contract)
-        self.market.save_contract(contract, contract_id)
+        self.market.save_contract(
+            contract, contract_id, callback=self.on_contract_saved
+        )
+
+    def on_contract_saved(self, error):
+        # Contracts with an image are stored after the client has asked
+        # for the list of contracts, so send it again once they are.
+        if error is None:
+            self.client_query_contracts(None, {})
+            return
+        self.send_to_client(None, {
+            'type': 'save_contract_result',
+            'result': 'failure',
+            'detail': error,
+            'v': constants.VERSION
+        })
 
     def client_remove_contract(self, socket_handler, msg):
         self.log.info("Remove contract: %s", msg)
@@ -640,18 +753,10 @@ class ProtocolHandler(object):
                 'tcp://%s' % self.transport.settings['obelisk']
             )
 
-            seller = offer_data_json['Seller']
             buyer = bid_data_json['Buyer']
-            notary = notary_data_json['Notary']
-
-            pubkeys = [
-                seller['seller_BTC_uncompressed_pubkey'],
-                buyer['buyer_BTC_uncompressed_pubkey'],
-                notary['notary_BTC_uncompressed_pubkey']
-            ]
 
-            script = mk_multisig_script(pubkeys, 2, 3)
-            multi_address = scriptaddr(script)
+            script = order['multisig_script']
+            multi_address = order['address']
 
             def get_history_callback(escrow, history, order):
 
@@ -704,18 +809,14 @@ class ProtocolHandler(object):
         # Get BIP32 child signing key for this order id
         rows = self.db_connection.select_entries("keystore", {
             'order_id': order_id
-        })
+        }, select_fields="id")
 
         if len(rows):
             key_id = rows[0]['id']
 
             settings = self.transport.settings
 
-            wallet = bitcoin.bip32_ckd(bitcoin.bip32_master_key(settings.get('bip32_seed')), 1)
-            wallet_chain = bitcoin.bip32_ckd(wallet, 0)
-            bip32_identity_priv = bitcoin.bip32_ckd(wallet_chain, key_id)
-            # bip32_identity_pub = bitcoin.bip32_privtopub(bip32_identity_priv)
-            return bitcoin.encode_privkey(bitcoin.bip32_extract_key(bip32_identity_priv), 'wif')
+            return get_keychain(settings.get('bip32_seed')).get_signing_key(key_id)
 
         else:
             self.log.error('No keys found for that contract id: #%s', order_id)
@@ -725,18 +826,14 @@ class ProtocolHandler(object):
         # Get BIP32 child signing key for this order id
         rows = self.db_connection.select_entries("keystore", {
             'contract_id': contract_id
-        })
+        }, select_fields="id")
 
         if len(rows):
             key_id = rows[0]['id']
 
             settings = self.transport.settings
 
-            wallet = bitcoin.bip32_ckd(bitcoin.bip32_master_key(settings.get('bip32_seed')), 1)
-            wallet_chain = bitcoin.bip32_ckd(wallet, 0)
-            bip32_identity_priv = bitcoin.bip32_ckd(wallet_chain, key_id)
-            # bip32_identity_pub = bitcoin.bip32_privtopub(bip32_identity_priv)
-            return bitcoin.encode_privkey(bitcoin.bip32_extract_key(bip32_identity_priv), 'wif')
+            return get_keychain(settings.get('bip32_seed')).get_signing_key(key_id)
 
         else:
             self.log.error('No keys found for that contract id: #%s', contract_id)
@@ -786,19 +883,8 @@ class ProtocolHandler(object):
                 'tcp://%s' % self.transport.settings['obelisk']
             )
 
-            seller = offer_data_json['Seller']
-            buyer = bid_data_json['Buyer']
-            notary = notary_data_json['Notary']
-
-            pubkeys = [
-                seller['seller_BTC_uncompressed_pubkey'],
-                buyer['buyer_BTC_uncompressed_pubkey'],
-                notary['notary_BTC_uncompressed_pubkey']
-            ]
-            self.log.debug('Pubkeys: %s', pubkeys)
-
-            script = mk_multisig_script(pubkeys, 2, 3)
-            multi_address = scriptaddr(script)
+            script = order['multisig_script']
+            multi_address = order['address']
 
             def get_history_callback(escrow, history, order):
 
@@ -1035,17 +1121,86 @@ class ProtocolHandler(object):
 
         self.log.info("Querying for Contracts %s", msg)
 
+        # Answer from the local index at once; the network lookup below
+        # then refreshes it with any listings we have not seen yet.
+        listings = self.market.listing_index.search(msg['key'])
+        for listing in listings:
+            self.send_to_client(None, {
+                "type": "query_listing_result",
+                "listing": [{
+                    "key": listing['key'],
+                    "contract_body": json.dumps(with_image_url(
+                        listing['contract_body'], listing['guid']
+                    )),
+                    "signed_contract_body": listing['signed_contract_body']
+                }]
+            })
+        self.log.debug('Found %d listings locally', len(listings))
+
+        # The other shards of the keyword index are looked up as the GUI
+        # scrolls, see client_query_network_products_more().
+        keyword = msg['key'].upper()
+        self.search_shard = (keyword, 1, constants.KEYWORD_INDEX_SHARDS)
         self.transport.dht.find_listings_by_keyword(
-            msg['key'].upper(),
-            callback=self.on_find_products
+            keyword, callback=functools.partial(self.on_find_search_shard, keyword),
+            shard=0
         )
 
+    def client_query_network_products_more(self, socket_handler, msg):
+        """Look up the next shard of the keyword index being searched."""
+        keyword = msg['key'].upper()
+        if self.search_shard is None or self.search_shard[0] != keyword:
+            return
+        _, shard, shards = self.search_shard
+        if shard >= shards:
+            return
+        self.search_shard = (keyword, shard + 1, shards)
+        self.transport.dht.find_listings_by_keyword(
+            keyword, callback=functools.partial(self.on_find_search_shard, keyword),
+            shard=shard
+        )
+
+    def on_find_search_shard(self, keyword, results):
+        """
+        Note the overflow shards a shard of the index being searched
+        reports, so that they are paged through too, then show its
+        listings.
+        """
+        if isinstance(results, dict) and self.search_shard is not None:
+            searched, shard, shards = self.search_shard
+            found_shards = results.get('shards')
+            if searched == keyword and isinstance(found_shards, int):
+                found_shards = min(found_shards, constants.KEYWORD_INDEX_MAX_SHARDS)
+                self.search_shard = (keyword, shard, max(shards, found_shards))
+        self.on_find_products(results)
+
     def client_query_store_products(self, socket_handler, msg):
         self.log.info("Searching network for contracts")
 
+        # Show the listings we have at once; the store then sends only
+        # the ones we are missing.
+        for listing in self.store_listings.listings(msg['key']):
+            self.send_to_client(None, {
+                "type": "store_contract",
+                "contract": listing
+            })
+
+        self.store_cursors.pop(msg['key'], None)
+        self.query_store_window(msg['key'], None)
+
+    def client_query_store_products_more(self, socket_handler, msg):
+        """Get the next window of listings of a store, as the GUI scrolls."""
+        cursor, more = self.store_cursors.get(msg['key'], (None, False))
+        if more:
+            self.query_store_window(msg['key'], cursor)
+
+    def query_store_window(self, guid, cursor):
         self.transport.dht.find_listings(
-            msg['key'],
-            callback=self.on_find_products_by_store
+            guid,
+            callback=self.on_find_products_by_store,
+            known=self.store_listings.known(guid),
+            cursor=cursor,
+            window=constants.LISTING_WINDOW
         )
 
     def client_create_backup(self, socket_handler, msg):
@@ -1175,95 +1330,85 @@ class ProtocolHandler(object):
         msg['avatar_url'] = self.transport.avatar_url
         self.transport.send(protocol.shout(msg))
 
-    def on_node_search_value(self, results, key):
-
-        self.log.debug('Listing Data: %s %s', results, key)
-
-        # Import gpg pubkey
-        gpg = gnupg.GPG()
-
-        # Retrieve JSON from the contract
-        # 1) Remove PGP Header
-        contract_data = ''.join(results.split('\n')[3:])
+    @staticmethod
+    def get_listing_json(raw_contract):
+        """Extract the JSON of a signed listing contract."""
+        # Remove PGP Header
+        contract_data = ''.join(raw_contract.split('\n')[3:])
         index_of_signature = contract_data.find(
             '-----BEGIN PGP SIGNATURE-----', 0, len(contract_data)
         )
-        contract_data_json = contract_data[0:index_of_signature]
+        return json.loads(contract_data[0:index_of_signature])
+
+    def on_node_search_value(self, results, key):
+
+        self.log.debug('Listing Data: %s %s', results, key)
 
         try:
-            contract_data_json = json.loads(contract_data_json)
+            contract_data_json = self.contract_cache.parse(
+                results, self.get_listing_json
+            )
             seller = contract_data_json.get('Seller')
             seller_pubkey = seller.get('seller_PGP')
+        except Exception:
+            self.log.debug('Error getting JSON contract')
+            return
 
-            gpg.import_keys(seller_pubkey)
-
-            if gpg.verify(results):
-                self.send_to_client(None, {
-                    "type": "new_listing",
-                    "data": contract_data_json,
-                    "key": key,
-                    "rawContract": results
-                })
-            else:
-
+        def on_verified(fingerprint):
+            if not fingerprint:
                 self.log.error('Could not verify signature of contract.')
+                return
 
-        except Exception:
-            self.log.debug('Error getting JSON contract')
+            self.index_listing(key, results, contract_data_json)
+            self.send_to_client(None, {
+                "type": "new_listing",
+                "data": with_image_url(
+                    contract_data_json, seller.get('seller_GUID')
+                ),
+                "key": key,
+                "rawContract": results
+            })
+
+        self.market.verifier.verify_async(results, seller_pubkey, on_verified)
 
     def on_global_search_value(self, results, key):
 
         self.log.info('global search: %s %s', results, key)
-        if results and not isinstance(results, list):
-            self.log.debug('Listing Data: %s %s', results, key)
+        if not results or isinstance(results, list):
+            self.log.info('No results')
+            return
 
-            # Import gpg pubkey
-            gpg = gnupg.GPG()
+        self.log.debug('Listing Data: %s %s', results, key)
 
-            # Retrieve JSON from the contract
-            # 1) Remove PGP Header
-            contract_data = ''.join(results.split('\n')[3:])
-            index_of_signature = contract_data.find(
-                '-----BEGIN PGP SIGNATURE-----', 0, len(contract_data)
+        try:
+            contract_data_json = self.contract_cache.parse(
+                results, self.get_listing_json
             )
-            contract_data_json = contract_data[0:index_of_signature]
-
-            try:
-                contract_data_json = json.loads(contract_data_json)
-                seller_pubkey = contract_data_json.get(
-                    'Seller'
-                ).get(
-                    'seller_PGP'
-                )
-
-                gpg.import_keys(seller_pubkey)
-
-                if gpg.verify(results):
+            seller = contract_data_json.get('Seller')
+            seller_pubkey = seller.get('seller_PGP')
+        except Exception:
+            self.log.debug('Error getting JSON contract')
+            return
 
-                    seller = contract_data_json.get('Seller')
-                    contract_guid = seller.get('seller_GUID')
+        def on_verified(fingerprint):
+            if not fingerprint:
+                self.log.error('Could not verify signature of contract.')
+                return
 
-                    if contract_guid == self.transport.guid:
-                        nickname = self.transport.nickname
-                    else:
-                        routing_table = self.transport.dht.routing_table
-                        peer = routing_table.get_contact(contract_guid)
-                        nickname = peer.nickname if peer is not None else ""
+            nickname = self.get_nickname(seller.get('seller_GUID'))
+            self.index_listing(key, results, contract_data_json)
 
-                    self.send_to_client(None, {
-                        "type": "global_search_result",
-                        "data": contract_data_json,
-                        "key": key,
-                        "rawContract": results,
-                        "nickname": nickname
-                    })
-                else:
-                    self.log.error('Could not verify signature of contract.')
+            self.send_to_client(None, {
+                "type": "global_search_result",
+                "data": with_image_url(
+                    contract_data_json, seller.get('seller_GUID')
+                ),
+                "key": key,
+                "rawContract": results,
+                "nickname": nickname
+            })
 
-            except Exception:
-                self.log.debug('Error getting JSON contract')
-        else:
-            self.log.info('No results')
+        self.market.verifier.verify_async(results, seller_pubkey, on_verified)
 
     def on_node_search_results(self, results):
         if len(results) > 1:
@@ -1315,7 +1460,9 @@ class ProtocolHandler(object):
     def on_all(self, *args):
         first = args[0]
         if isinstance(first, dict):
-            self.send_to_client(None, first)
+            # Images are served to the client over HTTP.
+            if first.get('type') not in ('query_image', 'image'):
+                self.send_to_client(None, first)
             peer = self.transport.dht.routing_table.get_contact(first.get('senderGUID'))
             if peer:
                 peer.reachable = True
@@ -258,6 +258,19 @@ class TestKBucket(unittest.TestCase):
 
         return new_bucket
 
+    def test_get_contact_after_split(self):
+        bucket = self._make_split_kbucket()
+        all_contacts = bucket.get_contacts()
+        new_bucket = bucket.split_kbucket()
+
+        for s_contact in all_contacts:
+            if bucket.contact_in_range(s_contact):
+                self.assertEqual(bucket.get_contact(s_contact.guid), s_contact)
+                self.assertIsNone(new_bucket.get_contact(s_contact.guid))
+            else:
+                self.assertIsNone(bucket.get_contact(s_contact.guid))
+                self.assertEqual(new_bucket.get_contact(s_contact.guid), s_contact)
+
     def test_contact_in_range(self):
         range_min, range_max = 2, 16
         bucket = self.kbucket_class(range_min, range_max)
@@ -177,6 +177,36 @@ class TestRoutingTable(unittest.TestCase):
         except Exception:
             self.fail('RoutingTable crashed on removing absent contact.')
 
+    def test_version(self):
+        version = self.rt.version
+        new_contact = self._make_contact_from_num(self.range_max - 1)
+        self.rt.add_contact(new_contact)
+        self.assertGreater(self.rt.version, version)
+
+        version = self.rt.version
+        self.rt.get_contact(new_contact.guid)
+        self.rt.find_close_nodes(new_contact.guid)
+        self.assertEqual(self.rt.version, version)
+
+        # Seeing a contact again, or caching one, changes nothing.
+        self.rt.add_contact(new_contact)
+        self.assertEqual(self.rt.version, version)
+
+        self.rt.remove_guid(new_contact.guid)
+        self.assertGreater(self.rt.version, version)
+
+        version = self.rt.version
+        self.rt.remove_guid(new_contact.guid)
+        self.rt.remove_contact(new_contact)
+        self.assertEqual(self.rt.version, version)
+
+    def test_version_on_replaced_contact(self):
+        new_contact = self._make_contact_from_num(self.range_max - 1)
+        self.rt.add_contact(new_contact)
+        version = self.rt.version
+        self.rt.add_contact(self._make_contact_from_num(self.range_max - 1))
+        self.assertGreater(self.rt.version, version)
+
     def _make_rt_with_n_buckets(self, n):
         rt = routingtable.RoutingTable(self.own_guid, 42)
         # Fill the first Kbucket and cause it to split. Since all
@@ -1,5 +1,8 @@
+import json
 import unittest
 
+import mock
+
 from node import connection, guid, transport
 from tests import test_transport
 import socket
@@ -202,5 +205,40 @@ class TestCryptoPeerConnection(TestPeerConnection):
         self.assertTrue(connection.CryptoPeerListener.validate_signature(signature, data))
         self.assertFalse(connection.CryptoPeerListener.validate_signature(bad_signature, data))
 
+    def test_send_envelope(self):
+        with mock.patch.object(self.pc2, 'encrypt', return_value='secret'), \
+                mock.patch.object(self.pc2, 'send_raw') as send_raw:
+            self.pc2.send_envelope('envelope')
+            self.pc2.encrypt.assert_called_once_with('envelope')
+            send_raw.assert_called_once_with('secret', None)
+
+            # Without the public key of the peer nothing can be sent.
+            self.pc1.send_envelope('envelope')
+            self.assertEqual(send_raw.call_count, 1)
+
+
+class TestSignMessage(unittest.TestCase):
+
+    def test_sign_message(self):
+        ob_transport = mock.Mock()
+        ob_transport.guid = 'guid'
+        ob_transport.pubkey = 'pubkey'
+        ob_transport.nickname = 'nickname'
+        ob_transport.settings = {'avatar_url': 'avatar'}
+        ob_transport.namecoin_id = None
+        ob_transport.cryptor.sign.return_value = 'signature'
+
+        envelope = json.loads(
+            connection.sign_message(ob_transport, {'type': 'page'})
+        )
+        data = json.loads(envelope['data'].decode('hex'))
+        self.assertEqual(data['type'], 'page')
+        self.assertEqual(data['senderGUID'], 'guid')
+        self.assertEqual(data['pubkey'], 'pubkey')
+        self.assertEqual(data['avatar_url'], 'avatar')
+        self.assertNotIn('guid', data)
+        self.assertEqual(envelope['sig'], 'signature'.encode('hex'))
+        ob_transport.cryptor.sign.assert_called_once_with(envelope['data'])
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+
+import mock
+
+from node import contract_cache
+
+
+class TestContractCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = contract_cache.ContractCache(max_bytes=10)
+
+    def test_contract_digest(self):
+        self.assertEqual(
+            contract_cache.contract_digest(u'contract'),
+            contract_cache.contract_digest('contract')
+        )
+        self.assertNotEqual(
+            contract_cache.contract_digest('contract'),
+            contract_cache.contract_digest('contract2')
+        )
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.put('a', 1, 4)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_memory_bound(self):
+        self.cache.put('a', 1, 4)
+        self.cache.put('b', 2, 4)
+        # 'a' becomes the most recently used.
+        self.cache.get('a')
+        self.cache.put('c', 3, 4)
+        self.assertEqual(len(self.cache), 2)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+
+        # A contract larger than the bound is still cached, alone.
+        self.cache.put('d', 4, 20)
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.get('d'), 4)
+
+    def test_put_replaces(self):
+        self.cache.put('a', 1, 8)
+        self.cache.put('a', 2, 8)
+        self.assertEqual(self.cache.get('a'), 2)
+        self.assertEqual(self.cache._size, 8)
+
+    def test_parse(self):
+        parser = mock.Mock(return_value={'parsed': True})
+        for _ in range(2):
+            self.assertEqual(
+                self.cache.parse('raw', parser, 'state'), {'parsed': True}
+            )
+        parser.assert_called_once_with('raw', 'state')
+
+        # Parsed again for other arguments, or by another parser.
+        self.cache.parse('raw', parser, 'other state')
+        self.assertEqual(parser.call_count, 2)
+        other_parser = mock.Mock(return_value={'other': True})
+        self.assertEqual(
+            self.cache.parse('raw', other_parser, 'state'), {'other': True}
+        )
+
+    def test_parse_error_not_cached(self):
+        parser = mock.Mock(side_effect=ValueError)
+        for _ in range(2):
+            self.assertRaises(ValueError, self.cache.parse, 'raw', parser)
+        self.assertEqual(parser.call_count, 2)
+        self.assertEqual(len(self.cache), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,12 @@
+import os
+import shutil
+import tempfile
 import unittest
 import UserDict
 
 import mock
 
-from node import datastore, db_store
+from node import datastore, db_store, setup_db
 
 
 class TestSqliteDatastore(unittest.TestCase):
@@ -15,7 +18,7 @@ class TestSqliteDatastore(unittest.TestCase):
                 {'key': 'CH'.encode('hex')}
                 ]
         }
-        self.db_mock.select_entries.side_effect = data.__getitem__
+        self.db_mock.iter_entries.side_effect = lambda table, **kwargs: iter(data[table])
         self.sqlite_datastore = datastore.SqliteDataStore(self.db_mock)
 
     def test_init(self):
@@ -39,3 +42,97 @@ class TestSqliteDatastore(unittest.TestCase):
 
     def test_set_item(self):
         pass
+
+
+class TestBulkSqliteDatastore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        db_path = os.path.join(self.directory, 'test.db')
+        setup_db.setup_db(db_path, disable_sqlite_crypt=True)
+        self.db = db_store.Obdb(db_path, disable_sqlite_crypt=True)
+        self.io_loop = mock.Mock()
+        self.data_store = datastore.BulkSqliteDataStore(
+            self.db, io_loop=self.io_loop, market_id=1, batch_size=3
+        )
+
+    def tearDown(self):
+        self.data_store.close()
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+    def _set_item(self, key, value, market_id=1):
+        self.data_store.set_item(
+            key.encode('hex'), value, 10, 5, 'a' * 40, market_id=market_id
+        )
+
+    def _count_rows(self):
+        return self.db.count_entries('datastore')
+
+    def test_store_is_buffered(self):
+        self._set_item('Zurich', 'value')
+        self.assertEqual(self._count_rows(), 0)
+        self.assertEqual(self.io_loop.call_later.call_count, 1)
+
+        # Buffered stores are visible to reads.
+        self.assertEqual(self.data_store['Zurich'.encode('hex')], 'value')
+        entry = self.data_store.get_entry('Zurich'.encode('hex'))
+        self.assertEqual(entry['lastPublished'], 10)
+        self.assertEqual(entry['originallyPublished'], 5)
+
+        self.data_store.flush()
+        self.assertEqual(self._count_rows(), 1)
+        self.assertEqual(self.data_store['Zurich'.encode('hex')], 'value')
+
+    def test_flush_on_batch_size(self):
+        for key in ('Zurich', 'Geneva', 'Bern'):
+            self._set_item(key, 'value')
+        self.assertEqual(self._count_rows(), 3)
+        self.assertEqual(self.io_loop.remove_timeout.call_count, 1)
+
+    def test_upsert(self):
+        self._set_item('Zurich', 'old')
+        self.data_store.flush()
+        self._set_item('Zurich', 'new')
+        self._set_item('Zurich', 'new', market_id=2)
+        self.data_store.flush()
+        self.assertEqual(self._count_rows(), 2)
+        self.assertEqual(self.data_store['Zurich'.encode('hex')], 'new')
+
+    def test_read_own_market(self):
+        self._set_item('Zurich', 'own')
+        self._set_item('Zurich', 'other', market_id=2)
+        self.assertEqual(self.data_store['Zurich'.encode('hex')], 'own')
+        self.data_store.flush()
+        self.assertEqual(self.data_store['Zurich'.encode('hex')], 'own')
+
+    def test_failed_flush_kept(self):
+        self._set_item('Zurich', 'value')
+        with mock.patch.object(self.data_store, '_get_connection') as con:
+            con = con.return_value.__enter__.return_value
+            con.executemany.side_effect = datastore.dbapi2.OperationalError()
+            self.data_store.flush()
+        self.assertEqual(self._count_rows(), 0)
+        self.assertEqual(self.data_store['Zurich'.encode('hex')], 'value')
+
+        self.data_store.flush()
+        self.assertEqual(self._count_rows(), 1)
+
+    def test_keys_and_metadata(self):
+        self._set_item('Zurich', 'value')
+        self._set_item('CH', 'value')
+        self.assertEqual(sorted(self.data_store.keys()), ['CH', 'Zurich'])
+        self.assertEqual(
+            sorted(self.data_store.get_metadata()),
+            [('CH'.encode('hex'), 10, 5, 'a' * 40),
+             ('Zurich'.encode('hex'), 10, 5, 'a' * 40)]
+        )
+
+    def test_delitem(self):
+        self._set_item('Zurich', 'value')
+        self.data_store.flush()
+        self._set_item('CH', 'value')
+        del self.data_store['Zurich']
+        del self.data_store['CH']
+        self.data_store.flush()
+        self.assertEqual(self._count_rows(), 0)
+        self.assertIsNone(self.data_store.get_entry('CH'.encode('hex')))
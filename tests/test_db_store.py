@@ -2,6 +2,8 @@ import os
 import tempfile
 import unittest
 
+import mock
+
 from node import db_store, setup_db
 
 
@@ -38,6 +40,9 @@ class TestDbOperations(unittest.TestCase):
             disable_sqlite_crypt=self.disable_sqlite_crypt
         )
 
+    def tearDown(self):
+        self.obdb.close()
+
     def test_insert_select_operations(self):
         # Create a dictionary of a random review
         review_to_store = {"pubKey": "123",
@@ -160,6 +165,140 @@ class TestDbOperations(unittest.TestCase):
         # Test that the rating has been updated succesfully
         self.assertEqual(retrieved_review["rating"], 9)
 
+    def test_select_fields(self):
+        self.obdb.insert_entry("reviews", {"pubKey": "456", "rating": 5})
+        retrieved_review = self.obdb.select_entries(
+            "reviews", {"pubkey": "456"}, select_fields=["pubKey", "rating"]
+        )[0]
+        self.assertEqual(retrieved_review, {"pubKey": "456", "rating": 5})
+
+        retrieved_review = self.obdb.select_entries(
+            "reviews", {"pubkey": "456"}, select_fields="rating"
+        )[0]
+        self.assertEqual(retrieved_review, {"rating": 5})
+
+        self.obdb.delete_entries("reviews", {"pubkey": "456"})
+
+    def test_iter_entries(self):
+        for rating in range(5):
+            self.obdb.insert_entry("reviews", {"pubKey": "555", "rating": rating})
+
+        rows = self.obdb.iter_entries(
+            "reviews", {"pubkey": "555"}, order="DESC",
+            select_fields=["pubKey", "rating", "text"], chunk_size=2
+        )
+        ratings = []
+        for row in rows:
+            self.assertEqual(row["pubKey"], "555")
+            self.assertIsNone(row["text"])
+            ratings.append(row["rating"])
+        self.assertEqual(ratings, [4, 3, 2, 1, 0])
+
+        # The reader connection is returned once the rows are consumed.
+        self.assertEqual(self.obdb._readers.qsize(), self.obdb._reader_count)
+
+        self.obdb.delete_entries("reviews", {"pubkey": "555"})
+
+    @mock.patch.object(db_store.constants, 'DB_READER_TIMEOUT', 0.01)
+    def test_read_with_busy_readers(self):
+        # Iterators not consumed hold all the reader connections.
+        iterators = []
+        for _ in range(self.obdb.pool_size):
+            iterator = self.obdb.iter_entries("reviews")
+            next(iterator, None)
+            iterators.append(iterator)
+
+        self.assertIsInstance(self.obdb.select_entries("reviews"), list)
+        # The temporary connection is not kept.
+        self.assertEqual(self.obdb._readers.qsize(), 0)
+
+        for iterator in iterators:
+            iterator.close()
+        self.assertEqual(self.obdb._readers.qsize(), self.obdb.pool_size)
+
+    def test_count_entries_and_exists(self):
+        self.obdb.insert_entry("reviews", {"pubKey": "789", "rating": 1})
+        self.obdb.insert_entry("reviews", {"pubKey": "789", "rating": 2})
+
+        self.assertEqual(self.obdb.count_entries("reviews", {"pubkey": "789"}), 2)
+        self.assertEqual(
+            self.obdb.count_entries("reviews", {"pubkey": "789", "rating": 2}), 1
+        )
+        self.assertEqual(self.obdb.count_entries("reviews", {"pubkey": "0"}), 0)
+        self.assertTrue(self.obdb.exists("reviews", {"pubkey": "789"}))
+        self.assertFalse(self.obdb.exists("reviews", {"pubkey": "0"}))
+
+        self.obdb.delete_entries("reviews", {"pubkey": "789"})
+
+    def test_transaction(self):
+        with self.obdb.transaction():
+            self.obdb.insert_entry("reviews", {"pubKey": "tx", "rating": 1})
+            self.obdb.update_entries("reviews", {"rating": 2}, {"pubkey": "tx"})
+            # Reads inside the transaction see its changes...
+            self.assertEqual(self.obdb.count_entries("reviews", {"pubkey": "tx"}), 1)
+            # ...while other connections don't, until it is committed.
+            reader = self.obdb._get_reader()
+            uncommitted = reader.execute(
+                "SELECT * FROM reviews WHERE pubKey = 'tx'"
+            ).fetchall()
+            self.obdb._readers.put(reader)
+            self.assertEqual(uncommitted, [])
+        self.assertEqual(
+            self.obdb.select_entries("reviews", {"pubkey": "tx"})[0]["rating"], 2
+        )
+        self.obdb.delete_entries("reviews", {"pubkey": "tx"})
+
+    def test_transaction_rollback(self):
+        with self.assertRaises(ValueError):
+            with self.obdb.transaction():
+                self.obdb.insert_entry("reviews", {"pubKey": "tx", "rating": 1})
+                raise ValueError()
+        self.assertFalse(self.obdb.exists("reviews", {"pubkey": "tx"}))
+
+    def test_insert_many(self):
+        self.obdb.insert_many("reviews", [
+            {"pubKey": "many", "rating": rating} for rating in range(3)
+        ])
+        self.assertEqual(self.obdb.count_entries("reviews", {"pubkey": "many"}), 3)
+        self.obdb.delete_entries("reviews", {"pubkey": "many"})
+
+    def test_wal_journal_mode(self):
+        self.obdb.select_entries("reviews")
+        reader = self.obdb._readers.get()
+        journal_mode = reader.execute("PRAGMA journal_mode").fetchone()
+        self.obdb._readers.put(reader)
+        self.assertEqual(journal_mode['journal_mode'], 'wal')
+
+    def test_read_during_write(self):
+        # Reads don't wait for the writer lock.
+        with self.obdb._lock:
+            all_reviews = self.obdb.select_entries("reviews")
+        self.assertIsInstance(all_reviews, list)
+
+    @mock.patch('node.constants.DB_SLOW_QUERY_THRESHOLD', 0)
+    def test_slow_query_plan(self):
+        self.obdb._log = mock.Mock()
+        self.obdb.select_entries("reviews", {"pubkey": "123"})
+        self.obdb.select_entries("reviews", {"pubkey": "123"})
+        # The plan of a slow query is only logged once.
+        self.assertEqual(self.obdb._log.warning.call_count, 1)
+        message = self.obdb._log.warning.call_args[0]
+        self.assertIn('SCAN', message[3])
+
+        # Indexed lookups are not reported as full scans.
+        self.obdb.select_entries("orders", {"order_id": 1})
+        self.assertNotIn('SCAN', self.obdb._log.warning.call_args[0][3])
+
+    @mock.patch('node.constants.DB_SLOW_QUERY_THRESHOLD', 0)
+    def test_slow_insert_many_plan(self):
+        self.obdb._log = mock.Mock()
+        self.obdb.insert_many("reviews", [
+            {"pubKey": "slow", "rating": rating} for rating in range(2)
+        ])
+        self.assertEqual(self.obdb._log.warning.call_count, 1)
+        self.assertIn('INSERT INTO reviews', self.obdb._log.warning.call_args[0][2])
+        self.obdb.delete_entries("reviews", {"pubkey": "slow"})
+
     def test_delete_operation(self):
         # Delete the entry with pubkey equal to '123'
         self.obdb.delete_entries("reviews", {"pubkey": "123"})
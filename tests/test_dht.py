@@ -0,0 +1,379 @@
+import collections
+import json
+import threading
+import time
+import unittest
+
+import mock
+
+from node import constants, dht, guid
+
+
+class TestMeteredRLock(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = dht.MeteredRLock('test')
+
+    def test_init(self):
+        stats = self.lock.get_stats()
+        self.assertEqual(stats['name'], 'test')
+        self.assertEqual(stats['acquisitions'], 0)
+        self.assertEqual(stats['contentions'], 0)
+        self.assertEqual(stats['wait_time'], 0)
+        self.assertEqual(stats['max_wait_time'], 0)
+
+    def test_uncontended(self):
+        with self.lock:
+            # Reentrant acquisitions do not count as contention.
+            with self.lock:
+                pass
+        stats = self.lock.get_stats()
+        self.assertEqual(stats['acquisitions'], 2)
+        self.assertEqual(stats['contentions'], 0)
+
+    def test_contended(self):
+        acquired = threading.Event()
+        release = threading.Event()
+
+        def hold_lock():
+            with self.lock:
+                acquired.set()
+                release.wait()
+
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        acquired.wait()
+        threading.Timer(0.05, release.set).start()
+
+        with self.lock:
+            pass
+        holder.join()
+
+        stats = self.lock.get_stats()
+        self.assertEqual(stats['acquisitions'], 2)
+        self.assertEqual(stats['contentions'], 1)
+        self.assertGreater(stats['wait_time'], 0)
+        self.assertEqual(stats['wait_time'], stats['max_wait_time'])
+
+
+
+class TestCloseNodes(unittest.TestCase):
+
+    own_guid = '1' * constants.HEX_NODE_ID_LEN
+
+    def setUp(self):
+        self.dht = dht.DHT(
+            mock.Mock(), 42, {'guid': self.own_guid}, mock.Mock()
+        )
+
+    def _add_peer(self, num):
+        peer = guid.GUIDMixin('%040x' % num)
+        peer.hostname = '10.0.0.%d' % num
+        peer.port = 12345
+        peer.pub = 'pub'
+        peer.nickname = 'peer%d' % num
+        peer.nat_type = 'Full Cone'
+        peer.avatar_url = None
+        peer.last_reached = time.time()
+        self.dht.routing_table.add_contact(peer)
+        return peer
+
+    def test_cached(self):
+        self._add_peer(2)
+        self._add_peer(3)
+        self.dht.routing_table.find_close_nodes = mock.Mock(
+            wraps=self.dht.routing_table.find_close_nodes
+        )
+        first = self.dht.close_nodes('%040x' % 4)
+        second = self.dht.close_nodes('%040x' % 4)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(first, second)
+        self.assertEqual(self.dht.routing_table.find_close_nodes.call_count, 1)
+
+        # The excluded guid is part of the cache key.
+        self.assertEqual(len(self.dht.close_nodes('%040x' % 4, '%040x' % 2)), 1)
+
+    def test_invalidated_by_routing_table_change(self):
+        self._add_peer(2)
+        self.assertEqual(len(self.dht.close_nodes('%040x' % 4)), 1)
+        self._add_peer(3)
+        self.assertEqual(len(self.dht.close_nodes('%040x' % 4)), 2)
+        self.dht.routing_table.remove_contact('%040x' % 3)
+        self.assertEqual(len(self.dht.close_nodes('%040x' % 4)), 1)
+
+    def test_expired(self):
+        self._add_peer(2)
+        self.dht.close_nodes('%040x' % 4)
+        cache_key, (cached_at, _) = self.dht._close_nodes_cache.items()[0]
+        self.dht._close_nodes_cache[cache_key] = (
+            cached_at - constants.CLOSE_NODES_CACHE_TTL, []
+        )
+        self.assertEqual(len(self.dht.close_nodes('%040x' % 4)), 1)
+
+
+class TestKeywordIndex(unittest.TestCase):
+
+    own_guid = '1' * constants.HEX_NODE_ID_LEN
+    key = 'a' * constants.HEX_NODE_ID_LEN
+
+    def setUp(self):
+        self.dht = dht.DHT(
+            mock.Mock(), 42, {'guid': self.own_guid}, mock.Mock()
+        )
+        self.dht.data_store = collections.defaultdict(lambda: None)
+
+        def store_locally(key, value, *args):
+            self.dht.data_store[key] = value
+        self.dht._store_locally = store_locally
+
+    @staticmethod
+    def _update(update, listing, shard=3):
+        return json.dumps({
+            update: {'guid': 'guid', 'key': listing}, 'shard': shard
+        })
+
+    def _listings(self):
+        index = self.dht.data_store[self.key]
+        return [listing['key'] for listing in index['listings']]
+
+    def _store(self, value):
+        self.dht._on_store_value({
+            'key': self.key,
+            'value': value,
+            'originalPublisherID': 'guid',
+            'age': 0
+        })
+
+    def test_add_is_a_set(self):
+        for listing in ['l1', 'l2', 'l1']:
+            self._store(self._update('keyword_index_add', listing))
+        self.assertEqual(self._listings(), ['l2', 'l1'])
+        index = self.dht.data_store[self.key]
+        self.assertEqual(index['shard'], 3)
+        self.assertEqual(index['shards'], constants.KEYWORD_INDEX_SHARDS)
+
+    def test_remove(self):
+        self._store(self._update('keyword_index_add', 'l1'))
+        self._store(self._update('keyword_index_add', 'l2'))
+        self._store(self._update('keyword_index_remove', 'l1'))
+        self.assertEqual(self._listings(), ['l2'])
+
+        # Removing a missing listing stores nothing.
+        with mock.patch.object(self.dht, '_store_locally') as store_locally:
+            self._store(self._update('keyword_index_remove', 'l1'))
+        self.assertFalse(store_locally.called)
+
+    @mock.patch.object(constants, 'KEYWORD_INDEX_SHARD_SIZE', 3)
+    def test_bounded_without_keyword(self):
+        # Updates from older peers do not name the keyword, so a full
+        # shard cannot overflow.
+        for listing in ['l1', 'l2', 'l3']:
+            self._store(self._update('keyword_index_add', listing))
+        # Refreshing l1 makes l2 the oldest.
+        self._store(self._update('keyword_index_add', 'l1'))
+        self._store(self._update('keyword_index_add', 'l4'))
+        self.assertEqual(self._listings(), ['l3', 'l1', 'l4'])
+
+    @mock.patch.object(constants, 'KEYWORD_INDEX_SHARD_SIZE', 3)
+    @mock.patch.object(
+        dht.DHT, 'keyword_index_key',
+        side_effect=lambda keyword, shard=0: '%s-%d' % (keyword.upper(), shard)
+    )
+    def test_full_shard_overflows(self, _):
+        key = 'LAMP-3'
+
+        def store(update, listing, key=key, shard=3):
+            value = json.loads(self._update(update, listing, shard))
+            value['keyword'] = 'lamp'
+            self.dht._on_store_value({
+                'key': key, 'value': json.dumps(value),
+                'originalPublisherID': 'guid', 'age': 0
+            })
+
+        def overflow():
+            scheduled = self.dht.transport.loop.add_callback.call_args[0]
+            self.dht.transport.loop.add_callback.reset_mock()
+            self.assertEqual(scheduled[:2], (self.dht.iterative_store, 'LAMP-11'))
+            return json.loads(scheduled[2])
+
+        for listing in ['l1', 'l2', 'l3']:
+            store('keyword_index_add', listing)
+        self.assertFalse(self.dht.transport.loop.add_callback.called)
+
+        # The oldest listing moves to shard 11, which the shard counts.
+        store('keyword_index_add', 'l4')
+        index = self.dht.data_store[key]
+        self.assertEqual([l['key'] for l in index['listings']], ['l2', 'l3', 'l4'])
+        self.assertEqual(index['shards'], 3 + constants.KEYWORD_INDEX_SHARDS + 1)
+        update = overflow()
+        self.assertEqual(update['shard'], 11)
+        self.assertEqual(update['keyword_index_add'], [{'guid': 'guid', 'key': 'l1'}])
+        self.assertEqual(update['keyword_index_remove'], [{'guid': 'guid', 'key': 'l4'}])
+
+        # Removals not found are passed on to the overflow shard.
+        store('keyword_index_remove', 'l1')
+        self.assertEqual(
+            overflow()['keyword_index_remove'], [{'guid': 'guid', 'key': 'l1'}]
+        )
+
+        # An update naming another keyword than its key's cannot overflow.
+        store('keyword_index_add', 'l5', key='OTHER-3')
+        for listing in ['l6', 'l7', 'l8']:
+            store('keyword_index_add', listing, key='OTHER-3')
+        self.assertFalse(self.dht.transport.loop.add_callback.called)
+
+    def test_batched_update(self):
+        self._store(self._update('keyword_index_add', 'l1'))
+        self._store(json.dumps({
+            'keyword_index_add': [
+                {'guid': 'guid', 'key': 'l2'}, {'guid': 'guid', 'key': 'l3'}
+            ],
+            'keyword_index_remove': [{'guid': 'guid', 'key': 'l1'}],
+            'shard': 3
+        }))
+        self.assertEqual(self._listings(), ['l2', 'l3'])
+
+    def test_updates_are_sent_as_deltas(self):
+        self._store(self._update('keyword_index_add', 'l1'))
+        peer = mock.Mock(version='0.5.1')
+        self.dht.routing_table.get_contact = mock.Mock(return_value=peer)
+        self.dht.iterative_find_node = mock.Mock()
+
+        update = self._update('keyword_index_add', 'l2')
+        self.dht.iterative_store(self.key, update, 'guid')
+        self.assertEqual(self._listings(), ['l1', 'l2'])
+
+        on_nodes_found = self.dht.iterative_find_node.call_args[0][1]
+        on_nodes_found([('10.0.0.2', 12345, '2' * 40)])
+        self.assertEqual(peer.send.call_args[0][0]['value'], update)
+
+    def test_whole_index_sent_to_old_peers(self):
+        self._store(self._update('keyword_index_add', 'l1'))
+        self.dht.iterative_find_node = mock.Mock()
+
+        for version in ('0.5.0', None):
+            peer = mock.Mock(version=version)
+            self.dht.routing_table.get_contact = mock.Mock(return_value=peer)
+            self.dht.iterative_store(
+                self.key, self._update('keyword_index_add', 'l2'), 'guid'
+            )
+            on_nodes_found = self.dht.iterative_find_node.call_args[0][1]
+            on_nodes_found([('10.0.0.2', 12345, '2' * 40)])
+            index = peer.send.call_args[0][0]['value']
+            self.assertEqual(
+                [listing['key'] for listing in index['listings']], ['l1', 'l2']
+            )
+
+    @mock.patch.object(
+        dht.DHT, 'keyword_index_key',
+        side_effect=lambda keyword, shard: (keyword, shard)
+    )
+    def test_find_listings_by_keyword(self, _):
+        self.dht.iterative_find_value = mock.Mock()
+        self.dht.find_listings_by_keyword('LAMP', shard=2)
+        self.assertEqual(
+            self.dht.iterative_find_value.call_args_list,
+            [mock.call(('LAMP', 2), None)]
+        )
+
+        self.dht.iterative_find_value.reset_mock()
+        callback = mock.Mock()
+        self.dht.find_listings_by_keyword('LAMP', callback=callback)
+        self.assertEqual(
+            [call[0][0] for call in self.dht.iterative_find_value.call_args_list],
+            [('LAMP', shard) for shard in range(constants.KEYWORD_INDEX_SHARDS)]
+        )
+
+        # The overflow shards a shard reports are looked up too, once.
+        on_shard_found = self.dht.iterative_find_value.call_args[0][1]
+        value = {'listings': [], 'shard': 3, 'shards': 12}
+        on_shard_found(value)
+        on_shard_found(value)
+        callback.assert_called_with(value)
+        self.assertEqual(
+            [call[0][0] for call in self.dht.iterative_find_value.call_args_list],
+            [('LAMP', shard) for shard in range(12)]
+        )
+
+    def test_keyword_index_shard(self):
+        shards = set(
+            dht.DHT.keyword_index_shard('%040x' % number)
+            for number in range(100)
+        )
+        self.assertEqual(shards, set(range(constants.KEYWORD_INDEX_SHARDS)))
+
+
+class TestIterativeStore(unittest.TestCase):
+
+    own_guid = '1' * constants.HEX_NODE_ID_LEN
+    key = '0' * constants.HEX_NODE_ID_LEN
+
+    def setUp(self):
+        self.dht = dht.DHT(
+            mock.Mock(), 42, {'guid': self.own_guid}, mock.Mock()
+        )
+        self.dht.transport.guid = self.own_guid
+        self.dht._merge_and_store = mock.Mock(return_value='value')
+        self.dht.iterative_find_node = mock.Mock()
+        self.dht.store_key_value = mock.Mock()
+
+        self.dht.active_peers = [
+            mock.Mock(hostname='10.0.0.%d' % num, port=12345, guid='%040x' % num)
+            for num in range(1, 4)
+        ]
+
+    @staticmethod
+    def _node(num):
+        return ('10.0.0.%d' % num, 12345, '%040x' % num, 'pub', 'nick', None)
+
+    def _find_nodes(self, nodes):
+        on_nodes_found = self.dht.iterative_find_node.call_args[0][1]
+        on_nodes_found(nodes)
+
+    def test_closest_nodes(self):
+        nodes = [self._node(num) for num in (8, 1, 4, 2)]
+        nodes.append(('seed', 12345, 'seed1', 'pub', 'nick', None))
+        nodes.append(('127.0.0.1', 12345, self.own_guid, 'pub', 'nick', None))
+        closest = self.dht.closest_nodes(self.key, nodes + nodes[:1], count=3)
+        self.assertEqual(closest, [self._node(1), self._node(2), self._node(4)])
+
+    def test_stored_on_closest_nodes_only(self):
+        self.dht.iterative_store(self.key, 'value')
+        self.assertFalse(self.dht.store_key_value.called)
+
+        self._find_nodes([self._node(num) for num in range(30, 0, -1)])
+        nodes, key, value = self.dht.store_key_value.call_args[0][:3]
+        self.assertEqual(nodes, [self._node(num) for num in range(1, constants.K + 1)])
+        self.assertEqual((key, value), (self.key, 'value'))
+
+        # Later callbacks of the lookup do not store again.
+        self._find_nodes([self._node(1)])
+        self.assertEqual(self.dht.store_key_value.call_count, 1)
+
+    def test_no_close_nodes(self):
+        # The real lookup, which calls back at once with no nodes.
+        del self.dht.iterative_find_node
+        self.dht.iterative_store(self.key, 'value')
+        self.dht.store_key_value.assert_called_once_with(
+            [], self.key, 'value', self.own_guid, mock.ANY, None
+        )
+        self.assertEqual(self.dht.searches, [])
+
+    def test_wide_replication(self):
+        self.dht.replicate_widely(self.key)
+        self.dht.iterative_store(self.key, 'value')
+        nodes = self.dht.store_key_value.call_args[0][0]
+        self.assertEqual(
+            [node[2] for node in nodes], ['%040x' % num for num in range(1, 4)]
+        )
+        self._find_nodes([self._node(5)])
+        self.assertEqual(self.dht.store_key_value.call_count, 2)
+
+    def test_nothing_to_store(self):
+        self.dht._merge_and_store.return_value = None
+        self.dht.iterative_store(self.key, 'value')
+        self.assertFalse(self.dht.iterative_find_node.called)
+
+
+if __name__ == "__main__":
+    unittest.main()
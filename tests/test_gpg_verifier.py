@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from node import db_store, gpg_verifier, setup_db
+from node.contract_cache import contract_digest
+
+
+class TestGPGVerifier(unittest.TestCase):
+
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        db_path = os.path.join(self.db_dir, 'testdb.db')
+        setup_db.setup_db(db_path, disable_sqlite_crypt=True)
+        self.db = db_store.Obdb(db_path, disable_sqlite_crypt=True)
+
+        self.gpg = mock.Mock()
+        self.gpg.import_keys.return_value.fingerprints = ['FINGERPRINT']
+        self.gpg.verify.return_value.fingerprint = 'SUBKEY'
+        self.gpg.verify.return_value.pubkey_fingerprint = 'FINGERPRINT'
+        self.io_loop = mock.Mock()
+        self.io_loop.add_callback.side_effect = lambda func, *args: func(*args)
+        self.verifier = self._make_verifier()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.db_dir)
+
+    def _make_verifier(self):
+        return gpg_verifier.GPGVerifier(
+            self.db, 1, self.gpg, io_loop=self.io_loop
+        )
+
+    def test_verified_once(self):
+        for _ in range(2):
+            self.assertEqual(
+                self.verifier.verify('contract', 'key'), 'FINGERPRINT'
+            )
+        self.gpg.import_keys.assert_called_once_with('key')
+        self.gpg.verify.assert_called_once_with('contract')
+
+    def test_persisted(self):
+        self.verifier.verify('contract', 'key')
+
+        # A new instance, with an empty cache, uses the stored result.
+        verifier = self._make_verifier()
+        self.assertEqual(verifier.verify('contract', 'key'), 'FINGERPRINT')
+        self.assertEqual(self.gpg.verify.call_count, 1)
+
+    def test_key_imported_once(self):
+        self.verifier.verify('contract 1', 'key')
+        self.verifier.verify('contract 2', 'key')
+        self.assertEqual(self.gpg.import_keys.call_count, 1)
+        self.assertEqual(self.gpg.verify.call_count, 2)
+
+    def test_key_not_imported(self):
+        self.gpg.import_keys.return_value.fingerprints = []
+        self.assertIsNone(self.verifier.verify('contract', 'key'))
+        self.assertFalse(self.gpg.verify.called)
+
+        # Tried again, as it was not imported.
+        self.gpg.import_keys.return_value.fingerprints = ['FINGERPRINT']
+        self.assertEqual(
+            self.verifier.verify('contract', 'key'), 'FINGERPRINT'
+        )
+
+    def test_signed_with_other_key(self):
+        self.verifier.verify('contract', 'key')
+
+        # Another key claims the same contract.
+        self.gpg.import_keys.return_value.fingerprints = ['OTHER']
+        self.assertIsNone(self.verifier.verify('contract', 'other key'))
+        callback = mock.Mock()
+        self.verifier._verify_batch([
+            (contract_digest('contract'), 'contract', 'other key', callback)
+        ])
+        callback.assert_called_once_with(None)
+
+    def test_failure_not_remembered(self):
+        self.gpg.verify.return_value = mock.Mock(
+            __nonzero__=lambda _: False
+        )
+        self.assertIsNone(self.verifier.verify('contract', 'key'))
+        self.assertIsNone(self.verifier.verify('contract', 'key'))
+        self.assertEqual(self.gpg.verify.call_count, 2)
+        self.assertIsNone(
+            self.verifier.get_verified(contract_digest('contract'))
+        )
+
+    def test_batch(self):
+        self.gpg.import_keys.side_effect = lambda key: mock.Mock(
+            fingerprints=['FINGERPRINT']
+        )
+        callbacks = [mock.Mock() for _ in range(3)]
+        batch = [
+            (contract_digest(contract), contract, key, callback)
+            for contract, key, callback in zip(
+                ['contract 1', 'contract 2', 'contract 1'],
+                ['key 1', 'key 2', 'key 1'],
+                callbacks
+            )
+        ]
+        self.verifier._verify_batch(batch)
+
+        # Each key is imported and each contract verified once.
+        self.assertEqual(
+            sorted(args[0] for args, _ in self.gpg.import_keys.call_args_list),
+            ['key 1', 'key 2']
+        )
+        self.assertEqual(self.gpg.verify.call_count, 2)
+        for callback in callbacks:
+            callback.assert_called_once_with('FINGERPRINT')
+
+    def test_verify_async_cached(self):
+        self.verifier.verify('contract', 'key')
+        callback = mock.Mock()
+        with mock.patch.object(gpg_verifier.threading, 'Thread') as thread:
+            self.verifier.verify_async('contract', 'key', callback)
+            self.assertFalse(thread.called)
+        callback.assert_called_once_with('FINGERPRINT')
+
+
+if __name__ == "__main__":
+    unittest.main()
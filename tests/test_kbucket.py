@@ -232,7 +232,7 @@ class TestKBucket(unittest.TestCase):
         target_contact_offset = random.randrange(0, self.init_contact_count)
         target_contact_id = self.range_min + target_contact_offset
         excl_contact = self._mk_contact_by_num(target_contact_id)
-        rest_contacts = self.bucket.get_contacts(exclude_contact=excl_contact)
+        rest_contacts = self.bucket.get_contacts(excluded_guid=excl_contact)
         count_rest = len(rest_contacts)
 
         # ... check it was indeed excluded ...
@@ -262,7 +262,7 @@ class TestKBucket(unittest.TestCase):
 
         # ... and check it's OK to exclude a contact that is not there yet.
         try:
-            self.bucket.get_contacts(exclude_contact=self.ghost_contact)
+            self.bucket.get_contacts(excluded_guid=self.ghost_contact)
         except Exception:
             self.fail("Crashed while excluding contact absent from bucket.")
 
@@ -0,0 +1,60 @@
+import unittest
+
+import bitcoin
+import mock
+
+from node import keychain
+
+
+class TestKeyChain(unittest.TestCase):
+
+    seed = 'b' * 64
+
+    def setUp(self):
+        self.keychain = keychain.KeyChain(self.seed, cache_size=2)
+
+    def _derive(self, key_id):
+        wallet = bitcoin.bip32_ckd(bitcoin.bip32_master_key(self.seed), 1)
+        wallet_chain = bitcoin.bip32_ckd(wallet, 0)
+        return bitcoin.bip32_ckd(wallet_chain, key_id)
+
+    def test_keys(self):
+        child = self._derive(3)
+        self.assertEqual(self.keychain.get_child(3), child)
+        self.assertEqual(
+            self.keychain.get_signing_key(3),
+            bitcoin.encode_privkey(bitcoin.bip32_extract_key(child), 'wif')
+        )
+        self.assertEqual(
+            self.keychain.get_pubkey(3),
+            bitcoin.encode_pubkey(
+                bitcoin.bip32_extract_key(bitcoin.bip32_privtopub(child)),
+                'hex'
+            )
+        )
+
+    def test_memoized(self):
+        with mock.patch.object(
+                keychain.bitcoin, 'bip32_ckd', wraps=bitcoin.bip32_ckd) as ckd:
+            self.keychain.get_child(1)
+            self.keychain.get_child(1)
+            # m/1, m/1/0 and m/1/0/1, each once.
+            self.assertEqual(ckd.call_count, 3)
+
+            self.keychain.get_child(2)
+            self.keychain.get_child(3)
+            # Key 1 has been evicted.
+            self.keychain.get_child(1)
+            self.assertEqual(ckd.call_count, 6)
+
+    def test_get_keychain(self):
+        self.assertIs(
+            keychain.get_keychain(self.seed), keychain.get_keychain(self.seed)
+        )
+        self.assertIsNot(
+            keychain.get_keychain(self.seed), keychain.get_keychain('c' * 64)
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import json
+import unittest
+
+import mock
+
+from node import keyword_publisher
+
+
+class TestKeywordPublisher(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = mock.Mock()
+        self.transport.guid = 'guid'
+        self.transport.dht.keyword_index_shard.side_effect = (
+            lambda listing_key: int(listing_key[-1]) % 2
+        )
+        self.transport.dht.keyword_index_key.side_effect = (
+            lambda keyword, shard: '%s-%d' % (keyword, shard)
+        )
+        self.io_loop = mock.Mock()
+        self.publisher = keyword_publisher.KeywordPublisher(
+            self.transport, 42, io_loop=self.io_loop, batch_size=2
+        )
+
+    def _stores(self):
+        return dict(
+            (call[0][0], json.loads(call[0][1]))
+            for call in self.transport.store.call_args_list
+        )
+
+    def test_grouped_by_key(self):
+        for listing_key in ['l0', 'l1', 'l2']:
+            self.publisher.add('lamp', listing_key)
+        self.assertEqual(len(self.publisher), 2)
+        self.assertFalse(self.transport.store.called)
+        # One publication is scheduled for all of them.
+        self.assertEqual(self.io_loop.call_later.call_count, 1)
+
+        self.assertEqual(self.publisher.publish(), 2)
+        stores = self._stores()
+        self.assertEqual(stores['lamp-1'], {
+            'shard': 1,
+            'keyword': 'lamp',
+            'keyword_index_add': [{'guid': 'guid', 'key': 'l1'}]
+        })
+        self.assertEqual(stores['lamp-0']['shard'], 0)
+        self.assertEqual(
+            sorted(l['key'] for l in stores['lamp-0']['keyword_index_add']),
+            ['l0', 'l2']
+        )
+
+    def test_latest_update_wins(self):
+        self.publisher.add('lamp', 'l0')
+        self.publisher.remove('lamp', 'l0')
+        self.publisher.add('lamp', 'l2')
+        self.publisher.publish()
+        self.assertEqual(self._stores(), {'lamp-0': {
+            'shard': 0,
+            'keyword': 'lamp',
+            'keyword_index_add': [{'guid': 'guid', 'key': 'l2'}],
+            'keyword_index_remove': [{'guid': 'guid', 'key': 'l0'}]
+        }})
+
+    def test_batches_are_bounded(self):
+        for keyword in ['a', 'b', 'c']:
+            self.publisher.add(keyword, 'l0')
+        self.assertEqual(self.publisher.publish(), 2)
+        self.assertEqual(self.transport.store.call_count, 2)
+        # The rest goes in the next batch.
+        self.assertEqual(self.io_loop.call_later.call_count, 2)
+        self.assertEqual(self.publisher.publish(), 1)
+        self.assertEqual(sorted(self._stores()), ['a-0', 'b-0', 'c-0'])
+        self.assertEqual(self.io_loop.call_later.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
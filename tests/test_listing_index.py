@@ -0,0 +1,139 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from node import db_store, setup_db
+from node.listing_index import ListingIndex
+
+
+def _listing(title, keywords=(), desc=''):
+    return {
+        'Contract': {
+            'item_title': title,
+            'item_keywords': list(keywords),
+            'item_desc': desc
+        }
+    }
+
+
+class TestListingIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        db_path = os.path.join(self.db_dir, 'testdb.db')
+        setup_db.setup_db(db_path, disable_sqlite_crypt=True)
+        self.db = db_store.Obdb(db_path, disable_sqlite_crypt=True)
+        self.index = ListingIndex(self.db, 1, 'own')
+
+    def tearDown(self):
+        self.index.close()
+        self.db.close()
+        shutil.rmtree(self.db_dir)
+
+    def _keys(self, text):
+        return [listing['key'] for listing in self.index.search(text)]
+
+    def test_make_query(self):
+        self.assertEqual(
+            ListingIndex.make_query('Red  "bike"-lamp'), 'red* bike* lamp*'
+        )
+        self.assertIsNone(ListingIndex.make_query(' - '))
+        self.assertEqual(self._keys('""'), [])
+
+    def test_search(self):
+        self.index.add('k1', _listing('Red bicycle'), 'signed 1', 'guid', 'nick')
+        self.index.add('k2', _listing('Blue lamp'), 'signed 2', 'guid')
+
+        results = self.index.search('bicycle')
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0], {
+            'key': 'k1',
+            'guid': 'guid',
+            'nickname': 'nick',
+            'contract_body': _listing('Red bicycle'),
+            'signed_contract_body': 'signed 1'
+        })
+
+    def test_prefix_and_all_terms(self):
+        self.index.add('k1', _listing('Red bicycle'), '', 'guid')
+        self.index.add('k2', _listing('Red lamp'), '', 'guid')
+
+        self.assertEqual(self._keys('bic'), ['k1'])
+        self.assertEqual(sorted(self._keys('re')), ['k1', 'k2'])
+        self.assertEqual(self._keys('red lam'), ['k2'])
+        self.assertEqual(self._keys('blue lamp'), [])
+
+    def test_ranking(self):
+        self.index.add('desc', _listing('Chair', desc='a lamp'), '', 'guid')
+        self.index.add('title', _listing('Lamp'), '', 'guid')
+        self.index.add('keywords', _listing('Light', ['lamp']), '', 'guid')
+
+        self.assertEqual(self._keys('lamp'), ['title', 'keywords', 'desc'])
+
+    def test_paging(self):
+        for number in range(5):
+            self.index.add(str(number), _listing('Lamp'), '', 'guid')
+        first = [l['key'] for l in self.index.search('lamp', limit=3)]
+        rest = [l['key'] for l in self.index.search('lamp', limit=3, offset=3)]
+        self.assertEqual(len(first), 3)
+        self.assertEqual(sorted(first + rest), ['0', '1', '2', '3', '4'])
+
+    def test_common_term_ranks_recent_matches_only(self):
+        self.index.candidates = 3
+        for number in range(5):
+            self.index.add(str(number), _listing('Lamp'), '', 'guid')
+        self.index.add('title', _listing('Red lamp'), '', 'guid')
+
+        with mock.patch('node.listing_index._rank', return_value=0.0) as rank:
+            # Reconnect, to register the mock as listing_rank.
+            self.index.close()
+            results = self.index.search('lamp', limit=3)
+        self.assertEqual(
+            sorted(l['key'] for l in results), ['3', '4', 'title']
+        )
+        self.assertEqual(rank.call_count, 3)
+
+        # Paging goes past the candidates.
+        self.index.close()
+        keys = [l['key'] for l in self.index.search('lamp', limit=2, offset=4)]
+        self.assertEqual(len(keys), 2)
+
+    def test_replace_and_remove(self):
+        self.index.add('k1', _listing('Red bicycle'), '', 'guid')
+        self.index.add('k1', _listing('Blue bicycle'), '', 'guid')
+        self.assertEqual(len(self.index), 1)
+        self.assertEqual(self._keys('red'), [])
+        self.assertEqual(self._keys('blue'), ['k1'])
+
+        self.index.remove('k1')
+        self.assertEqual(len(self.index), 0)
+        self.assertEqual(self._keys('bicycle'), [])
+
+    def test_markets_are_separate(self):
+        other = ListingIndex(self.db, 2)
+        self.addCleanup(other.close)
+        self.index.add('k1', _listing('Lamp'), '', 'guid')
+        other.add('k2', _listing('Lamp'), '', 'guid')
+
+        self.assertEqual(self._keys('lamp'), ['k1'])
+        self.assertEqual(len(other), 1)
+
+    @mock.patch('node.listing_index.time.time')
+    def test_least_recently_used_evicted(self, time):
+        time.side_effect = range(100, 200)
+        self.index.max_rows = 2
+        self.index.add('mine', _listing('Own lamp'), '', 'own')
+        self.index.add('k1', _listing('Red lamp'), '', 'guid')
+        self.index.add('k2', _listing('Blue lamp'), '', 'guid')
+        # Found, so used more recently than k2
+        self.assertEqual(self._keys('red'), ['k1'])
+        self.index.add('k3', _listing('Green lamp'), '', 'guid')
+
+        self.assertEqual(sorted(self._keys('lamp')), ['k1', 'k3', 'mine'])
+
+
+if __name__ == "__main__":
+    unittest.main()
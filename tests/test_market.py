@@ -0,0 +1,148 @@
+import functools
+import unittest
+
+import mock
+
+from node import market
+
+
+class TestPageEnvelope(unittest.TestCase):
+
+    def setUp(self):
+        self.market = mock.Mock()
+        self.market.page_envelope = None
+        self.market.get_settings.return_value = {
+            'storeDescription': 'Store', 'nickname': 'nickname',
+            'homepage': '', 'avatar_url': ''
+        }
+        self.market.get_page_envelope = functools.partial(
+            market.Market.get_page_envelope.im_func, self.market
+        )
+        self.peer = mock.Mock()
+        self.market.dht.routing_table.get_contact.return_value = self.peer
+
+        patcher = mock.patch(
+            'node.market.sign_message', return_value='envelope'
+        )
+        self.sign_message = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _query_page(self):
+        market.Market.on_query_page.im_func(
+            self.market, {'senderGUID': 'peer'}
+        )
+
+    def test_signed_once(self):
+        for _ in range(3):
+            self._query_page()
+        self.assertEqual(self.sign_message.call_count, 1)
+        self.assertEqual(self.market.get_settings.call_count, 1)
+        self.assertEqual(self.peer.send_envelope.call_count, 3)
+        self.peer.send_envelope.assert_called_with('envelope')
+        self.assertFalse(self.peer.send.called)
+
+    def test_rebuilt_after_save_settings(self):
+        self._query_page()
+        self.market.page_envelope = None  # As save_settings() does
+        self._query_page()
+        self.assertEqual(self.sign_message.call_count, 2)
+
+
+class TestSaveContract(unittest.TestCase):
+
+    def setUp(self):
+        self.market = mock.Mock()
+        self.market.get_settings.return_value = {
+            'PGPPubkeyFingerprint': 'fingerprint', 'guid': 'guid',
+            'refundAddress': 'address'
+        }
+        self.market.on_contract_image = functools.partial(
+            market.Market.on_contract_image.im_func, self.market
+        )
+        self.contract = {
+            'Seller': {},
+            'Contract': {'item_images': {'image1': 'data:image/jpeg,...'}}
+        }
+
+    def test_image_processed_before_storing(self):
+        saved = mock.Mock()
+        market.Market.save_contract.im_func(
+            self.market, self.contract, 7, saved
+        )
+        self.assertFalse(self.market.store_contract.called)
+
+        (uri, callback), _ = self.market.thumbnails.add.call_args
+        self.assertEqual(uri, 'data:image/jpeg,...')
+        callback('0' * 64)
+        self.market.store_contract.assert_called_once_with(
+            self.contract, 7, True
+        )
+        saved.assert_called_once_with(None)
+        # The image is referenced, not inlined.
+        self.assertEqual(
+            self.contract['Contract'], {'item_image_hashes': ['0' * 64]}
+        )
+
+    def test_unreadable_image(self):
+        saved = mock.Mock()
+        market.Market.save_contract.im_func(
+            self.market, self.contract, 7, saved
+        )
+        self.market.thumbnails.add.call_args[0][1](None)
+        self.assertFalse(self.market.store_contract.called)
+        self.assertIsNotNone(saved.call_args[0][0])
+
+    def test_store_failed(self):
+        saved = mock.Mock()
+        self.market.store_contract.side_effect = ValueError()
+        market.Market.save_contract.im_func(
+            self.market, self.contract, 7, saved
+        )
+        self.market.thumbnails.add.call_args[0][1]('0' * 64)
+        self.assertIsNotNone(saved.call_args[0][0])
+
+    def test_no_image(self):
+        del self.contract['Contract']['item_images']
+        market.Market.save_contract.im_func(self.market, self.contract, 7)
+        self.assertFalse(self.market.thumbnails.add.called)
+        self.market.store_contract.assert_called_once_with(
+            self.contract, 7, True
+        )
+
+
+class TestQueryImage(unittest.TestCase):
+
+    def setUp(self):
+        self.market = mock.Mock()
+        self.market.send_image = functools.partial(
+            market.Market.send_image.im_func, self.market
+        )
+        self.msg = {'senderGUID': 'peer', 'image_hash': '0' * 64, 'size': 200}
+
+    def _query(self, thumbnail):
+        market.Market.on_query_image.im_func(self.market, self.msg)
+        image_hash, size, callback = self.market.thumbnails.get.call_args[0]
+        self.assertEqual((image_hash, size), ('0' * 64, 200))
+        callback(thumbnail)
+        message, guid = self.market.transport.send.call_args[0]
+        self.assertEqual(guid, 'peer')
+        return message
+
+    def test_validate(self):
+        validate = market.Market.validate_on_query_image.im_func
+        self.assertTrue(validate(self.market, self.msg))
+        self.msg['size'] = 13
+        self.assertFalse(validate(self.market, self.msg))
+
+    def test_image_sent(self):
+        self.assertEqual(self._query('thumbnail'), {
+            'type': 'image', 'image_hash': '0' * 64, 'size': 200,
+            'data': 'thumbnail'.encode('base64')
+        })
+
+    def test_unknown_image(self):
+        self.assertIsNone(self._query(None)['data'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,216 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from node import db_store, setup_db
+from node.contract_cache import ContractCache
+from node.orders import Orders
+
+
+class TestGetOrders(unittest.TestCase):
+
+    market_id = 1
+    own_guid = 'a' * 40
+    other_guid = 'b' * 40
+    notary_guid = 'c' * 40
+
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        db_path = os.path.join(self.db_dir, 'testdb.db')
+        setup_db.setup_db(db_path, disable_sqlite_crypt=True)
+        self.db = db_store.Obdb(db_path, disable_sqlite_crypt=True)
+
+        self.db.insert_entry(
+            "peers", {"guid": self.other_guid, "nickname": "other"}
+        )
+        # Twelve purchases, then three sales and two notarizations.
+        parties = (
+            [(self.own_guid, self.other_guid)] * 12 +
+            [(self.other_guid, self.own_guid)] * 3 +
+            [(self.other_guid, self.notary_guid)] * 2
+        )
+        self.db.insert_many("orders", [
+            {
+                "order_id": order_id,
+                "market_id": self.market_id,
+                "buyer": buyer,
+                "merchant": merchant,
+                "updated": order_id
+            }
+            for order_id, (buyer, merchant) in enumerate(parties)
+        ])
+
+        transport = mock.Mock()
+        transport.guid = self.own_guid
+        self.orders = Orders(transport, self.market_id, self.db, None)
+        patcher = mock.patch.object(
+            Orders, '_build_order',
+            side_effect=lambda row, order_id: {'order_id': order_id}
+        )
+        self.build_order = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.db_dir)
+
+    def _order_ids(self, result):
+        return [order['order_id'] for order in result['orders']]
+
+    def test_all_orders(self):
+        result = self.orders.get_orders()
+        self.assertEqual(result['total'], 17)
+        # Most recently updated first.
+        self.assertEqual(self._order_ids(result), range(16, 6, -1))
+        self.assertEqual(self.build_order.call_count, 10)
+
+    def test_purchases_are_paged_in_sql(self):
+        result = self.orders.get_orders(0, merchant=False)
+        self.assertEqual(result['total'], 12)
+        self.assertEqual(self._order_ids(result), range(11, 1, -1))
+
+        result = self.orders.get_orders(1, merchant=False)
+        self.assertEqual(self._order_ids(result), [1, 0])
+
+    def test_sales(self):
+        result = self.orders.get_orders(0, True)
+        self.assertEqual(result['total'], 3)
+        self.assertEqual(self._order_ids(result), [14, 13, 12])
+
+    def test_notarizations(self):
+        result = self.orders.get_orders(0, notarizations=True)
+        self.assertEqual(result['total'], 2)
+        self.assertEqual(self._order_ids(result), [16, 15])
+
+    def test_notarizations_with_unknown_party(self):
+        self.db.insert_entry("orders", {
+            "order_id": 17,
+            "market_id": self.market_id,
+            "buyer": self.other_guid,
+            "updated": 17
+        })
+        result = self.orders.get_orders(0, notarizations=True)
+        self.assertEqual(result['total'], 3)
+        self.assertEqual(self._order_ids(result), [17, 16, 15])
+
+    def test_nicknames(self):
+        result = self.orders.get_orders(0, merchant=False)
+        order = result['orders'][0]
+        self.assertEqual(order['merchant_nickname'], 'other')
+        # Unknown peers have no nickname.
+        self.assertEqual(order['buyer_nickname'], '')
+
+
+class TestParsedContract(unittest.TestCase):
+
+    sections = ({'Seller': {}}, {'Buyer': {}}, {'Notary': {}})
+
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        db_path = os.path.join(self.db_dir, 'testdb.db')
+        setup_db.setup_db(db_path, disable_sqlite_crypt=True)
+        self.db = db_store.Obdb(db_path, disable_sqlite_crypt=True)
+        self.db.insert_entry("orders", {
+            "order_id": 1,
+            "state": Orders.State.NOTARIZED,
+            "signed_contract_body": "contract"
+        })
+
+        patcher = mock.patch.object(
+            Orders, 'parse_contract', return_value=self.sections
+        )
+        self.parse_contract = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.db_dir)
+
+    def _get_parsed_contract(self, orders):
+        row = self.db.select_entries("orders", {"order_id": 1})[0]
+        return orders.get_parsed_contract(row)
+
+    def test_parsed_once(self):
+        orders = Orders(mock.Mock(), 1, self.db, None)
+        for _ in range(2):
+            self.assertEqual(self._get_parsed_contract(orders), self.sections)
+        self.parse_contract.assert_called_once_with(
+            "contract", Orders.State.NOTARIZED
+        )
+
+    def test_shared_cache(self):
+        cache = ContractCache()
+        orders = Orders(mock.Mock(), 1, self.db, None, contract_cache=cache)
+        self._get_parsed_contract(orders)
+        self.assertEqual(len(cache), 1)
+
+    def test_persisted(self):
+        self._get_parsed_contract(Orders(mock.Mock(), 1, self.db, None))
+
+        # A new instance, with an empty cache, uses the stored sections.
+        orders = Orders(mock.Mock(), 1, self.db, None)
+        self.assertEqual(
+            tuple(self._get_parsed_contract(orders)), self.sections
+        )
+        self.assertEqual(self.parse_contract.call_count, 1)
+
+    def test_reparsed_on_change(self):
+        orders = Orders(mock.Mock(), 1, self.db, None)
+        self._get_parsed_contract(orders)
+
+        self.db.update_entries(
+            "orders", {"state": Orders.State.PAID}, {"order_id": 1}
+        )
+        self._get_parsed_contract(orders)
+        self.db.update_entries(
+            "orders", {"signed_contract_body": "contract 2"}, {"order_id": 1}
+        )
+        self._get_parsed_contract(orders)
+        self.assertEqual(self.parse_contract.call_count, 3)
+
+
+class TestGetMultisig(unittest.TestCase):
+
+    def setUp(self):
+        self.db = mock.Mock()
+        self.orders = Orders(mock.Mock(), 1, self.db, None)
+        self.sections = (
+            {'Seller': {'seller_BTC_uncompressed_pubkey': 'seller'}},
+            {'Buyer': {'buyer_BTC_uncompressed_pubkey': 'buyer'}},
+            {'Notary': {'notary_BTC_uncompressed_pubkey': 'notary'}}
+        )
+
+    @mock.patch('node.orders.scriptaddr', return_value='address')
+    @mock.patch('node.orders.mk_multisig_script', return_value='script')
+    def test_derived_once(self, mk_multisig_script, _):
+        row = {'id': 7, 'address': '', 'multisig_script': ''}
+        parsed = mock.patch.object(
+            self.orders, 'get_parsed_contract', return_value=self.sections
+        )
+        with parsed:
+            self.assertEqual(
+                self.orders.get_multisig(row), ('script', 'address')
+            )
+            self.assertEqual(
+                self.orders.get_multisig(row), ('script', 'address')
+            )
+        mk_multisig_script.assert_called_once_with(
+            ['seller', 'buyer', 'notary'], 2, 3
+        )
+        self.db.update_entries.assert_called_once_with(
+            "orders",
+            {"multisig_script": 'script', "address": 'address'},
+            {"id": 7}
+        )
+
+    def test_stored(self):
+        row = {'id': 7, 'address': 'address', 'multisig_script': 'script'}
+        self.assertEqual(self.orders.get_multisig(row), ('script', 'address'))
+        self.assertFalse(self.db.update_entries.called)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import time
+import unittest
+
+import mock
+
+from node import payment_poller
+
+
+class TestPaymentPoller(unittest.TestCase):
+
+    def setUp(self):
+        self.callback = mock.Mock()
+        self.io_loop = mock.Mock()
+        self.poller = payment_poller.PaymentPoller(
+            42, self.callback, io_loop=self.io_loop, watch_timeout=60
+        )
+        # Polls run synchronously.
+        self.io_loop.add_callback.side_effect = lambda func, *args: func(*args)
+        thread_patcher = mock.patch.object(
+            payment_poller.threading, 'Thread',
+            side_effect=lambda target, args: mock.Mock(
+                start=lambda: target(*args)
+            )
+        )
+        thread_patcher.start()
+        self.addCleanup(thread_patcher.stop)
+        start_patcher = mock.patch.object(payment_poller.PaymentPoller, 'start')
+        self.start = start_patcher.start()
+        self.addCleanup(start_patcher.stop)
+
+        self.balances = {'addr1': [100, 50], 'addr2': []}
+        unspent_patcher = mock.patch.object(
+            payment_poller.bitcoin, 'unspent',
+            side_effect=lambda address: [
+                {'value': value} for value in self.balances[address]
+            ]
+        )
+        self.unspent = unspent_patcher.start()
+        self.addCleanup(unspent_patcher.stop)
+
+    def test_watch_polls_new_address(self):
+        self.poller.watch(1, 'addr1')
+        self.start.assert_called_once_with()
+        self.callback.assert_called_once_with(1, 150)
+
+    def test_watch_reports_known_total(self):
+        self.poller.watch(1, 'addr1')
+        self.poller.watch(2, 'addr1')
+        self.assertEqual(self.unspent.call_count, 1)
+        self.callback.assert_called_with(2, 150)
+
+    def test_watch_runs_on_io_loop(self):
+        self.poller.watch(1, 'addr1')
+        self.io_loop.add_callback.side_effect = None
+        self.callback.reset_mock()
+        self.start.reset_mock()
+
+        self.poller.watch(2, 'addr1')
+        self.assertFalse(self.callback.called)
+        self.assertFalse(self.start.called)
+        self.io_loop.add_callback.assert_any_call(self.callback, 2, 150)
+        self.io_loop.add_callback.assert_any_call(self.poller.start)
+
+    def test_poll_batches_addresses(self):
+        self.poller.watch(1, 'addr1')
+        self.poller.watch(2, 'addr2')
+        self.unspent.reset_mock()
+        self.callback.reset_mock()
+
+        self.poller.poll()
+        self.assertEqual(self.unspent.call_count, 2)
+        # Unchanged balances are not reported again.
+        self.assertFalse(self.callback.called)
+
+        self.balances['addr2'] = [10]
+        self.poller.poll()
+        self.callback.assert_called_once_with(2, 10)
+
+    def test_poll_error(self):
+        self.unspent.side_effect = Exception('unreachable')
+        self.poller.watch(1, 'addr1')
+        self.assertFalse(self.callback.called)
+        self.assertFalse(self.poller._polling)
+
+    def test_poll_in_progress(self):
+        self.poller.watch(1, 'addr1')
+        self.poller._polling = True
+        self.poller.poll()
+        self.assertTrue(self.poller._poll_again)
+
+        self.unspent.reset_mock()
+        self.poller._on_poll_done({})
+        self.assertEqual(self.unspent.call_count, 1)
+
+    def test_watch_timeout(self):
+        self.poller.watch(1, 'addr1')
+        self.poller._watches['addr1']['watched'] = time.time() - 61
+        self.poller.poll()
+        self.assertEqual(len(self.poller), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,165 @@
+import os
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+import mock
+from PIL import Image
+
+from node import peer_images
+
+
+def _thumbnail(size, color=(0, 0, 255)):
+    output = StringIO()
+    Image.new('RGB', (size, size), color).save(output, format='PNG')
+    return output.getvalue()
+
+
+class TestImageURL(unittest.TestCase):
+
+    image_hash = 'ab' * 32
+
+    def test_image_url(self):
+        self.assertEqual(
+            peer_images.image_url(self.image_hash),
+            '/images/%s.png' % self.image_hash
+        )
+        self.assertEqual(
+            peer_images.image_url(self.image_hash, 'guid', 64),
+            '/images/%s-64.png?guid=guid' % self.image_hash
+        )
+
+    def test_with_image_url(self):
+        contract_body = {
+            'Contract': {'item_image_hashes': [self.image_hash]},
+            'Seller': {}
+        }
+        result = peer_images.with_image_url(contract_body, 'guid')
+        self.assertEqual(
+            result['Contract']['item_images'],
+            peer_images.image_url(self.image_hash, 'guid')
+        )
+        # Shared parsed contracts are left alone.
+        self.assertNotIn('item_images', contract_body['Contract'])
+
+    def test_without_image(self):
+        for contract_body in ({'Contract': {}}, {},
+                              {'Contract': {'item_image_hashes': ['../x']}}):
+            self.assertIs(
+                peer_images.with_image_url(contract_body, 'guid'),
+                contract_body
+            )
+
+
+class TestPeerImageCache(unittest.TestCase):
+
+    guid = '12' * 20
+    image_hash = 'ab' * 32
+
+    def setUp(self):
+        self.cache_dir = os.path.join(tempfile.mkdtemp(), 'peer_images')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.cache_dir))
+        self.transport = mock.Mock()
+        self.io_loop = mock.Mock()
+        self.thumbnail = _thumbnail(64)
+        self.cache = self._make_cache(max_bytes=3 * len(self.thumbnail))
+
+    def _make_cache(self, max_bytes):
+        return peer_images.PeerImageCache(
+            self.transport, 42, self.cache_dir, io_loop=self.io_loop,
+            max_bytes=max_bytes, timeout=30
+        )
+
+    def _get(self, image_hash=image_hash, size=64):
+        callback = mock.Mock()
+        self.cache.get(self.guid, image_hash, size, callback)
+        return callback
+
+    def _answer(self, data, image_hash=image_hash, size=64, guid=guid):
+        self.cache.on_image({
+            'senderGUID': guid, 'image_hash': image_hash, 'size': size,
+            'data': data.encode('base64') if data is not None else None
+        })
+
+    def test_fetched_once(self):
+        first, second = self._get(), self._get()
+        self.transport.send.assert_called_once_with({
+            'type': 'query_image', 'image_hash': self.image_hash, 'size': 64
+        }, self.guid)
+
+        self._answer(self.thumbnail)
+        first.assert_called_once_with(self.thumbnail)
+        second.assert_called_once_with(self.thumbnail)
+
+        # Then it is read from the cache, also by a new instance.
+        self.cache = self._make_cache(max_bytes=1024 * 1024)
+        self._get().assert_called_once_with(self.thumbnail)
+        self.assertEqual(self.transport.send.call_count, 1)
+
+    def test_invalid_image(self):
+        callback = self._get()
+        # Not of the size asked for
+        self._answer(_thumbnail(200))
+        callback.assert_called_once_with(None)
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_other_sender(self):
+        callback = self._get()
+        self._answer(_thumbnail(64, (255, 0, 0)), guid='34' * 20)
+        self.assertFalse(callback.called)
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+        self._answer(self.thumbnail)
+        callback.assert_called_once_with(self.thumbnail)
+
+    def test_cached_per_store(self):
+        self._get()
+        self._answer(self.thumbnail)
+
+        callback = mock.Mock()
+        self.cache.get('34' * 20, self.image_hash, 64, callback)
+        self.assertFalse(callback.called)
+        self.assertEqual(self.transport.send.call_count, 2)
+
+    def test_invalid_query(self):
+        callback = mock.Mock()
+        self.cache.get('../guid', self.image_hash, 64, callback)
+        callback.assert_called_once_with(None)
+        self.assertFalse(self.transport.send.called)
+
+    def test_unknown_image(self):
+        callback = self._get()
+        self._answer(None)
+        callback.assert_called_once_with(None)
+
+    def test_timeout(self):
+        callback = self._get()
+        delay, expire, key, callbacks = self.io_loop.call_later.call_args[0]
+        self.assertEqual(delay, 30)
+        expire(key, callbacks)
+        callback.assert_called_once_with(None)
+
+        # A late answer is ignored.
+        self._answer(self.thumbnail)
+        self.assertEqual(callback.call_count, 1)
+
+    def test_least_recently_used_evicted(self):
+        hashes = ['%02d' % number * 32 for number in range(4)]
+        for image_hash in hashes[:3]:
+            self._get(image_hash)
+            self._answer(self.thumbnail, image_hash)
+        # Use the first one again, then add a fourth.
+        self._get(hashes[0])
+        self._get(hashes[3])
+        self._answer(self.thumbnail, hashes[3])
+
+        self.assertEqual(
+            sorted(os.listdir(self.cache_dir)),
+            sorted('%s-%s-64.png' % (self.guid, image_hash)
+                   for image_hash in (hashes[0], hashes[2], hashes[3]))
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
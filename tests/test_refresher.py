@@ -0,0 +1,89 @@
+import threading
+import unittest
+
+import mock
+
+from node import refresher
+
+
+class TestRoutingTableRefresher(unittest.TestCase):
+
+    def setUp(self):
+        self.dht = mock.Mock()
+        self.dht._peers_lock = threading.RLock()
+        self.dht.routing_table.get_refresh_list.return_value = [
+            '01', '02', '03', '04'
+        ]
+        self.dht.routing_table.kbucket_index.return_value = 0
+        self.bucket = mock.Mock()
+        self.bucket.is_stale.return_value = True
+        self.dht.routing_table.buckets = [self.bucket]
+
+        self.callbacks = {}
+
+        def iterative_find_node(node_id, callback=None):
+            self.callbacks[node_id] = callback
+            search = mock.Mock()
+            search.contacted_now = 2
+            search.find_id = node_id
+            return search
+
+        self.dht.iterative_find_node.side_effect = iterative_find_node
+        self.refresher = refresher.RoutingTableRefresher(
+            self.dht, 42, concurrency=2, spread=60, lookup_timeout=30
+        )
+
+    def _start_cycle(self):
+        self.refresher.refresh()
+        # Fire the paced starts in order.
+        starts = list(self.dht.transport.loop.call_later.call_args_list)
+        for call in starts:
+            delay, func, node_id = call[0]
+            self.assertLess(delay, 60)
+            func(node_id)
+
+    def test_refresh_nothing_stale(self):
+        self.dht.routing_table.get_refresh_list.return_value = []
+        self.refresher.refresh()
+        self.assertFalse(self.refresher.running)
+        self.assertEqual(self.refresher.last_cycle['buckets'], 0)
+
+    def test_concurrency_cap(self):
+        self._start_cycle()
+        self.assertEqual(sorted(self.callbacks), ['01', '02'])
+
+        self.callbacks['01']([])
+        self.assertEqual(sorted(self.callbacks), ['01', '02', '03'])
+        self.dht.cancel_search.assert_called_once_with('01')
+
+        # Repeated callbacks of the same search count once.
+        self.callbacks['01']([])
+        self.assertEqual(len(self.callbacks), 3)
+
+    def test_cycle_stats(self):
+        self._start_cycle()
+        for node_id in ['01', '02', '03', '04']:
+            self.callbacks[node_id]([])
+
+        self.assertFalse(self.refresher.running)
+        cycle = self.refresher.last_cycle
+        self.assertEqual(cycle['refreshed'], 4)
+        self.assertEqual(cycle['skipped'], 0)
+        self.assertEqual(cycle['messages'], 8)
+        self.assertIn('duration', cycle)
+
+    def test_skips_recently_touched(self):
+        self.bucket.is_stale.return_value = False
+        self._start_cycle()
+        self.assertFalse(self.dht.iterative_find_node.called)
+        self.assertFalse(self.refresher.running)
+        self.assertEqual(self.refresher.last_cycle['skipped'], 4)
+
+    def test_previous_cycle_running(self):
+        self._start_cycle()
+        self.refresher.refresh()
+        self.assertEqual(self.dht.routing_table.get_refresh_list.call_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+import time
+import unittest
+
+import mock
+
+from node import constants, datastore, republisher
+
+
+class TestRepublishScheduler(unittest.TestCase):
+
+    own_guid = 'a' * constants.HEX_NODE_ID_LEN
+    other_guid = 'b' * constants.HEX_NODE_ID_LEN
+
+    def setUp(self):
+        self.entries = {}
+        self.dht = mock.Mock()
+        self.dht.settings = {'guid': self.own_guid}
+        self.dht.transport.handler = None
+        self.dht.data_store = mock.MagicMock(spec=datastore.SqliteDataStore)
+        self.dht.data_store.get_entry.side_effect = self.entries.get
+        self.dht.data_store.get_metadata.side_effect = lambda: [
+            (
+                key,
+                entry['lastPublished'],
+                entry['originallyPublished'],
+                entry['originalPublisherID']
+            )
+            for key, entry in self.entries.items()
+        ]
+        self.scheduler = republisher.RepublishScheduler(
+            self.dht, 42, batch_size=3, bandwidth_budget=100
+        )
+
+    def _add_entry(self, key, age, publisher_id, value='value'):
+        published = int(time.time()) - age
+        self.entries[key] = {
+            'value': value,
+            'lastPublished': published,
+            'originallyPublished': published,
+            'originalPublisherID': publisher_id
+        }
+
+    def test_load(self):
+        self._add_entry('01', 0, self.own_guid)
+        self._add_entry('02', 0, self.other_guid)
+        self.scheduler.load()
+        self.assertEqual(len(self.scheduler), 2)
+        self.dht.data_store.get_metadata.assert_called_once_with()
+
+    def test_tick_nothing_due(self):
+        self._add_entry('01', 0, self.own_guid)
+        self.scheduler.load()
+        self.assertEqual(self.scheduler.tick(), 0)
+        self.assertFalse(self.dht.iterative_store.called)
+        self.assertFalse(self.dht.data_store.get_entry.called)
+
+    def test_tick_republishes_own_data(self):
+        self._add_entry('01', constants.REPUBLISH_INTERVAL, self.own_guid)
+        self.scheduler.load()
+        self.assertEqual(self.scheduler.tick(), 1)
+        self.dht.iterative_store.assert_called_once_with('01', 'value')
+        # Rescheduled for the next interval.
+        self.assertEqual(len(self.scheduler), 1)
+        self.assertEqual(self.scheduler.tick(), 0)
+
+    def test_tick_replicates_other_data(self):
+        age = constants.REPUBLISH_INTERVAL
+        self._add_entry('01', age, self.other_guid)
+        self.scheduler.load()
+        self.assertEqual(self.scheduler.tick(), 1)
+        args = self.dht.iterative_store.call_args[0]
+        self.assertEqual(args[:3], ('01', 'value', self.other_guid))
+        self.assertGreaterEqual(args[3], age)
+
+    def test_tick_expires_other_data(self):
+        self._add_entry('01', constants.DATE_EXPIRE_TIMEOUT, self.other_guid)
+        self.scheduler.load()
+        self.assertEqual(self.scheduler.tick(), 0)
+        self.assertFalse(self.dht.iterative_store.called)
+        self.dht.data_store.__delitem__.assert_called_once_with('\x01')
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_tick_batch_size(self):
+        for i in range(5):
+            self._add_entry('0%d' % i, constants.REPUBLISH_INTERVAL, self.own_guid)
+        self.scheduler.load()
+        self.assertEqual(self.scheduler.tick(), 3)
+        self.assertEqual(self.scheduler.tick(), 2)
+        self.assertEqual(self.scheduler.tick(), 0)
+
+    def test_tick_bandwidth_budget(self):
+        for i in range(3):
+            self._add_entry(
+                '0%d' % i, constants.REPUBLISH_INTERVAL, self.own_guid,
+                value='x' * 40
+            )
+        self.scheduler.load()
+        self.assertEqual(self.scheduler.tick(), 2)
+        self.assertEqual(self.dht.iterative_store.call_count, 2)
+
+    def test_schedule_supersedes(self):
+        self._add_entry('01', constants.REPUBLISH_INTERVAL, self.own_guid)
+        self.scheduler.load()
+        # The key was stored again just now.
+        self.scheduler.schedule('01', int(time.time()), 0, self.own_guid)
+        self.assertEqual(self.scheduler.tick(), 0)
+        self.assertFalse(self.dht.data_store.get_entry.called)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -145,6 +145,42 @@ class TestOptimizedTreeRoutingTable(TestRoutingTable):
         self.assertEqual(self.id1, self.routingtable.get_contact(self.id1))
         self.assertIsNone(self.routingtable.get_contact(self.id2))
 
+    def _fill_high_half(self, count):
+        contacts = [
+            guid.GUIDMixin(self.routingtable.num_to_id(self.range_max - 1 - i))
+            for i in range(count)
+        ]
+        for contact in contacts:
+            self.routingtable.add_contact(contact)
+        return contacts
+
+    def test_add_contact_split_and_get_contact(self):
+        contacts = self._fill_high_half(constants.K + 1)
+
+        # The initial KBucket covered the parent node id, so it was split.
+        self.assertEqual(len(self.routingtable.buckets), 2)
+        for contact in contacts[:constants.K]:
+            self.assertIs(contact, self.routingtable.get_contact(contact.guid))
+            self.assertIs(contact, self.routingtable.get_contact(contact))
+
+        # The other KBucket can't be split, so the last contact is cached.
+        self.assertIsNone(self.routingtable.get_contact(contacts[-1].guid))
+        self.assertEqual(
+            self.routingtable.replacement_cache,
+            {1: [contacts[-1]]}
+        )
+
+    def test_remove_contact_refills_from_cache(self):
+        contacts = self._fill_high_half(constants.K + 1)
+
+        self.routingtable.remove_contact(contacts[0].guid)
+        self.assertIsNone(self.routingtable.get_contact(contacts[0].guid))
+        self.assertIs(
+            contacts[-1],
+            self.routingtable.get_contact(contacts[-1].guid)
+        )
+        self.assertEqual(self.routingtable.replacement_cache, {})
+
     def _init_n_buckets(self, number):
         bucket_range = self.range_max - self.range_min
         chop = bucket_range // number
@@ -0,0 +1,198 @@
+import functools
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from node import constants, db_store, market, setup_db, store_listings
+from node.contract_cache import ContractCache
+
+
+def _listing(number):
+    return {'key': '%02d' % number * 20, 'item_title': 'Listing %d' % number}
+
+
+class TestStoreListingCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = store_listings.StoreListingCache()
+
+    def test_listing_digest(self):
+        self.assertEqual(
+            len(store_listings.listing_digest('a' * 40)),
+            constants.LISTING_DIGEST_LENGTH
+        )
+
+    def test_add_and_remove(self):
+        for number in range(3):
+            self.cache.add('store', _listing(number))
+        self.cache.add('store', _listing(1))
+        self.assertEqual(len(self.cache.listings('store')), 3)
+        self.assertEqual(self.cache.known('store'), sorted(
+            store_listings.listing_digest(_listing(number)['key'])
+            for number in range(3)
+        ))
+
+        removed = self.cache.remove('store', [
+            store_listings.listing_digest(_listing(1)['key']), 'unknown'
+        ])
+        self.assertEqual(removed, [_listing(1)])
+        self.assertEqual(len(self.cache.listings('store')), 2)
+        self.assertEqual(self.cache.listings('other'), [])
+
+    def test_bounded(self):
+        self.cache = store_listings.StoreListingCache(max_bytes=200)
+        self.cache.add('store1', _listing(1))
+        self.cache.add('store2', _listing(2))
+        # Browsing store1 makes store2 the least recently used.
+        self.cache.listings('store1')
+        self.cache.add('store3', _listing(3))
+        self.assertEqual(self.cache.listings('store2'), [])
+        self.assertEqual(len(self.cache.listings('store1')), 1)
+
+
+class TestQueryListings(unittest.TestCase):
+
+    def setUp(self):
+        self.market = mock.Mock()
+        self.market.market_id = 1
+        self.market.get_contracts.return_value = {
+            'contracts': [_listing(1), _listing(2)],
+            'page': 0,
+            'total_contracts': 3
+        }
+        self.market.db_connection.select_entries.return_value = [
+            {'key': _listing(number)['key']} for number in range(1, 4)
+        ]
+
+    def _query(self, **query):
+        query['senderGUID'] = 'peer'
+        market.Market.on_query_listings.im_func(self.market, query)
+        return [
+            call[0][0] for call in self.market.transport.send.call_args_list
+        ]
+
+    def test_without_known(self):
+        sent = self._query()
+        self.assertEqual(
+            [msg['type'] for msg in sent], ['listing_result', 'listing_result']
+        )
+
+    def test_only_missing_sent(self):
+        known = [
+            store_listings.listing_digest(_listing(number)['key'])
+            for number in (1, 5)
+        ]
+        sent = self._query(known=known, page=0)
+        self.assertEqual(sent[0]['key'], _listing(2)['key'])
+        self.assertEqual(sent[1]['type'], 'listing_sync')
+        self.assertEqual(sent[1]['removed'], [known[1]])
+        self.assertEqual(len(sent), 2)
+        self.market.get_contracts.assert_called_once_with(0, remote=True)
+
+
+class TestStreamListings(unittest.TestCase):
+
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        db_path = os.path.join(self.db_dir, 'testdb.db')
+        setup_db.setup_db(db_path, disable_sqlite_crypt=True)
+        self.db = db_store.Obdb(db_path, disable_sqlite_crypt=True)
+        self.db.insert_many("contracts", [
+            {
+                "market_id": 1,
+                "key": _listing(number)['key'],
+                "deleted": 1 if number == 3 else 0,
+                "contract_body": json.dumps({'Contract': {
+                    'item_title': 'Listing %d' % number,
+                    'item_delivery': {}
+                }})
+            }
+            for number in range(1, 13)
+        ])
+
+        self.market = mock.Mock()
+        self.market.market_id = 1
+        self.market.db_connection = self.db
+        self.market.contract_cache = ContractCache()
+        self.market.loop.add_callback.side_effect = (
+            lambda func, *args: func(*args)
+        )
+        for name in ('stream_listings', '_send_in_turn',
+                     'get_contracts_after', 'make_listing'):
+            setattr(self.market, name, functools.partial(
+                getattr(market.Market, name).im_func, self.market
+            ))
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.db_dir)
+
+    def _query(self, **query):
+        self.market.transport.send.reset_mock()
+        query['senderGUID'] = 'peer'
+        market.Market.on_query_listings.im_func(self.market, query)
+        return [
+            call[0][0] for call in self.market.transport.send.call_args_list
+        ]
+
+    @staticmethod
+    def _titles(sent):
+        return [
+            contract['item_title']
+            for msg in sent if msg['type'] == 'listing_results'
+            for contract in msg['contracts']
+        ]
+
+    def test_windows(self):
+        sent = self._query(window=7, cursor=None)
+        # Two frames, then the sync message.
+        self.assertEqual(
+            [msg['type'] for msg in sent],
+            ['listing_results', 'listing_results', 'listing_sync']
+        )
+        self.assertEqual(
+            self._titles(sent),
+            ['Listing %d' % number for number in (1, 2, 4, 5, 6, 7, 8)]
+        )
+        sync = sent[-1]
+        self.assertTrue(sync['more'])
+        self.assertEqual(sync['total_contracts'], 11)
+
+        sent = self._query(window=7, cursor=sync['cursor'])
+        self.assertEqual(
+            self._titles(sent),
+            ['Listing %d' % number for number in range(9, 13)]
+        )
+        self.assertFalse(sent[-1]['more'])
+
+    def test_known_and_removed(self):
+        known = [
+            store_listings.listing_digest(_listing(number)['key'])
+            for number in (1, 3)
+        ]
+        sent = self._query(window=3, cursor=None, known=known)
+        self.assertEqual(self._titles(sent), ['Listing 2', 'Listing 4'])
+        self.assertEqual(sent[-1]['removed'], [known[1]])
+
+    def test_frames_sent_in_turn(self):
+        self.market.loop.add_callback.side_effect = None
+        self._query(window=7, cursor=None)
+        self.assertFalse(self.market.transport.send.called)
+
+        # Each message is sent on its own iteration, after the previous one.
+        for msg_type in ('listing_results', 'listing_results', 'listing_sync'):
+            scheduled = self.market.loop.add_callback.call_args[0]
+            self.market.loop.add_callback.reset_mock()
+            scheduled[0](*scheduled[1:])
+            self.assertEqual(
+                self.market.transport.send.call_args[0][0]['type'], msg_type
+            )
+        self.assertFalse(self.market.loop.add_callback.called)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+import mock
+from PIL import Image
+
+from node import constants, thumbnails
+from node.data_uri import DataURI
+
+
+def _image_data(width=300, height=150):
+    output = StringIO()
+    Image.new('RGB', (width, height), (255, 0, 0)).save(output, format='JPEG')
+    return output.getvalue()
+
+
+class TestThumbnailCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = os.path.join(tempfile.mkdtemp(), 'images')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.cache_dir))
+
+        io_loop = mock.Mock()
+        io_loop.add_callback.side_effect = lambda func, *args: func(*args)
+        self.cache = thumbnails.ThumbnailCache(
+            self.cache_dir, 42, io_loop=io_loop
+        )
+        # Work runs synchronously.
+        pool_patcher = mock.patch.object(
+            thumbnails, 'ThreadPool',
+            return_value=mock.Mock(apply_async=lambda func: func())
+        )
+        pool_patcher.start()
+        self.addCleanup(pool_patcher.stop)
+
+        self.data = _image_data()
+        self.uri = DataURI.make('image/jpeg', None, True, self.data)
+
+    def _add(self, uri):
+        callback = mock.Mock()
+        self.cache.add(uri, callback)
+        return callback.call_args[0][0]
+
+    def _get(self, image_hash, size):
+        callback = mock.Mock()
+        self.cache.get(image_hash, size, callback)
+        return callback.call_args[0][0]
+
+    def test_add(self):
+        image_hash = self._add(self.uri)
+        self.assertEqual(image_hash, thumbnails.image_hash(self.data))
+        with open(self.cache.path(image_hash), 'rb') as image_file:
+            self.assertEqual(image_file.read(), self.data)
+        path = self.cache.path(image_hash, constants.THUMBNAIL_SIZE)
+        with open(path, 'rb') as image_file:
+            self.assertEqual(
+                Image.open(StringIO(image_file.read())).size,
+                (constants.THUMBNAIL_SIZE, constants.THUMBNAIL_SIZE)
+            )
+
+    def test_add_twice(self):
+        self.assertEqual(self._add(self.uri), self._add(self.uri))
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    def test_add_unreadable(self):
+        uri = DataURI.make('image/jpeg', None, True, 'not an image')
+        self.assertIsNone(self._add(uri))
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_sizes_rendered_lazily(self):
+        image_hash = self._add(self.uri)
+        path = self.cache.path(image_hash, 64)
+        self.assertFalse(os.path.exists(path))
+
+        thumbnail = self._get(image_hash, 64)
+        self.assertEqual(Image.open(StringIO(thumbnail)).size, (64, 64))
+        self.assertTrue(os.path.exists(path))
+
+        with mock.patch.object(thumbnails, 'render_thumbnail') as render:
+            self.assertEqual(self._get(image_hash, 64), thumbnail)
+            self.assertFalse(render.called)
+
+    def test_get_unknown(self):
+        self.assertIsNone(self._get('0' * 64, constants.THUMBNAIL_SIZE))
+        self.assertIsNone(self._get('../secret', constants.THUMBNAIL_SIZE))
+        self.assertRaises(ValueError, self.cache.get, '0' * 64, 13, None)
+
+
+if __name__ == "__main__":
+    unittest.main()